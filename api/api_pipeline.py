@@ -1,10 +1,9 @@
 import os
 import logging
-import tempfile
 import shutil
-import pickle
+import threading
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Callable, Union
 from PIL import Image
 from datetime import datetime
 
@@ -12,47 +11,75 @@ os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 # Import original CAIRE functions - exactly like main.py
-from src.scripts.retrieval import process_images
+from src.scripts.retrieval import get_retrieval_context
 from src.scripts.disambiguation import lemma_match
 from src.scripts.fetch_wikipedia import wiki_retrieval
-from src.scripts.culture_scores import qwen_vl_scores
-from src.utils import load_model
-from src.config import MAX_WIKI_DOCS, OUTPUT_PATH
+from src.scripts.culture_scores import qwen_vl_scores, WIKI_FIELDS, WIKI_CHAR_BUDGET
+from src.scripts.stages import RetrievalResult, LemmaResult, WikiResult, save_retrieval, save_lemmas, save_wiki, save_scores
+from src.models.model_loader import get_model
+from src.config import MAX_WIKI_DOCS, OUTPUT_PATH, NUMBER_RETRIEVED_IMAGES, LEMMA_TOP_K, WIKI_BACKEND, API_PERSIST_RUNS
+from src.image_handle import ImageHandle
+from api.result_cache import get_result_cache
+from api.sessions import SessionStore, mark_run_dir
+from api.batcher import RetrievalBatcher
+from api.executor import ScoringLock
 
 logger = logging.getLogger(__name__)
 
+# Name of the uploaded image in a run's stage results; the image itself is passed in memory and never written
+IMAGE_NAME = "uploaded_image"
+
 class CAIREPipeline:
     def __init__(self):
-        self.model = None
-        self.processor = None
-        self.cache = {}  # Cache for storing intermediate results by session_id
+        self.retrieval = None  # SigLIP encoder + FAISS index, loaded once
+        self.cache = SessionStore()  # Intermediate results by session_id, bounded in count and age
+        self.persist_runs = API_PERSIST_RUNS  # Also write each request's stage results to a run directory
+        self.result_cache = None  # Stage outputs by image digest, shared across sessions and restarts
+        self.batcher = None  # Shares SigLIP + FAISS batches between concurrent requests
+        self.scoring_lock = ScoringLock()  # One VLM scoring run at a time on the GPU, ahead of batch jobs
+        self._in_flight = set()  # Run directories of requests still running, not yet owned by a session
+        self._in_flight_lock = threading.Lock()
         
     def initialize(self):
-        """Initialize models - like main.py line 22-23"""
+        """Initialize models and the retrieval index once for the lifetime of the server"""
         logger.info("Initializing model...")
-        self.model, self.processor = load_model()
+        self.retrieval = get_retrieval_context()
+        self.result_cache = get_result_cache()
+        self.batcher = RetrievalBatcher(self.retrieval)
+        # Keep the default scoring VLM resident so the first request does not pay for loading it
+        get_model('qwen_vl')
         logger.info("Model initialized successfully")
     
-    def process_image(self, image: Image.Image, cultures: List[str], use_multiple_wiki_pages: bool = False, model_name: str = 'qwen_vl', session_id: str = None) -> Dict[str, Any]:
+    def process_image(self, image: Union[ImageHandle, Image.Image], cultures: List[str], use_multiple_wiki_pages: bool = False, model_name: str = 'qwen_vl', session_id: str = None, scoring_mode: str = 'generate', on_event: Optional[Callable[[str, Dict[str, Any]], None]] = None) -> Dict[str, Any]:
         """Run the CAIRE pipeline - exactly like run_pipeline() in main.py
         
         Args:
-            image: Input image to process
+            image: Input image to process, decoded once and shared by retrieval and scoring
             cultures: List of cultures to evaluate
             use_multiple_wiki_pages: Whether to use multiple Wikipedia pages for context
             model_name: VLM model to use for scoring ('qwen_vl', 'pangea_vl', 'llama_vl')
             session_id: Optional session ID to reuse cached intermediate results
+            scoring_mode: 'generate' for scores with reasoning, 'logits' for single-pass scores with a 1-5 distribution
+            on_event: Optional callback(event, payload) for streaming progress: 'context' with the matched
+                      entity, Wikipedia pages and session_id once Wikipedia retrieval is done, then 'score'
+                      with each culture's score as it is produced
         """
         
+        if not isinstance(image, ImageHandle):
+            image = ImageHandle(image=image)
+        digest = image.digest
+
         # Check if we can reuse cached results
-        logger.info(f"Cache check: session_id={session_id}, cache_keys={list(self.cache.keys())}")
-        if session_id and session_id in self.cache:
-            cached_data = self.cache[session_id]
+        logger.info(f"Cache check: session_id={session_id}, cache_keys={self.cache.keys()}")
+        cached_data = self.cache.get(session_id) if session_id else None
+        if cached_data is not None and cached_data['image_hash'] != digest:
+            logger.info(f"Session {session_id} was created for a different image, running full pipeline")
+        elif cached_data is not None:
             logger.info(f"Found cached session {session_id}, analyzing cultures: {cultures}")
             # Image matches (same session) - only cultures, wiki mode, and model can differ
             # All of those only affect scoring, not retrieval/lemma/wikipedia steps
             logger.info(f"✅ Reusing cached data from session {session_id}, only running scoring for cultures={cultures} with {model_name} and wiki_mode={use_multiple_wiki_pages}")
-            return self._process_with_cache(cached_data, cultures, use_multiple_wiki_pages, model_name, session_id)
+            return self._process_with_cache(cached_data, cultures, use_multiple_wiki_pages, model_name, session_id, scoring_mode, on_event)
         else:
             logger.info(f"No cache found for session {session_id}, running full pipeline")
         
@@ -66,45 +93,91 @@ class CAIREPipeline:
         args.is_predefined_list = False
         args.is_folder = False
         
-        # Create output directory (like main.py lines 47-48)
+        # Stage results are handed over in memory; with API_PERSIST_RUNS they are also
+        # written to a run directory (like main.py lines 47-48) for inspection
         output_dir = Path(OUTPUT_PATH) / args.timestamp
-        output_dir.mkdir(parents=True, exist_ok=True)
+        persist = self.persist_runs
         
-        # Save image in output directory for caching
-        cached_image_path = output_dir / "cached_image.jpg"
-        image.save(cached_image_path)
-        args.image_paths = [cached_image_path]
+        image_path = output_dir / IMAGE_NAME
+        args.image_paths = [image_path]
+        args.images = {image_path: image}
+
+        # Everything before scoring depends only on the image and these settings
+        result_key = None
+        if self.result_cache is not None:
+            result_key = self.result_cache.key(digest, {
+                "retrieved_images": NUMBER_RETRIEVED_IMAGES,
+                "lemma_top_k": LEMMA_TOP_K,
+                "max_wiki_docs": MAX_WIKI_DOCS,
+                "wiki_fields": WIKI_FIELDS,
+                "wiki_chars": WIKI_CHAR_BUDGET,
+                "wiki_backend": WIKI_BACKEND
+            })
         
         try:
+            if persist:
+                # Protected from the output sweeper until the session owns it
+                with self._in_flight_lock:
+                    self._in_flight.add(output_dir.resolve())
+                output_dir.mkdir(parents=True, exist_ok=True)
+                mark_run_dir(output_dir)
             
-            # Run pipeline - EXACT sequence from main.py lines 25-35
-            logger.info("Processing images...")
-            process_images(args, self.model, self.processor)
-            
-            logger.info("Performing lemma matching...")
-            lemma_match(args)
+            cached_stages = self.result_cache.get(result_key) if result_key is not None else None
+            if cached_stages is not None:
+                logger.info(f"✅ Reusing retrieval, lemma and Wikipedia results for image {digest[:12]}")
+                retrieval, lemmas, wiki = cached_stages
+                # Embeddings are keyed by image path; name the cached one after this run's image
+                retrieval = RetrievalResult(retrieval.bids, dict(zip(args.image_paths, retrieval.embeddings.values())))
+                if persist:
+                    save_retrieval(args, retrieval)
+                    save_lemmas(args, lemmas)
+                    save_wiki(args, wiki)
+            else:
+                # Run pipeline - EXACT sequence from main.py lines 25-35
+                logger.info("Processing images...")
+                embedding, neighbors = self.batcher.retrieve(image)
+                retrieval = RetrievalResult([neighbors], {image_path: embedding})
+                if persist:
+                    save_retrieval(args, retrieval)
+                
+                logger.info("Performing lemma matching...")
+                lemmas = lemma_match(args, retrieval, persist=persist)
+                
+                logger.info("Fetching Wikipedia data...")
+                wiki = wiki_retrieval(args, MAX_WIKI_DOCS, fields=WIKI_FIELDS, max_chars=WIKI_CHAR_BUDGET, lemmas=lemmas, persist=persist)
+
+                # Results cut short by the Wikipedia deadline are not cached
+                if result_key is not None and not any(wiki.skipped):
+                    self.result_cache.put(result_key, retrieval, lemmas, wiki)
             
-            logger.info("Fetching Wikipedia data...")
-            wiki_retrieval(args, MAX_WIKI_DOCS)
+            context = self._context(lemmas, wiki)
+            if on_event is not None:
+                on_event("context", {**context, "session_id": args.timestamp})
             
-            logger.info(f"1-5 Scoring with {model_name}...")
-            qwen_vl_scores(args, use_multiple_wiki_pages, model_name)
+            logger.info(f"1-5 Scoring with {model_name} ({scoring_mode})...")
+            with self.scoring_lock:
+                SCORES = qwen_vl_scores(args, use_multiple_wiki_pages, model_name, scoring_mode=scoring_mode, on_score=self._score_callback(on_event), wiki=wiki, persist=persist)
             
-            # Read results
-            logger.info("Reading results...")
-            results = self._read_results(args, model_name)
+            results = {"scores": self._format_scores(SCORES[0]), **context}
             
             # Generate session_id and cache intermediate results for reuse
             session_id = args.timestamp
             
-            # Cache the output directory and image info for potential reuse
+            # Cache the stage results and image info for potential reuse
             # Note: We don't cache cultures or wiki_mode since they only affect scoring
-            self.cache[session_id] = {
-                'output_dir': str(output_dir),
+            session = {
+                'output_dir': str(output_dir) if persist else None,
                 'timestamp': args.timestamp,
-                'image_path': str(cached_image_path),
-                'image_hash': hash(image.tobytes())  # To verify same image
+                'image_path': str(image_path),
+                'image': image,  # Re-decoded from the upload bytes if the session is scored again
+                'image_hash': digest,  # To verify same image
+                'lemmas': lemmas,
+                'wiki': wiki,
+                'scores': {}  # Score tables by (model, scoring mode, wiki mode), see _merge_scores
             }
+            self._merge_scores(session, SCORES[0], model_name, scoring_mode, use_multiple_wiki_pages)
+            image.release()
+            self.cache.put(session_id, session)
             
             # Add session_id to results
             results['session_id'] = session_id
@@ -119,8 +192,17 @@ class CAIREPipeline:
             except Exception as cleanup_error:
                 logger.warning(f"Failed to clean up on error: {cleanup_error}")
             raise e
+        finally:
+            if persist:
+                with self._in_flight_lock:
+                    self._in_flight.discard(output_dir.resolve())
     
-    def _process_with_cache(self, cached_data: Dict[str, Any], cultures: List[str], use_multiple_wiki_pages: bool, model_name: str, session_id: str) -> Dict[str, Any]:
+    def run_dirs(self) -> List[Path]:
+        """Run directories of requests still in flight, which the output sweeper must keep"""
+        with self._in_flight_lock:
+            return list(self._in_flight)
+
+    def _process_with_cache(self, cached_data: Dict[str, Any], cultures: List[str], use_multiple_wiki_pages: bool, model_name: str, session_id: str, scoring_mode: str = 'generate', on_event: Optional[Callable[[str, Dict[str, Any]], None]] = None) -> Dict[str, Any]:
         """Process only the scoring step using cached intermediate results"""
         
         # Reconstruct args object from cached data
@@ -130,52 +212,95 @@ class CAIREPipeline:
         args = Args()
         args.timestamp = cached_data['timestamp']
         args.target_list = cultures
-        args.image_paths = [Path(cached_data['image_path'])]  # Reuse cached image
+        args.image_paths = [Path(cached_data['image_path'])]
+        args.images = {args.image_paths[0]: cached_data['image']}  # Reuse the session's image
         
-        # Always run scoring since cultures, model, or wiki_mode may have changed
-        output_dir = Path(cached_data['output_dir'])
-        logger.info(f"Running scoring with {model_name} for cultures={cultures} with wiki_mode={use_multiple_wiki_pages}")
-        qwen_vl_scores(args, use_multiple_wiki_pages, model_name)
+        # Only cultures not yet scored with this model, scoring mode and wiki mode are scored
+        table = cached_data.setdefault('scores', {}).get((model_name, scoring_mode, use_multiple_wiki_pages), {})
+        missing = [culture for culture in dict.fromkeys(cultures) if culture not in table]
+        context = self._context(cached_data['lemmas'], cached_data['wiki'])
+        if on_event is not None:
+            on_event("context", {**context, "session_id": session_id})
+            for culture in dict.fromkeys(cultures):
+                if culture in table:
+                    row = table[culture]
+                    on_event("score", self._format_score(culture, row['score'], row['reasoning'], row['distribution']))
+        if missing:
+            logger.info(f"Running scoring with {model_name} for cultures={missing} with wiki_mode={use_multiple_wiki_pages}")
+            args.target_list = missing
+            try:
+                with self.scoring_lock:
+                    SCORES = qwen_vl_scores(args, use_multiple_wiki_pages, model_name, scoring_mode=scoring_mode, on_score=self._score_callback(on_event), wiki=cached_data['wiki'], persist=False)
+            finally:
+                cached_data['image'].release()
+            table = self._merge_scores(cached_data, SCORES[0], model_name, scoring_mode, use_multiple_wiki_pages)
+        else:
+            logger.info(f"✅ All cultures already scored with {model_name} in session {session_id}")
+
+        # The requested cultures' entry, as a full scoring run would return it
+        args.target_list = cultures
+        rows = {culture: table.get(culture, {}) for culture in cultures}
+        entry = {
+            'image_path': args.image_paths[0],
+            'values': {culture: row.get('score') for culture, row in rows.items()},
+            'reasoning': {culture: row.get('reasoning') for culture, row in rows.items()}
+        }
+        if scoring_mode == 'logits':
+            entry['distribution'] = {culture: row.get('distribution') for culture, row in rows.items()}
+        if cached_data['output_dir'] is not None:
+            save_scores(args, model_name, [entry])
         
-        # Read and return results
-        results = self._read_results(args, model_name)
+        results = {"scores": self._format_scores(entry), **context}
         results['session_id'] = session_id
         
         return results
-    
-    def _read_results(self, args, model_name: str = 'qwen_vl') -> Dict[str, Any]:
-        """Read results from pickle files created by CAIRE pipeline"""
-        
-        output_dir = Path(OUTPUT_PATH) / args.timestamp
-        
-        # Read Wikipedia data
-        wiki_path = output_dir / "WIKI.pkl"
-        with open(wiki_path, 'rb') as f:
-            wiki_data = pickle.load(f)
-        
-        # Read lemma match data (contains scores for each bid)
-        lemma_path = output_dir / "lemma_match.pkl"
-        with open(lemma_path, 'rb') as f:
-            lemma_data = pickle.load(f)
-        
-        # Read scores - use dynamic filename based on model_name
-        scores_path = output_dir / f"1-5_scores_VLM_{model_name}.pkl"
-        with open(scores_path, 'rb') as f:
-            scores_data = pickle.load(f)
-        
-        # Format results for API response
-        scores_result = []
-        reasoning_data = scores_data[0].get('reasoning', {})
-        for culture, score in scores_data[0]['values'].items():
-            # Handle None scores from models like pangea_vl
+
+    @staticmethod
+    def _merge_scores(cached_data: Dict[str, Any], scores: Dict[str, Any], model_name: str, scoring_mode: str, use_multiple_wiki_pages: bool) -> Dict[str, Any]:
+        """Add one image's qwen_vl_scores entry to the session's score table and return the table"""
+        table = cached_data['scores'].setdefault((model_name, scoring_mode, use_multiple_wiki_pages), {})
+        distribution = scores.get('distribution', {})
+        for culture, score in scores['values'].items():
+            # Unparseable scores are left out, so the next request retries them
             if score is None:
-                logger.warning(f"Score for culture '{culture}' is None, skipping")
                 continue
-            scores_result.append({
-                "culture": culture,
-                "score": float(score),
-                "reasoning": reasoning_data.get(culture, "No reasoning provided")
-            })
+            table[culture] = {
+                'score': score,
+                'reasoning': scores['reasoning'].get(culture),
+                'distribution': distribution.get(culture)
+            }
+        return table
+    
+    def _format_scores(self, scores: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Format one image's qwen_vl_scores entry for the API response, leaving out unparseable scores"""
+        scores_result = []
+        reasoning_data = scores.get('reasoning', {})
+        distribution_data = scores.get('distribution', {})
+        for culture, score in scores['values'].items():
+            score = self._format_score(culture, score, reasoning_data.get(culture, "No reasoning provided"), distribution_data.get(culture))
+            if score is not None:
+                scores_result.append(score)
+        return scores_result
+
+    @staticmethod
+    def _format_score(culture: str, score, reasoning: str, distribution=None) -> Optional[Dict[str, Any]]:
+        """Format one culture's score for the API response, or None if it could not be parsed"""
+        # Handle None scores from models like pangea_vl
+        if score is None:
+            logger.warning(f"Score for culture '{culture}' is None, skipping")
+            return None
+        return {
+            "culture": culture,
+            "score": float(score),
+            "reasoning": reasoning,
+            "distribution": distribution
+        }
+
+    @staticmethod
+    def _context(lemmas: LemmaResult, wiki: WikiResult) -> Dict[str, Any]:
+        """The matched entity and ranked Wikipedia pages, available once wiki_retrieval has run"""
+        wiki_data = wiki.pages
+        lemma_data = lemmas.matches  # Contains scores for each bid
         
         # Format Wikipedia pages with matching scores from lemma_match
         wiki_pages = []
@@ -195,10 +320,20 @@ class CAIREPipeline:
         matched_entity = wiki_data[0][0]['title'] if wiki_data[0] and wiki_data[0][0] else "Unknown"
         
         return {
-            "scores": scores_result,
             "wikipedia_pages": wiki_pages,
             "matched_entity": matched_entity
         }
 
+    def _score_callback(self, on_event: Optional[Callable[[str, Dict[str, Any]], None]]):
+        """Adapt an on_event callback to qwen_vl_scores' on_score, emitting a 'score' event per culture"""
+        if on_event is None:
+            return None
+
+        def on_score(idx, row):
+            score = self._format_score(row[0], row[1], row[2], row[3] if len(row) > 3 else None)
+            if score is not None:
+                on_event("score", score)
+        return on_score
+
 # Global pipeline instance
 pipeline = CAIREPipeline() 
\ No newline at end of file
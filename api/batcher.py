@@ -0,0 +1,72 @@
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, List, Optional, Tuple
+
+from src.config import API_WORKERS, API_RETRIEVAL_MAX_BATCH, API_RETRIEVAL_MAX_WAIT_S
+
+logger = logging.getLogger(__name__)
+
+class RetrievalBatcher:
+    """
+    Groups retrieval for concurrent API requests into shared SigLIP + FAISS batches.
+
+    Pipeline worker threads call retrieve(), which blocks until its image's result is
+    ready. A single batching thread takes the first waiting image, collects others
+    arriving within max_wait_s (up to max_batch), then encodes and searches them in
+    one call. Requests that arrive while a batch is running are picked up by the
+    next batch, so a lone request only waits max_wait_s. If a batch fails, its images
+    are retried one at a time, so one bad image only fails its own request.
+
+    Callers block in retrieve(), so a batch never holds more images than there are
+    pipeline workers; max_batch defaults to API_WORKERS.
+    """
+
+    def __init__(self, context, max_batch: Optional[int] = API_RETRIEVAL_MAX_BATCH, max_wait_s: float = API_RETRIEVAL_MAX_WAIT_S):
+        self.context = context
+        self.max_batch = API_WORKERS if max_batch is None else max_batch
+        self.max_wait_s = max_wait_s
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="caire-retrieval-batcher", daemon=True)
+        self._thread.start()
+
+    def retrieve(self, image) -> Tuple[Any, List]:
+        """Return (embedding, nearest neighbours) for one PIL image, as RetrievalContext.encode / search do"""
+        future = Future()
+        self._queue.put((image, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_s
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if len(batch) > 1:
+                logger.info(f"Retrieving {len(batch)} images in one batch")
+            self._retrieve(batch)
+
+    def _retrieve(self, batch):
+        try:
+            zimg = self.context.encode([image for image, _ in batch])
+            neighbors = self.context.search(zimg)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            logger.warning(f"Retrieval batch of {len(batch)} images failed ({e}), retrying them one at a time")
+            for item in batch:
+                self._retrieve([item])
+            return
+        for (_, future), z, n in zip(batch, zimg, neighbors):
+            future.set_result((z, n))
@@ -0,0 +1,177 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from src.config import API_WORKERS, API_MAX_QUEUE, API_MAX_QUEUE_WAIT_S, API_MAX_SCORING_WAIT_S
+
+logger = logging.getLogger(__name__)
+
+# Number of recent queue waits the reported statistics are computed over
+WAIT_HISTORY = 100
+
+def wait_summary(waits) -> Tuple[float, float]:
+    """Mean and 95th percentile of recorded wait times"""
+    waits = sorted(waits)
+    if not waits:
+        return 0.0, 0.0
+    return sum(waits) / len(waits), waits[min(len(waits) - 1, int(len(waits) * 0.95))]
+
+class QueueFullError(Exception):
+    """The request queue is full; the caller should retry later (HTTP 429)"""
+
+class QueueTimeoutError(Exception):
+    """The request waited longer than allowed for a worker or for the scoring lock (HTTP 503)"""
+
+class PipelineExecutor:
+    """
+    Runs blocking pipeline calls on dedicated worker threads, off the event loop.
+
+    At most `workers` calls run at once and at most `max_queue` more wait for a worker.
+    Further submissions fail immediately with QueueFullError. A queued call that has
+    waited longer than max_wait_s is dropped with QueueTimeoutError instead of being run.
+    """
+
+    def __init__(self, workers: int = API_WORKERS, max_queue: int = API_MAX_QUEUE, max_wait_s: Optional[float] = API_MAX_QUEUE_WAIT_S):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_wait_s = max_wait_s
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="caire-pipeline")
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._waits = deque(maxlen=WAIT_HISTORY)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> "asyncio.Future":
+        """
+        Queue fn(*args, **kwargs) on a worker thread and return an awaitable for its result.
+
+        Admission is decided immediately: QueueFullError is raised here, before anything is awaited.
+        """
+        with self._lock:
+            if self._running + self._queued >= self.workers + self.max_queue:
+                self._rejected += 1
+                raise QueueFullError(f"{self._queued} requests already queued")
+            self._queued += 1
+        enqueued_at = time.monotonic()
+
+        def run():
+            waited = time.monotonic() - enqueued_at
+            with self._lock:
+                self._queued -= 1
+                self._waits.append(waited)
+                if self.max_wait_s is not None and waited > self.max_wait_s:
+                    self._timed_out += 1
+                    raise QueueTimeoutError(f"Request waited {waited:.1f}s in the queue")
+                self._running += 1
+            logger.info(f"Pipeline request started after {waited:.2f}s in the queue")
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+
+        return asyncio.get_running_loop().run_in_executor(self._executor, run)
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth, worker usage and recent queue wait times"""
+        with self._lock:
+            mean_wait, p95_wait = wait_summary(self._waits)
+            return {
+                "workers": self.workers,
+                "running": self._running,
+                "queued": self._queued,
+                "max_queue": self.max_queue,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "timed_out": self._timed_out,
+                "mean_wait_s": mean_wait,
+                "p95_wait_s": p95_wait,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+class ScoringLock:
+    """
+    The GPU scoring lock shared by interactive requests and batch jobs.
+
+    Interactive requests take it with `with lock:` and have priority: a batch job takes it
+    with `with lock.background():`, which only succeeds while no interactive request is
+    waiting. Jobs score in short chunks, so a waiting request runs after the current chunk.
+
+    An interactive request that has waited max_wait_s gives up with QueueTimeoutError, and
+    its wait is recorded for the queue statistics like time spent queued for a worker.
+    """
+
+    def __init__(self, max_wait_s: Optional[float] = API_MAX_SCORING_WAIT_S):
+        self.max_wait_s = max_wait_s
+        self._cond = threading.Condition()
+        self._held = False
+        self._waiting = 0  # Interactive requests waiting for the lock
+        self._timed_out = 0
+        self._waits = deque(maxlen=WAIT_HISTORY)
+
+    def acquire(self, background: bool = False):
+        with self._cond:
+            if background:
+                self._cond.wait_for(lambda: not self._held and not self._waiting)
+                self._held = True
+                return
+            start = time.monotonic()
+            self._waiting += 1
+            try:
+                acquired = self._cond.wait_for(lambda: not self._held, self.max_wait_s)
+            finally:
+                self._waiting -= 1
+            waited = time.monotonic() - start
+            self._waits.append(waited)
+            if not acquired:
+                self._timed_out += 1
+                # A background job may go ahead now that this request stopped waiting
+                self._cond.notify_all()
+                raise QueueTimeoutError(f"Request waited {waited:.1f}s for the scoring lock")
+            self._held = True
+
+    def release(self):
+        with self._cond:
+            self._held = False
+            self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        """Requests waiting for the scoring lock and recent waits for it"""
+        with self._cond:
+            mean_wait, p95_wait = wait_summary(self._waits)
+            return {
+                "scoring_waiting": self._waiting,
+                "scoring_timed_out": self._timed_out,
+                "mean_scoring_wait_s": mean_wait,
+                "p95_scoring_wait_s": p95_wait,
+            }
+
+    @contextmanager
+    def background(self):
+        """Hold the lock for one chunk of batch work, after any waiting interactive request"""
+        self.acquire(background=True)
+        try:
+            yield self
+        finally:
+            self.release()
+
+# Global executor instance
+executor = PipelineExecutor()
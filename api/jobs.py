@@ -0,0 +1,255 @@
+import copy
+import time
+import uuid
+import zipfile
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from src.scripts.retrieval import process_images
+from src.scripts.disambiguation import lemma_match
+from src.scripts.fetch_wikipedia import wiki_retrieval
+from src.scripts.culture_scores import qwen_vl_scores, WIKI_FIELDS, WIKI_CHAR_BUDGET
+from src.scripts.stages import WikiResult, save_scores
+from src.utils import save_readable, generate_heatmap
+from src.config import MAX_WIKI_DOCS, OUTPUT_PATH, JOB_MAX_QUEUED, JOB_MAX_IMAGES, JOB_MAX_UNCOMPRESSED_MB, JOB_HISTORY, JOB_SCORING_PROMPTS, KEEP_DECODED_IMAGES
+from api.sessions import mark_run_dir
+from api.executor import ScoringLock
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+# Files of a finished run packed into the downloadable results archive
+RESULT_FILES = ("combined_outputs.csv", "diversity_metrics.json", "caire_heatmap.png")
+STAGES = ("queued", "retrieval", "lemma_matching", "wikipedia", "scoring", "writing_results", "completed")
+
+class JobQueueFullError(Exception):
+    """Too many batch jobs are waiting to run (HTTP 429)"""
+
+class Job:
+    """State of one batch evaluation, updated by the job worker and read by status polling"""
+
+    def __init__(self, job_id: str, run_dir: Path, image_paths: List[Path], cultures: List[str], model_name: str, scoring_mode: str, use_multiple_wiki_pages: bool):
+        self.job_id = job_id
+        self.run_dir = run_dir
+        self.image_paths = image_paths
+        self.cultures = cultures
+        self.model_name = model_name
+        self.scoring_mode = scoring_mode
+        self.use_multiple_wiki_pages = use_multiple_wiki_pages
+        self.status = "queued"  # queued, running, completed or failed
+        self.stage = "queued"
+        self.scored = 0
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def results_path(self) -> Path:
+        return self.run_dir / "results.zip"
+
+    def to_dict(self) -> Dict[str, Any]:
+        total = len(self.image_paths) * len(self.cultures)
+        # Stages count equally; the scoring stage advances with each scored (image, culture) pair
+        stage_progress = self.scored / total if self.stage == "scoring" and total else 0.0
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "stage": self.stage,
+            "num_images": len(self.image_paths),
+            "num_cultures": len(self.cultures),
+            "scored": self.scored,
+            "progress": (STAGES.index(self.stage) + stage_progress) / (len(STAGES) - 1),
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+
+class JobManager:
+    """
+    Runs multi-image evaluations in the background through the CLI's batched folder path.
+
+    Jobs run one at a time on their own worker thread, separate from interactive requests.
+    VLM scoring shares the pipeline's scoring lock, taken for JOB_SCORING_PROMPTS (image, culture)
+    prompts at a time and only while no interactive request waits for it, so interactive requests
+    run between chunks instead of after the whole job. Each job gets a run directory under
+    OUTPUT_PATH like a CLI run, and a results.zip with the readable outputs once it completes.
+    """
+
+    def __init__(self, max_queued: int = JOB_MAX_QUEUED, history: int = JOB_HISTORY):
+        self.max_queued = max_queued
+        self.history = history
+        self.retrieval = None  # Loaded on first use unless shared through initialize()
+        self.scoring_lock = ScoringLock()
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="caire-jobs")
+
+    def initialize(self, retrieval, scoring_lock: ScoringLock):
+        """Share the loaded retrieval context and the scoring lock with the interactive pipeline"""
+        self.retrieval = retrieval
+        self.scoring_lock = scoring_lock
+
+    def submit(self, images: List[Tuple[str, bytes]], cultures: List[str], model_name: str = 'qwen_vl', scoring_mode: str = 'generate', use_multiple_wiki_pages: bool = False) -> Job:
+        """Save the uploaded (filename, bytes) images to a new run directory and queue the job"""
+        if not images:
+            raise ValueError("No images provided")
+        if len(images) > JOB_MAX_IMAGES:
+            raise ValueError(f"At most {JOB_MAX_IMAGES} images per job")
+
+        with self._lock:
+            queued = sum(job.status == "queued" for job in self._jobs.values())
+            if queued >= self.max_queued:
+                raise JobQueueFullError(f"{queued} jobs already queued")
+
+            job_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{uuid.uuid4().hex[:8]}"
+            run_dir = Path(OUTPUT_PATH) / job_id
+            image_dir = run_dir / "images"
+            image_dir.mkdir(parents=True)
+            mark_run_dir(run_dir)
+            image_paths = []
+            for i, (name, data) in enumerate(images):
+                # Prefix with the index so duplicate names in different folders do not collide
+                path = image_dir / f"{i:05d}_{Path(name).name}"
+                path.write_bytes(data)
+                image_paths.append(path)
+
+            job = Job(job_id, run_dir, sorted(image_paths), cultures, model_name, scoring_mode, use_multiple_wiki_pages)
+            self._jobs[job_id] = job
+            self._forget_finished()
+
+        self._executor.submit(self._run, job)
+        logger.info(f"Queued job {job_id} with {len(images)} images and {len(cultures)} cultures")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def run_dirs(self) -> List[Path]:
+        """Run directories of the jobs still remembered, which the output sweeper must keep"""
+        with self._lock:
+            return [job.run_dir for job in self._jobs.values()]
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in ("completed", "failed")]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def _run(self, job: Job):
+        # Same argument object the CLI builds in main.py
+        class Args:
+            pass
+
+        args = Args()
+        args.timestamp = job.job_id
+        args.image_paths = job.image_paths
+        args.target_list = job.cultures
+        args.model_name = job.model_name
+        args.scoring_mode = job.scoring_mode
+        args.is_predefined_list = False
+        args.is_folder = True
+
+        job.status = "running"
+        try:
+            job.stage = "retrieval"
+            retrieval = process_images(args, self.retrieval)
+
+            job.stage = "lemma_matching"
+            lemmas = lemma_match(args, retrieval)
+
+            job.stage = "wikipedia"
+            wiki = wiki_retrieval(args, MAX_WIKI_DOCS, fields=WIKI_FIELDS, max_chars=WIKI_CHAR_BUDGET, lemmas=lemmas)
+
+            job.stage = "scoring"
+
+            def on_score(idx, row):
+                job.scored += 1
+
+            self._score(job, args, wiki, on_score)
+
+            job.stage = "writing_results"
+            save_readable(args, OUTPUT_PATH)
+            generate_heatmap(args, OUTPUT_PATH)
+            with zipfile.ZipFile(job.results_path, "w", zipfile.ZIP_DEFLATED) as archive:
+                for name in RESULT_FILES:
+                    if (job.run_dir / name).exists():
+                        archive.write(job.run_dir / name, name)
+
+            job.stage = "completed"
+            job.status = "completed"
+            logger.info(f"Job {job.job_id} completed")
+        except Exception as e:
+            logger.error(f"Job {job.job_id} failed in stage {job.stage}: {e}", exc_info=True)
+            job.status = "failed"
+            job.error = f"{job.stage}: {e}"
+        finally:
+            job.finished_at = time.time()
+
+    def _score(self, job: Job, args, wiki: WikiResult, on_score):
+        """
+        Score the job in chunks of about JOB_SCORING_PROMPTS (image, culture) prompts, taking the
+        scoring lock in the background for each chunk. Images are split by culture when one image
+        has more cultures than fit a chunk.
+        """
+        image_paths = sorted(args.image_paths)
+        cultures = list(args.target_list)
+        images_per_chunk = max(1, JOB_SCORING_PROMPTS // len(cultures))
+        cultures_per_chunk = min(len(cultures), JOB_SCORING_PROMPTS)
+        scores = []
+        for start in range(0, len(image_paths), images_per_chunk):
+            end = start + images_per_chunk
+            chunk_scores = None
+            for first in range(0, len(cultures), cultures_per_chunk):
+                chunk = copy.copy(args)  # Shares args.images, the decoded image handles
+                chunk.image_paths = image_paths[start:end]
+                chunk.target_list = cultures[first:first + cultures_per_chunk]
+                with self.scoring_lock.background():
+                    entries = qwen_vl_scores(
+                        chunk, job.use_multiple_wiki_pages, job.model_name, scoring_mode=job.scoring_mode, on_score=on_score,
+                        wiki=WikiResult(wiki.pages[start:end], wiki.skipped[start:end]), persist=False
+                    )
+                if chunk_scores is None:
+                    chunk_scores = entries
+                    continue
+                # Later culture slices of the same images extend their score tables
+                for entry, more in zip(chunk_scores, entries):
+                    for key, values in more.items():
+                        if isinstance(values, dict):
+                            entry[key].update(values)
+            scores += chunk_scores
+            if len(image_paths) > KEEP_DECODED_IMAGES:
+                for path in image_paths[start:end]:
+                    args.images[path].release()
+        save_scores(args, job.model_name, scores)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def read_archive(file: BinaryIO, max_images: int = JOB_MAX_IMAGES, max_bytes: int = JOB_MAX_UNCOMPRESSED_MB * 2 ** 20) -> List[Tuple[str, bytes]]:
+    """
+    Return the (filename, bytes) image entries of a zip archive, ignoring other files.
+
+    The entry count and total uncompressed size are checked against the limits from the
+    archive's directory before any entry is extracted; ValueError if either is exceeded.
+    """
+    with zipfile.ZipFile(file) as archive:
+        entries = []
+        for info in archive.infolist():
+            name = Path(info.filename).name
+            if info.is_dir() or name.startswith(".") or not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            entries.append((name, info))
+        if len(entries) > max_images:
+            raise ValueError(f"At most {max_images} images per job")
+        # Extraction stops at each entry's declared size, so this bounds memory use
+        if sum(info.file_size for _, info in entries) > max_bytes:
+            raise ValueError(f"Archive images exceed {max_bytes // 2 ** 20} MB uncompressed")
+        return [(name, archive.read(info)) for name, info in entries]
+
+# Global job manager instance
+jobs = JobManager()
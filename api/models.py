@@ -5,6 +5,7 @@ class CultureScore(BaseModel):
     culture: str
     score: Optional[float] = Field(None, ge=1, le=5)  # None represents N/A for parsing errors
     reasoning: str
+    distribution: Optional[List[float]] = None  # p(1)..p(5), only in logits scoring mode
 
 class WikipediaPage(BaseModel):
     title: str
@@ -24,4 +25,31 @@ class HealthResponse(BaseModel):
     message: str
 
 class PredefinedListsResponse(BaseModel):
-    lists: List[str] 
\ No newline at end of file
+    lists: List[str]
+
+class QueueStatsResponse(BaseModel):
+    workers: int
+    running: int
+    queued: int
+    max_queue: int
+    completed: int
+    rejected: int  # Turned away with 429 because the queue was full
+    timed_out: int  # Dropped with 503 after waiting too long in the queue
+    mean_wait_s: float  # Over the most recent requests
+    p95_wait_s: float
+    scoring_waiting: int  # Running requests waiting for the GPU scoring lock
+    scoring_timed_out: int  # Dropped with 503 after waiting too long for the scoring lock
+    mean_scoring_wait_s: float
+    p95_scoring_wait_s: float
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    status: str  # queued, running, completed or failed
+    stage: str  # queued, retrieval, lemma_matching, wikipedia, scoring, writing_results or completed
+    num_images: int
+    num_cultures: int
+    scored: int  # (image, culture) pairs scored so far
+    progress: float = Field(..., ge=0, le=1)
+    error: Optional[str] = None
+    created_at: float
+    finished_at: Optional[float] = None
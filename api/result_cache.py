@@ -0,0 +1,106 @@
+import os
+import json
+import pickle
+import shutil
+import hashlib
+import logging
+import threading
+import uuid
+from dataclasses import fields
+from pathlib import Path
+from typing import Optional, Dict, Any, Tuple
+
+from src.config import OUTPUT_PATH, RESULT_CACHE, RESULT_CACHE_MAX_ENTRIES
+from src.scripts.stages import RetrievalResult, LemmaResult, WikiResult
+
+logger = logging.getLogger(__name__)
+
+# File of an entry holding the stage results that only depend on the image, not on cultures, model or wiki mode
+STAGES_FILE = "stages.pkl"
+
+class ResultCache:
+    """
+    Persistent cache of the retrieval, lemma matching and Wikipedia outputs, keyed by image digest.
+
+    Each entry is a directory holding the pickled (RetrievalResult, LemmaResult, WikiResult)
+    of one image, so it survives server restarts. Entries are written to a temporary
+    directory and renamed into place. Their mtime records
+    the last use, and the least recently used entries are evicted beyond max_entries.
+    """
+
+    def __init__(self, root: Path, max_entries: Optional[int] = RESULT_CACHE_MAX_ENTRIES):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(digest: str, params: Dict[str, Any]) -> str:
+        """Cache key of an image digest and the settings its stage outputs depend on"""
+        payload = json.dumps({"digest": digest, **params}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[RetrievalResult, LemmaResult, WikiResult]]:
+        """Return a cached entry's stage results, or None on a miss"""
+        entry = self.root / key
+        with self._lock:
+            if not entry.is_dir():
+                return None
+            try:
+                with open(entry / STAGES_FILE, "rb") as f:
+                    stages = pickle.load(f)
+                self._check(stages)
+            except Exception as e:
+                # Incomplete entries, the older one-file-per-stage layout, and pickles of
+                # classes that have since changed or moved are all treated as a miss
+                logger.warning(f"Unreadable result cache entry {key} ({type(e).__name__}: {e}), discarding it")
+                shutil.rmtree(entry, ignore_errors=True)
+                return None
+            os.utime(entry)
+        return stages
+
+    @staticmethod
+    def _check(stages):
+        """Raise TypeError unless stages holds the current stage result classes with all their fields"""
+        expected = (RetrievalResult, LemmaResult, WikiResult)
+        if not isinstance(stages, tuple) or len(stages) != len(expected):
+            raise TypeError(f"expected {len(expected)} stage results")
+        for result, cls in zip(stages, expected):
+            if not isinstance(result, cls) or any(not hasattr(result, field.name) for field in fields(cls)):
+                raise TypeError(f"stale {cls.__name__}")
+
+    def put(self, key: str, retrieval: RetrievalResult, lemmas: LemmaResult, wiki: WikiResult):
+        """Store one image's stage results under key, evicting the least recently used entries if needed"""
+        entry = self.root / key
+        tmp = self.root / f".{key}.{uuid.uuid4().hex}"
+        tmp.mkdir()
+        try:
+            with open(tmp / STAGES_FILE, "wb") as f:
+                pickle.dump((retrieval, lemmas, wiki), f)
+            with self._lock:
+                if entry.exists():
+                    shutil.rmtree(entry)
+                os.replace(tmp, entry)
+                self._evict()
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def __len__(self) -> int:
+        return sum(1 for p in self.root.iterdir() if p.is_dir() and not p.name.startswith("."))
+
+    def _evict(self):
+        if self.max_entries is None:
+            return
+        entries = [p for p in self.root.iterdir() if p.is_dir() and not p.name.startswith(".")]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda p: p.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_entries]:
+            shutil.rmtree(entry, ignore_errors=True)
+        logger.info(f"Evicted {len(entries) - self.max_entries} result cache entries")
+
+def get_result_cache() -> Optional[ResultCache]:
+    """Open the result cache under OUTPUT_PATH, or return None if it is disabled"""
+    if RESULT_CACHE is None:
+        return None
+    return ResultCache(Path(OUTPUT_PATH) / RESULT_CACHE)
@@ -1,10 +1,12 @@
 import logging
 import os
-from typing import Optional
+import json
+import asyncio
+import zipfile
+from typing import Optional, List
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from PIL import Image
-import io
+from fastapi.responses import StreamingResponse, FileResponse
 from pathlib import Path
 import pickle
 
@@ -26,11 +28,18 @@ from api.models import (
     AnalysisResponse,
     HealthResponse,
     PredefinedListsResponse,
+    QueueStatsResponse,
+    JobStatusResponse,
     CultureScore,
     WikipediaPage
 )
 from api.api_pipeline import pipeline
-from src.config import DATA_PATH, PREDEFINED_TARGET_LISTS
+from api.executor import executor, QueueFullError, QueueTimeoutError
+from api.jobs import jobs, read_archive, JobQueueFullError
+from api.sessions import OutputSweeper
+from src.image_handle import ImageHandle
+from src.config import DATA_PATH, PREDEFINED_TARGET_LISTS, API_MAX_REQUEST_MB, JOB_MAX_IMAGES
+from src.scripts.culture_scores import SCORING_MODES
 
 # Configure logging
 logging.basicConfig(
@@ -57,12 +66,69 @@ app.add_middleware(
     max_age=3600,
 )
 
+class RequestTooLarge(Exception):
+    """Raised while receiving a body that exceeds RequestSizeLimit's limit"""
+
+class RequestSizeLimit:
+    """
+    ASGI middleware answering 413 to requests whose body exceeds max_bytes.
+
+    Declared Content-Length is checked before anything is read; chunked bodies are
+    counted while they are received and cut off once they pass the limit.
+    """
+
+    def __init__(self, app, max_bytes: Optional[int]):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.max_bytes is None:
+            return await self.app(scope, receive, send)
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            return await self._reject(send)
+
+        received = 0
+        started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise RequestTooLarge()
+            return message
+
+        async def tracked_send(message):
+            nonlocal started
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracked_send)
+        except RequestTooLarge:
+            if not started:
+                await self._reject(send)
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": f"Request body exceeds {self.max_bytes // 2 ** 20} MB"}).encode()
+        await send({"type": "http.response.start", "status": 413, "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+app.add_middleware(RequestSizeLimit, max_bytes=None if API_MAX_REQUEST_MB is None else API_MAX_REQUEST_MB * 2 ** 20)
+
+# Removes expired sessions and orphaned run directories, and keeps API outputs under the disk quota
+sweeper = OutputSweeper(pipeline.cache, protected=lambda: [*jobs.run_dirs(), *pipeline.run_dirs()])
+
 # Initialize pipeline on startup
 @app.on_event("startup")
 async def startup_event():
     logger.info("Starting CAIRE API server...")
     try:
         pipeline.initialize()
+        jobs.initialize(pipeline.retrieval, pipeline.scoring_lock)
+        sweeper.start()
         logger.info("Pipeline initialized successfully")
     except Exception as e:
         logger.error(f"Failed to initialize pipeline: {e}", exc_info=True)
@@ -76,6 +142,85 @@ async def health_check():
         message="CAIRE API is running"
     )
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    executor.shutdown()
+    jobs.shutdown()
+    sweeper.stop()
+
+@app.get("/api/queue", response_model=QueueStatsResponse)
+async def queue_stats():
+    """Pipeline queue depth, worker usage, and recent waits for a worker and for the scoring lock"""
+    return QueueStatsResponse(**executor.stats(), **pipeline.scoring_lock.stats())
+
+def run_pipeline(image_bytes: bytes, *args, **kwargs):
+    """Run the pipeline on the uploaded image; called on an executor worker thread, where it is decoded once"""
+    return pipeline.process_image(ImageHandle.from_bytes(image_bytes), *args, **kwargs)
+
+def queue_pipeline(image_bytes: bytes, *args, **kwargs):
+    """Queue a pipeline run and return an awaitable for its result; a full queue is answered with 429"""
+    try:
+        return executor.submit(run_pipeline, image_bytes, *args, **kwargs)
+    except QueueFullError as e:
+        logger.warning(f"Rejecting request: {e}")
+        raise HTTPException(status_code=429, detail="Server busy, please retry later", headers={"Retry-After": "5"})
+
+async def submit_pipeline(image_bytes: bytes, *args, **kwargs):
+    """Queue a pipeline run without blocking the event loop, mapping a full or stale queue to 429 / 503"""
+    future = queue_pipeline(image_bytes, *args, **kwargs)
+    try:
+        return await future
+    except QueueTimeoutError as e:
+        logger.warning(f"Dropping request: {e}")
+        raise HTTPException(status_code=503, detail="Request timed out in the queue, please retry later", headers={"Retry-After": "30"})
+
+def build_response(result, image_name: Optional[str]) -> AnalysisResponse:
+    return AnalysisResponse(
+        scores=[CultureScore(**score) for score in result["scores"]],
+        wikipedia_pages=[WikipediaPage(**page) for page in result["wikipedia_pages"]],
+        matched_entity=result["matched_entity"],
+        image_path=image_name or "uploaded_image",
+        session_id=result.get("session_id")  # Include session_id for caching
+    )
+
+def stream_pipeline(image_bytes: bytes, image_name: Optional[str], *args, **kwargs) -> StreamingResponse:
+    """
+    Run the pipeline and stream its progress as NDJSON, one event per line:
+
+        {"event": "context", "data": {"matched_entity", "wikipedia_pages", "session_id"}}
+        {"event": "score", "data": <CultureScore>}      (one per culture, as it is scored)
+        {"event": "result", "data": <AnalysisResponse>}  (last line on success)
+        {"event": "error", "data": {"status", "detail"}}  (last line on failure)
+
+    A full queue is still answered with a plain 429 before streaming starts.
+    """
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def on_event(event, payload):
+        # Called on the pipeline worker thread
+        loop.call_soon_threadsafe(events.put_nowait, {"event": event, "data": payload})
+
+    future = queue_pipeline(image_bytes, *args, on_event=on_event, **kwargs)
+    # Queued after every event the worker posted, so it marks the end of the stream
+    future.add_done_callback(lambda _: events.put_nowait(None))
+
+    async def body():
+        while (item := await events.get()) is not None:
+            yield json.dumps(item) + "\n"
+        try:
+            result = future.result()
+            item = {"event": "result", "data": build_response(result, image_name).model_dump()}
+            logger.info(f"Streamed analysis complete for {image_name}, session_id: {result.get('session_id')}")
+        except QueueTimeoutError:
+            item = {"event": "error", "data": {"status": 503, "detail": "Request timed out in the queue, please retry later"}}
+        except Exception as e:
+            logger.error(f"Error processing image: {e}", exc_info=True)
+            item = {"event": "error", "data": {"status": 500, "detail": f"Failed to process image: {str(e)}"}}
+        yield json.dumps(item) + "\n"
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
 @app.get("/api/predefined-lists", response_model=PredefinedListsResponse)
 async def get_predefined_lists():
     """Get list of available predefined culture lists"""
@@ -92,7 +237,9 @@ async def analyze_image(
     cultures: str = Form(...),
     use_multiple_wiki_pages: bool = Form(False),
     model_name: str = Form("qwen_vl"),
-    session_id: Optional[str] = Form(None)
+    session_id: Optional[str] = Form(None),
+    scoring_mode: str = Form("generate"),
+    stream: bool = Form(False)
 ):
     """
     Analyze cultural relevance of an image
@@ -104,11 +251,15 @@ async def analyze_image(
         model_name: VLM model to use for scoring (default: "qwen_vl")
                     Options: "qwen_vl", "pangea_vl", "llama_vl"
         session_id: Optional session ID to reuse cached intermediate results (for model switching)
+        scoring_mode: "generate" (default) for scores with reasoning, or "logits" for a single
+                      forward pass returning an expected score and 1-5 distribution
+        stream: Stream NDJSON events (Wikipedia context first, then each culture's score)
+                instead of returning one response at the end
     
     Returns:
         Analysis results with cultural scores and Wikipedia pages
     """
-    logger.info(f"Received analyze request - image: {image.filename}, content_type: {image.content_type}, cultures: {cultures}, use_multiple_wiki_pages: {use_multiple_wiki_pages}, model: {model_name}, session_id: {session_id}")
+    logger.info(f"Received analyze request - image: {image.filename}, content_type: {image.content_type}, cultures: {cultures}, use_multiple_wiki_pages: {use_multiple_wiki_pages}, model: {model_name}, scoring_mode: {scoring_mode}, session_id: {session_id}")
     
     try:
         # Validate image file
@@ -130,21 +281,22 @@ async def analyze_image(
             logger.error(f"Invalid model: {model_name}")
             raise HTTPException(status_code=400, detail=f"Model must be one of: {', '.join(valid_models)}")
         
-        # Read and process image
+        # Validate scoring_mode
+        if scoring_mode not in SCORING_MODES:
+            logger.error(f"Invalid scoring mode: {scoring_mode}")
+            raise HTTPException(status_code=400, detail=f"Scoring mode must be one of: {', '.join(SCORING_MODES)}")
+        
+        # Read image; decoding and the pipeline run on an executor worker
         image_bytes = await image.read()
-        pil_image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        
+        if stream:
+            return stream_pipeline(image_bytes, image.filename, culture_list, use_multiple_wiki_pages, model_name, session_id, scoring_mode)
         
         # Run CAIRE pipeline with optional session_id for caching
-        result = pipeline.process_image(pil_image, culture_list, use_multiple_wiki_pages, model_name, session_id)
+        result = await submit_pipeline(image_bytes, culture_list, use_multiple_wiki_pages, model_name, session_id, scoring_mode)
         
         # Format response
-        response = AnalysisResponse(
-            scores=[CultureScore(**score) for score in result["scores"]],
-            wikipedia_pages=[WikipediaPage(**page) for page in result["wikipedia_pages"]],
-            matched_entity=result["matched_entity"],
-            image_path=image.filename or "uploaded_image",
-            session_id=result.get("session_id")  # Include session_id for caching
-        )
+        response = build_response(result, image.filename)
         
         logger.info(f"Analysis complete for {image.filename}, session_id: {result.get('session_id')}")
         return response
@@ -160,7 +312,9 @@ async def analyze_with_predefined(
     image: UploadFile = File(...),
     list_name: str = Form(...),
     model_name: str = Form("qwen_vl"),
-    session_id: Optional[str] = Form(None)
+    session_id: Optional[str] = Form(None),
+    scoring_mode: str = Form("generate"),
+    stream: bool = Form(False)
 ):
     """
     Analyze cultural relevance using a predefined culture list
@@ -170,6 +324,8 @@ async def analyze_with_predefined(
         list_name: Name of predefined list (e.g., "top10_countries.pkl")
         model_name: VLM model to use for scoring (default: "qwen_vl")
                     Options: "qwen_vl", "pangea_vl", "llama_vl"
+        scoring_mode: "generate" (default) or "logits"
+        stream: Stream NDJSON events instead of returning one response at the end
     
     Returns:
         Analysis results with cultural scores and Wikipedia pages
@@ -188,23 +344,22 @@ async def analyze_with_predefined(
         if model_name not in valid_models:
             raise HTTPException(status_code=400, detail=f"Model must be one of: {', '.join(valid_models)}")
         
-        # Read and process image
+        if scoring_mode not in SCORING_MODES:
+            raise HTTPException(status_code=400, detail=f"Scoring mode must be one of: {', '.join(SCORING_MODES)}")
+        
+        # Read image; decoding and the pipeline run on an executor worker
         image_bytes = await image.read()
-        pil_image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
         
-        logger.info(f"Processing image with predefined list: {list_name}, model: {model_name}, session_id: {session_id}")
+        logger.info(f"Processing image with predefined list: {list_name}, model: {model_name}, scoring_mode: {scoring_mode}, session_id: {session_id}")
+        
+        if stream:
+            return stream_pipeline(image_bytes, image.filename, culture_list, use_multiple_wiki_pages=False, model_name=model_name, session_id=session_id, scoring_mode=scoring_mode)
         
         # Run CAIRE pipeline with optional session_id for caching
-        result = pipeline.process_image(pil_image, culture_list, use_multiple_wiki_pages=False, model_name=model_name, session_id=session_id)
+        result = await submit_pipeline(image_bytes, culture_list, use_multiple_wiki_pages=False, model_name=model_name, session_id=session_id, scoring_mode=scoring_mode)
         
         # Format response  
-        response = AnalysisResponse(
-            scores=[CultureScore(**score) for score in result["scores"]],
-            wikipedia_pages=[WikipediaPage(**page) for page in result["wikipedia_pages"]],
-            matched_entity=result["matched_entity"],
-            image_path=image.filename or "uploaded_image",
-            session_id=result.get("session_id")  # Include session_id for caching
-        )
+        response = build_response(result, image.filename)
         
         logger.info(f"Analysis complete for {image.filename}, session_id: {result.get('session_id')}")
         return response
@@ -215,6 +370,97 @@ async def analyze_with_predefined(
         logger.error(f"Error processing image: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Failed to process image: {str(e)}")
 
+@app.post("/api/jobs", response_model=JobStatusResponse, status_code=202)
+async def create_job(
+    images: Optional[List[UploadFile]] = File(None),
+    archive: Optional[UploadFile] = File(None),
+    cultures: Optional[str] = Form(None),
+    list_name: Optional[str] = Form(None),
+    use_multiple_wiki_pages: bool = Form(False),
+    model_name: str = Form("qwen_vl"),
+    scoring_mode: str = Form("generate")
+):
+    """
+    Start a background evaluation of many images
+    
+    Args:
+        images: Image files to analyze
+        archive: Zip archive of images, as an alternative (or in addition) to images
+        cultures: Comma-separated list of cultures; or
+        list_name: Name of a predefined list (e.g., "top10_countries.pkl")
+        use_multiple_wiki_pages: Whether to use multiple Wikipedia pages in context (default: False)
+        model_name: VLM model to use for scoring (default: "qwen_vl")
+        scoring_mode: "generate" (default) or "logits"
+    
+    Returns:
+        The new job's status; poll GET /api/jobs/{job_id} and download GET /api/jobs/{job_id}/results
+    """
+    if list_name:
+        list_path = DATA_PATH / list_name
+        if list_path not in PREDEFINED_TARGET_LISTS:
+            raise HTTPException(status_code=400, detail="Invalid predefined list name")
+        with open(list_path, "rb") as f:
+            culture_list = pickle.load(f)
+    else:
+        culture_list = [c.strip() for c in (cultures or "").split(",") if c.strip()]
+    if not culture_list:
+        raise HTTPException(status_code=400, detail="Provide cultures or a predefined list_name")
+    
+    valid_models = ["qwen_vl", "pangea_vl", "llama_vl"]
+    if model_name not in valid_models:
+        raise HTTPException(status_code=400, detail=f"Model must be one of: {', '.join(valid_models)}")
+    if scoring_mode not in SCORING_MODES:
+        raise HTTPException(status_code=400, detail=f"Scoring mode must be one of: {', '.join(SCORING_MODES)}")
+    
+    if len(images or []) > JOB_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"At most {JOB_MAX_IMAGES} images per job")
+    uploads = []
+    for image in images or []:
+        if not (image.content_type or "").startswith("image/"):
+            raise HTTPException(status_code=400, detail=f"{image.filename} is not an image")
+        uploads.append((image.filename or "image.jpg", await image.read()))
+    if archive is not None:
+        try:
+            # Read from the spooled upload; entries are only extracted once the limits are checked
+            uploads.extend(await asyncio.get_running_loop().run_in_executor(
+                None, lambda: read_archive(archive.file, max_images=JOB_MAX_IMAGES - len(uploads))
+            ))
+        except zipfile.BadZipFile:
+            raise HTTPException(status_code=400, detail="Archive must be a zip file")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        job = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: jobs.submit(uploads, culture_list, model_name, scoring_mode, use_multiple_wiki_pages)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except JobQueueFullError as e:
+        logger.warning(f"Rejecting job: {e}")
+        raise HTTPException(status_code=429, detail="Too many jobs queued, please retry later", headers={"Retry-After": "60"})
+    return JobStatusResponse(**job.to_dict())
+
+@app.get("/api/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_job(job_id: str):
+    """Poll a batch job's status and progress"""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    return JobStatusResponse(**job.to_dict())
+
+@app.get("/api/jobs/{job_id}/results")
+async def get_job_results(job_id: str):
+    """Download a completed job's results.zip (combined_outputs.csv, diversity_metrics.json, caire_heatmap.png)"""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    if job.status != "completed":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    if not job.results_path.exists():
+        raise HTTPException(status_code=410, detail="Job results were removed")
+    return FileResponse(job.results_path, media_type="application/zip", filename=f"caire_{job_id}.zip")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
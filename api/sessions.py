@@ -0,0 +1,185 @@
+import os
+import time
+import shutil
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from src.config import (
+    OUTPUT_PATH, API_MAX_SESSIONS, API_SESSION_TTL_S, OUTPUT_QUOTA_GB, OUTPUT_SWEEP_INTERVAL_S
+)
+
+logger = logging.getLogger(__name__)
+
+# Written into every run directory the API creates, so the sweeper never touches CLI outputs
+RUN_MARKER = ".caire_api"
+
+def mark_run_dir(run_dir: Path):
+    """Mark a run directory as created by the API server and safe to sweep"""
+    (Path(run_dir) / RUN_MARKER).touch()
+
+def dir_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class SessionStore:
+    """
+    Session data by session_id, bounded in count and age.
+
+    Least recently used sessions beyond max_sessions, and sessions unused for ttl_s,
+    are evicted. Evicting a session removes its run directory ('output_dir') if it has one.
+    """
+
+    def __init__(self, max_sessions: Optional[int] = API_MAX_SESSIONS, ttl_s: Optional[float] = API_SESSION_TTL_S):
+        self.max_sessions = max_sessions
+        self.ttl_s = ttl_s
+        self._sessions = OrderedDict()  # session_id -> (last used, data)
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Return a live session's data and mark it as recently used, or None"""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            if self._expired(entry[0]):
+                self._evict(session_id)
+                return None
+            self._sessions[session_id] = (time.time(), entry[1])
+            self._sessions.move_to_end(session_id)
+            return entry[1]
+
+    def put(self, session_id: str, data: Dict[str, Any]):
+        with self._lock:
+            self._sessions[session_id] = (time.time(), data)
+            self._sessions.move_to_end(session_id)
+            while self.max_sessions is not None and len(self._sessions) > self.max_sessions:
+                self._evict(next(iter(self._sessions)))
+
+    def evict(self, session_id: str):
+        with self._lock:
+            if session_id in self._sessions:
+                self._evict(session_id)
+
+    def evict_oldest(self) -> bool:
+        """Evict the least recently used session; return False if there is none"""
+        with self._lock:
+            if not self._sessions:
+                return False
+            self._evict(next(iter(self._sessions)))
+            return True
+
+    def expire(self):
+        """Evict every session unused for longer than the TTL"""
+        with self._lock:
+            for session_id in [s for s, (used, _) in self._sessions.items() if self._expired(used)]:
+                self._evict(session_id)
+
+    def run_dirs(self) -> set:
+        """Run directories still owned by a live session"""
+        with self._lock:
+            return {Path(data['output_dir']).resolve() for _, data in self._sessions.values() if data.get('output_dir')}
+
+    def keys(self):
+        with self._lock:
+            return list(self._sessions)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _expired(self, last_used: float) -> bool:
+        return self.ttl_s is not None and time.time() - last_used > self.ttl_s
+
+    def _evict(self, session_id: str):
+        _, data = self._sessions.pop(session_id)
+        if data.get('output_dir'):
+            shutil.rmtree(data['output_dir'], ignore_errors=True)
+        logger.info(f"Evicted session {session_id}")
+
+class OutputSweeper:
+    """
+    Background thread that bounds the API's disk usage under OUTPUT_PATH.
+
+    Every interval it expires stale sessions and removes orphaned API run directories:
+    ones marked with RUN_MARKER but no longer owned by a session or a remembered job,
+    for example after a restart. While the API run directories still exceed the quota,
+    it removes orphans oldest first, then evicts the least recently used sessions. The
+    quota pass also leaves orphans younger than one sweep interval alone, since they
+    may belong to a request still running in another server process.
+    CLI run directories carry no marker and are never touched.
+    """
+
+    def __init__(self, sessions: SessionStore, protected: Callable[[], Iterable[Path]] = lambda: (),
+                 quota_bytes: Optional[int] = OUTPUT_QUOTA_GB * 2 ** 30 if OUTPUT_QUOTA_GB is not None else None,
+                 interval_s: float = OUTPUT_SWEEP_INTERVAL_S, orphan_age_s: Optional[float] = API_SESSION_TTL_S):
+        self.sessions = sessions
+        self.protected = protected
+        self.quota_bytes = quota_bytes
+        self.interval_s = interval_s
+        self.orphan_age_s = orphan_age_s
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="caire-output-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval_s):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Output sweep failed: {e}", exc_info=True)
+
+    def _run_dirs(self):
+        """API run directories under OUTPUT_PATH, oldest first, as (path, mtime, size)"""
+        root = Path(OUTPUT_PATH)
+        if not root.exists():
+            return []
+        dirs = []
+        for path in root.iterdir():
+            marker = path / RUN_MARKER
+            if path.is_dir() and marker.exists():
+                dirs.append((path.resolve(), marker.stat().st_mtime, dir_size(path)))
+        return sorted(dirs, key=lambda d: d[1])
+
+    def sweep(self):
+        self.sessions.expire()
+
+        live = self.sessions.run_dirs() | {Path(p).resolve() for p in self.protected()}
+        now = time.time()
+        dirs = []
+        for path, mtime, size in self._run_dirs():
+            if path not in live and self.orphan_age_s is not None and now - mtime > self.orphan_age_s:
+                shutil.rmtree(path, ignore_errors=True)
+                logger.info(f"Removed orphaned run directory {path}")
+            else:
+                dirs.append((path, mtime, size))
+
+        if self.quota_bytes is None:
+            return
+        total = sum(size for _, _, size in dirs)
+        if total <= self.quota_bytes:
+            return
+
+        # Orphans first, then sessions in least recently used order
+        for path, mtime, size in dirs:
+            if total <= self.quota_bytes:
+                break
+            if path not in live and now - mtime > self.interval_s:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+        while total > self.quota_bytes and self.sessions.evict_oldest():
+            total = sum(size for path, _, size in dirs if path.exists())
+        logger.info(f"API run directories use {total / 2 ** 30:.2f} GB after sweeping")
@@ -42,6 +42,26 @@ class DownloadAssetsCommand(Command):
             subprocess.run(cmd, shell=True, check=True)
         print("Data download complete.")
 
+class BuildStoresCommand(Command):
+    description = "Convert downloaded data files into memory-mapped / indexed stores."
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        from src.stores.lemma_store import build_lemma_store
+        from src.stores.index_store import build_index_info_store
+        from src.stores.babelnet_store import build_babelnet_store
+
+        build_lemma_store()
+        build_index_info_store()
+        build_babelnet_store()
+        print("Store conversion complete.")
+
 setup(
     name="caire",
     version="0.1",
@@ -49,6 +69,7 @@ setup(
 
     install_requires=[
         "accelerate",
+        "aiohttp",
         "certifi",
         "charset-normalizer",
         "einops",
@@ -83,11 +104,11 @@ setup(
         "typing_extensions",
         "urllib3",
         "wheel",
-        "Wikipedia-API",
         "gsutil",
         "tabulate",
     ],
     cmdclass={
         "download_assets": DownloadAssetsCommand,
+        "build_stores": BuildStoresCommand,
     },
 )
\ No newline at end of file
@@ -4,6 +4,25 @@ DEFAULT_DATASET = Path("src") / "examples"
 DATA_PATH = Path("data")
 # Use relative path for outputs
 OUTPUT_PATH = Path("src") / "outputs"
+RESULT_CACHE = "result_cache"  # API cache of retrieval / lemma / Wikipedia results by image digest, under OUTPUT_PATH (None disables it)
+RESULT_CACHE_MAX_ENTRIES = 1000  # Least recently used images are evicted beyond this
+API_WORKERS = 4  # Pipeline runs executed concurrently by the API server; VLM scoring is still one at a time
+API_MAX_QUEUE = 8  # Requests allowed to wait for a worker; further requests get 429
+API_MAX_QUEUE_WAIT_S = 120  # Requests still queued after this long get 503 (None = wait indefinitely)
+API_MAX_SCORING_WAIT_S = 120  # Running requests that wait longer than this for the GPU scoring lock get 503 (None = wait indefinitely)
+API_RETRIEVAL_MAX_BATCH = None  # Concurrent API requests encoded and searched together (None = API_WORKERS, the most that can wait on retrieval at once)
+API_RETRIEVAL_MAX_WAIT_S = 0.005  # How long a retrieval batch waits for more requests before running
+JOB_MAX_QUEUED = 16  # Batch jobs waiting to run; further submissions get 429
+JOB_MAX_IMAGES = 2000  # Images accepted per batch job
+JOB_MAX_UNCOMPRESSED_MB = 2048  # Total uncompressed size of the images in a job's zip archive, checked before extraction
+API_MAX_REQUEST_MB = 1024  # Request bodies larger than this get 413 (None = unbounded)
+JOB_HISTORY = 200  # Finished batch jobs remembered for polling; older ones are forgotten
+JOB_SCORING_PROMPTS = 32  # (image, culture) prompts a batch job scores per hold of the shared scoring lock, a few SCORING_BATCH_SIZE batches
+API_MAX_SESSIONS = 256  # Sessions kept for reuse; least recently used ones are evicted with their run directories
+API_SESSION_TTL_S = 3600  # Sessions unused for this long are evicted (None = never expire)
+API_PERSIST_RUNS = False  # Also write each API request's stage results to a run directory under OUTPUT_PATH, like a CLI run
+OUTPUT_QUOTA_GB = 50  # Disk quota for API run directories under OUTPUT_PATH (None = unbounded)
+OUTPUT_SWEEP_INTERVAL_S = 300  # How often expired sessions, orphaned run directories and the quota are checked
 
 PREDEFINED_TARGET_LISTS = [
     DATA_PATH / "country_list.pkl",         
@@ -14,16 +33,47 @@ PREDEFINED_TARGET_LISTS = [
 ]
 
 INDEX_INFOS = "index_infos_merged.json"
+INDEX_INFOS_STORE = "index_infos_merged"  # Columnar store built from INDEX_INFOS (python -m src.stores.index_store)
 FAISS_INDICES = "faiss_index_merged"
+FAISS_USE_MMAP = False  # Memory-map the FAISS index (read-only) so several worker processes share it
 LEMMA_EMBEDS = "combined_lemma_embeds.pkl"
+LEMMA_EMBEDS_MATRIX = "combined_lemma_embeds.f16.npy"  # Memory-mapped store built from LEMMA_EMBEDS (python -m src.stores.lemma_store)
+LEMMA_EMBEDS_IDS = "combined_lemma_embeds_ids.npy"
 BABELNET_WIKI = 'babelnet_source_dict.pkl'
+BABELNET_WIKI_DB = 'babelnet_source_dict.sqlite'  # Indexed store built from BABELNET_WIKI (python -m src.stores.babelnet_store)
 
 RETRIEVAL_BATCH_SIZE = 64
+SCORING_BATCH_SIZE = 8  # (image, target) prompts generated together by the VLM scorer
+KEEP_DECODED_IMAGES = 64  # Runs with up to this many images keep them decoded from retrieval to scoring; larger runs decode twice to bound memory
 NUMBER_RETRIEVED_IMAGES = 20
+LEMMA_MATCH_BATCH_SIZE = 256  # Images ranked per lemma-matching matrix product
+LEMMA_TOP_K = None  # Keep only the k best lemmas per image in lemma_match.pkl (None keeps every candidate)
+
+MODEL_POOL_MEMORY_GB = None  # Memory budget for resident VLMs (None = memory of all visible GPUs, less what is allocated outside the pool and MODEL_POOL_HEADROOM_GB)
+MODEL_POOL_HEADROOM_GB = 6  # GPU memory left free for KV caches (including prefix caches) and activations when the budget is derived
 
 MAX_WIKI_DOCS = 10
+WIKI_API_URL = "https://{lang}.wikipedia.org/w/api.php"  # MediaWiki endpoint ({lang} is filled in); can point at a local mock server
+WIKI_USER_AGENT = "CAIRE/1.0 (https://github.com/siddharthyayavaram/CAIRE)"
+WIKI_MAX_CONCURRENCY = 16  # Wikipedia requests in flight over the shared connection pool
+WIKI_REQUEST_TIMEOUT_S = 5  # Timeout of a single Wikipedia request
+WIKI_HEDGE_DELAY_S = 1.0  # Send a duplicate request if the first has not answered after this long (None disables hedging)
+WIKI_MAX_RETRIES = 2  # Retries after a timeout, connection error, 429 or 5xx response
+WIKI_PREFETCH_BIDS = 4  # Bids resolved speculatively ahead of the one being waited on
+WIKI_IMAGE_DEADLINE_S = 30  # Latency budget for one image's Wikipedia pages (None = no deadline)
+WIKI_CONCURRENT_IMAGES = 8  # Images whose pages are retrieved at once; an image's deadline starts when it is admitted
+WIKI_CACHE = "wiki_cache.sqlite"  # Persistent Wikipedia page / langlink cache under DATA_PATH (None disables it)
+WIKI_CACHE_MAX_MB = 4096  # Size limit of the cache; least recently used entries are evicted (None = unbounded)
+WIKI_CACHE_TTL_DAYS = 30  # Entries older than this are refetched (None = never expire)
+WIKI_OFFLINE = False  # Serve Wikipedia lookups from the cache only, without network access
+WIKI_BACKEND = "api"  # "api" (live MediaWiki) or "snapshot" (local store imported from a dump, no network access)
+WIKI_SNAPSHOT = "wiki_snapshot.sqlite"  # Snapshot store under DATA_PATH (python -m src.stores.wiki_snapshot)
 USE_MULTIPLE_WIKI_PAGES = False  # Set to True to use multiple Wikipedia pages in VLM scoring
 WIKI_CHARS_PER_PAGE = 2000  # Characters to use per Wikipedia page when USE_MULTIPLE_WIKI_PAGES is True
+WIKI_CHARS_SINGLE_PAGE = 15000  # Characters of the top Wikipedia page used in single-page mode
+USE_PREFIX_CACHE = False  # Prefill the image + Wikipedia prefix once per image and reuse its KV cache for every target
+SCORE_CACHE = "score_cache.sqlite"  # Persistent VLM score cache under DATA_PATH (None disables it)
+PROMPT_TEMPLATE_VERSION = 1  # Bump when editing the prompt templates below, so cached scores are not reused
 
 PROMPT_TEMPLATE = '''We want to assess how relevant an image is to a given culture. 
 We have identified this concept to be closely associated with the image: {entity}. 
@@ -65,4 +115,50 @@ In your reasoning process, please consider BOTH the image and the information ab
 
 Provide your response in the following JSON format:
 {{"score": <number between 1-5>, "reasoning": "<your detailed reasoning>"}}
-'''
\ No newline at end of file
+'''
+
+# Target-last variants of the prompts above, used when USE_PREFIX_CACHE is True.
+# Everything before PROMPT_TARGET_TEMPLATE is identical across targets, so its
+# key/value states can be computed once per image and shared by all targets.
+PROMPT_CONTEXT_TEMPLATE = '''We want to assess how relevant an image is to a given culture. 
+We have identified this concept to be closely associated with the image: {entity}. 
+Here is some detailed information about this concept from Wikipedia. {wiki}.
+
+The final score should be a number between 1 to 5, where 1 and 5 mean the following:
+1 -- Not relevant: – The content does not connect with or reflect the target culture at all.
+2 -- Minimally Relevant: – The content shows slight or superficial connections to the culture but lacks depth. May include vague references or isolated cultural elements that feel out of place or underdeveloped.
+3 -- Somewhat Relevant: – The content contains identifiable cultural references, but they may feel generic, inconsistent, or limited in scope. The connection to the culture is present but could be stronger or more meaningful.
+4 -- Relevant: – The content reflects a reasonable understanding of the culture, including accurate and appropriate references. It integrates cultural aspects well, though there may still be areas where more depth could be added.
+5 -- Highly Relevant: – The content is deeply connected to the target culture, showing an immersive, accurate, and respectful understanding. Cultural references feel natural, meaningful, and central to the content.
+
+In your reasoning process, please consider BOTH the image and the information about the entity provided above.
+
+Provide your response in the following JSON format:
+{{"score": <number between 1-5>, "reasoning": "<your detailed reasoning>"}}
+
+'''
+
+PROMPT_CONTEXT_TEMPLATE_MULTI = '''We want to assess how relevant an image is to a given culture. 
+We have identified several related concepts that are closely associated with the image. These Wikipedia titles are listed in decreasing order of relevance: {entities}.
+Here is some detailed information about these concepts from Wikipedia:
+
+{wiki}
+
+
+The final score should be a number between 1 to 5, where 1 and 5 mean the following:
+1 -- Not relevant: – The content does not connect with or reflect the target culture at all.
+2 -- Minimally Relevant: – The content shows slight or superficial connections to the culture but lacks depth. May include vague references or isolated cultural elements that feel out of place or underdeveloped.
+3 -- Somewhat Relevant: – The content contains identifiable cultural references, but they may feel generic, inconsistent, or limited in scope. The connection to the culture is present but could be stronger or more meaningful.
+4 -- Relevant: – The content reflects a reasonable understanding of the culture, including accurate and appropriate references. It integrates cultural aspects well, though there may still be areas where more depth could be added.
+5 -- Highly Relevant: – The content is deeply connected to the target culture, showing an immersive, accurate, and respectful understanding. Cultural references feel natural, meaningful, and central to the content.
+
+In your reasoning process, please consider BOTH the image and the information about these entities provided above. Note that the first entity is most relevant to the image, while others provide additional context.
+
+Provide your response in the following JSON format:
+{{"score": <number between 1-5>, "reasoning": "<your detailed reasoning>"}}
+
+'''
+
+PROMPT_TARGET_TEMPLATE = '''Assign a score from 1 to 5 based on how culturally relevant the image is to {target}:
+Think step by step, specifically considering cultural symbols, styles, traditions, or any features that align with the culture of {target}.
+'''
@@ -0,0 +1,76 @@
+import io
+import threading
+from PIL import Image, ImageFile
+from src.utils import image_digest
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+class ImageHandle:
+    """
+    An image decoded once and shared by retrieval and scoring.
+
+    The image comes from a file path, encoded bytes (an API upload) or an already decoded
+    PIL image. It is decoded to RGB on first use, and the views derived from the pixels
+    (the sha256 digest and the SigLIP pixel values) are computed lazily and cached.
+
+    release() drops the pixels and cached views but keeps the digest, so large folders
+    do not hold every decoded image between retrieval and scoring. A released image is
+    decoded again from its path or bytes if it is needed later.
+    """
+
+    def __init__(self, path=None, data=None, image=None):
+        if path is None and data is None and image is None:
+            raise ValueError("ImageHandle needs a path, encoded bytes or a PIL image")
+        self.path = path
+        self.data = data
+        self._image = image.convert("RGB") if image is not None and image.mode != "RGB" else image
+        self._digest = None
+        self._siglip = {}  # id(processor) -> pixel values of shape (1, 3, H, W)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_bytes(cls, data, path=None):
+        return cls(path=path, data=data)
+
+    @property
+    def image(self):
+        """The decoded RGB PIL image"""
+        with self._lock:
+            if self._image is None:
+                source = io.BytesIO(self.data) if self.data is not None else self.path
+                self._image = Image.open(source).convert("RGB")
+            return self._image
+
+    @property
+    def digest(self):
+        """image_digest of the decoded pixels, the key of the score and result caches"""
+        if self._digest is None:
+            self._digest = image_digest(self.image)
+        return self._digest
+
+    def siglip_pixels(self, processor):
+        """SigLIP pixel values of this image, preprocessed once per processor"""
+        key = id(processor)
+        if key not in self._siglip:
+            self._siglip[key] = processor(images=[self.image], return_tensors="pt")["pixel_values"]
+        return self._siglip[key]
+
+    def release(self):
+        """Drop the decoded pixels and cached views, keeping the digest; no-op for in-memory-only images"""
+        if self.path is None and self.data is None:
+            return
+        if self._image is not None and self._digest is None:
+            self._digest = image_digest(self._image)
+        with self._lock:
+            self._image = None
+            self._siglip.clear()
+
+def image_handles(args):
+    """Return args.images, the ImageHandle of each path in args.image_paths, opening missing ones"""
+    images = getattr(args, "images", None)
+    if images is None:
+        images = args.images = {}
+    for path in args.image_paths:
+        if path not in images:
+            images[path] = ImageHandle(path=path)
+    return images
@@ -9,11 +9,11 @@ os.environ["HF_TOKEN"] = os.getenv("HF_TOKEN")
 if not os.environ["HF_TOKEN"]:
     raise ValueError("HF_TOKEN not found in environment variables. Please make sure it's set in your bashrc and the environment is sourced.")
 
-from src.scripts.retrieval import process_images
+from src.scripts.retrieval import process_images, get_retrieval_context
 from src.scripts.disambiguation import lemma_match
 from src.scripts.fetch_wikipedia import wiki_retrieval
-from src.scripts.culture_scores import qwen_vl_scores
-from src.utils import load_model, parse_args, resolve_image_paths, resolve_target_list, log_run_metadata, save_readable, generate_heatmap
+from src.scripts.culture_scores import qwen_vl_scores, WIKI_FIELDS, WIKI_CHAR_BUDGET
+from src.utils import parse_args, resolve_image_paths, resolve_target_list, log_run_metadata, save_readable, generate_heatmap
 from src.config import MAX_WIKI_DOCS, OUTPUT_PATH
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -23,20 +23,20 @@ def run_pipeline(args):
     try:
         logging.info(f"Timestamp: {args.timestamp}")
 
-        logging.info("Initializing model...")
-        model, processor = load_model()
+        logging.info("Initializing model and retrieval index...")
+        context = get_retrieval_context()
 
         logging.info("Processing images...")
-        process_images(args, model, processor)
+        retrieval = process_images(args, context)
 
         logging.info("Performing lemma matching...")
-        lemma_match(args)
+        lemmas = lemma_match(args, retrieval)
 
         logging.info("Fetching Wikipedia data...")
-        wiki_retrieval(args, MAX_WIKI_DOCS)
+        wiki = wiki_retrieval(args, MAX_WIKI_DOCS, fields=WIKI_FIELDS, max_chars=WIKI_CHAR_BUDGET, lemmas=lemmas)
 
-        logging.info(f"1-5 Scoring with {args.model_name}...")
-        qwen_vl_scores(args, model_name=args.model_name)
+        logging.info(f"1-5 Scoring with {args.model_name} ({args.scoring_mode})...")
+        qwen_vl_scores(args, model_name=args.model_name, scoring_mode=args.scoring_mode, wiki=wiki)
 
     except Exception:
         logging.error("ERROR: ", exc_info=True)
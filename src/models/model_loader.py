@@ -1,5 +1,8 @@
+import gc
 import torch
 import logging
+import threading
+from collections import OrderedDict
 from transformers import (
     AutoProcessor,
     Qwen2_5_VLForConditionalGeneration,
@@ -28,16 +31,19 @@ MODEL_CONFIGS = {
     "qwen_vl": {
         "model_id": "Qwen/Qwen2.5-VL-7B-Instruct",
         "model_class": Qwen2_5_VLForConditionalGeneration,
+        "memory_gb": 17,  # approximate bf16 footprint, used to evict before loading
         "extra_kwargs": {"attn_implementation": "flash_attention_2"} if USE_FLASH_ATTENTION else {}
     },
     "llama_vl": {
         "model_id": "meta-llama/Llama-3.2-11B-Vision-Instruct",
         "model_class": MllamaForConditionalGeneration,
+        "memory_gb": 22,
         "extra_kwargs": {"attn_implementation": "sdpa"}
     },
     "pangea_vl": {
         "model_id": "neulab/Pangea-7B-hf",
         "model_class": LlavaNextForConditionalGeneration,  # Per official docs
+        "memory_gb": 16,
         "extra_kwargs": {"attn_implementation": "flash_attention_2"} if USE_FLASH_ATTENTION else {}
     },
     # NOTE: CulturalPangea requires custom llava library loader, not supported via transformers yet
@@ -79,3 +85,103 @@ def load_model(model_name):
         processor = AutoProcessor.from_pretrained(model_id, token=hf_token)
 
     return model, processor, DEVICE
+
+class ModelPool:
+    """
+    Process-wide registry that keeps loaded VLMs and processors resident.
+
+    Models are kept in least-recently-used order. Before a new model is loaded,
+    older models are evicted until the estimated footprint fits the memory budget.
+
+    Args:
+        memory_budget_gb: Total memory the pool may hold, in GB. If None, it is derived
+                          before each load: the memory of every visible GPU (device_map="auto"
+                          spreads models over all of them), less memory allocated outside the
+                          pool such as the SigLIP encoder, less headroom_gb. No limit on CPU.
+        headroom_gb: Memory kept free for KV caches and activations when the budget is derived
+    """
+
+    def __init__(self, memory_budget_gb=None, headroom_gb=0):
+        self.memory_budget_gb = memory_budget_gb
+        self.headroom_gb = headroom_gb
+        self._models = OrderedDict()  # model_name -> (model, processor, device, footprint_gb)
+        self._lock = threading.RLock()
+
+    def get(self, model_name):
+        """Return (model, processor, device) for model_name, loading it if needed"""
+        with self._lock:
+            if model_name in self._models:
+                self._models.move_to_end(model_name)
+                model, processor, device, _ = self._models[model_name]
+                return model, processor, device
+
+            if model_name not in MODEL_CONFIGS:
+                raise ValueError(f"Invalid model name '{model_name}'.")
+
+            self._make_room(MODEL_CONFIGS[model_name].get("memory_gb", 0))
+
+            logging.info(f"Loading {model_name} into model pool")
+            model, processor, device = load_model(model_name)
+            model.eval()
+            footprint_gb = model.get_memory_footprint() / 1024 ** 3
+            self._models[model_name] = (model, processor, device, footprint_gb)
+            logging.info(f"Loaded {model_name} ({footprint_gb:.1f} GB), resident models: {list(self._models)}")
+            return model, processor, device
+
+    def evict(self, model_name):
+        with self._lock:
+            if model_name not in self._models:
+                return
+            del self._models[model_name]
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            logging.info(f"Evicted {model_name} from model pool")
+
+    def clear(self):
+        with self._lock:
+            for model_name in list(self._models):
+                self.evict(model_name)
+
+    def resident_models(self):
+        with self._lock:
+            return list(self._models)
+
+    def budget_gb(self):
+        """Memory the pool may hold now, in GB, or None for no limit"""
+        if self.memory_budget_gb is not None:
+            return self.memory_budget_gb
+        if not torch.cuda.is_available():
+            return None
+        devices = range(torch.cuda.device_count())
+        total_gb = sum(torch.cuda.get_device_properties(d).total_memory for d in devices) / 1024 ** 3
+        allocated_gb = sum(torch.cuda.memory_allocated(d) for d in devices) / 1024 ** 3
+        outside_gb = max(0.0, allocated_gb - self._resident_gb())
+        return total_gb - outside_gb - self.headroom_gb
+
+    def _make_room(self, required_gb):
+        budget_gb = self.budget_gb()
+        if budget_gb is None:
+            return
+        while self._models and self._resident_gb() + required_gb > budget_gb:
+            self.evict(next(iter(self._models)))
+        if required_gb > budget_gb:
+            logging.warning(f"Loading a {required_gb} GB model with a {budget_gb:.1f} GB model pool budget")
+
+    def _resident_gb(self):
+        return sum(entry[3] for entry in self._models.values())
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_model_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            from src.config import MODEL_POOL_MEMORY_GB, MODEL_POOL_HEADROOM_GB
+            _POOL = ModelPool(MODEL_POOL_MEMORY_GB, MODEL_POOL_HEADROOM_GB)
+        return _POOL
+
+def get_model(model_name):
+    """Return a resident (model, processor, device) from the process-wide model pool"""
+    return get_model_pool().get(model_name)
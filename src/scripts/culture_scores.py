@@ -1,17 +1,35 @@
-from PIL import Image
+import copy
+import functools
 import torch
-import pickle
 import json
 import re
 import logging
-from src.utils import save_pickle
+from src.image_handle import image_handles
+from src.scripts.stages import load_wiki, save_scores
 from tqdm import tqdm
-from pathlib import Path
-from src.config import OUTPUT_PATH, PROMPT_TEMPLATE, PROMPT_TEMPLATE_MULTI, USE_MULTIPLE_WIKI_PAGES, WIKI_CHARS_PER_PAGE
-from src.models.model_loader import load_model
+from src.config import (
+    PROMPT_TEMPLATE, PROMPT_TEMPLATE_MULTI, USE_MULTIPLE_WIKI_PAGES, WIKI_CHARS_PER_PAGE, WIKI_CHARS_SINGLE_PAGE,
+    USE_PREFIX_CACHE, SCORING_BATCH_SIZE, PROMPT_CONTEXT_TEMPLATE, PROMPT_CONTEXT_TEMPLATE_MULTI, PROMPT_TARGET_TEMPLATE,
+    KEEP_DECODED_IMAGES
+)
+from src.models.model_loader import get_model
+from src.stores.score_cache import get_score_cache, digest_context, score_key
 import os
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+# Images decoded and length-bucketed together by the batched scorers; bounds memory on large folders
+IMAGES_PER_BUCKETING_WINDOW = 64
+
+SCORING_MODES = ("generate", "logits")
+# Assistant turn is pre-filled up to the score so the next token is the digit itself
+LOGITS_RESPONSE_PREFIX = '{"score": '
+SCORE_DIGITS = ["1", "2", "3", "4", "5"]
+
+# Wikipedia page fields and text length build_wiki_context reads. Wiki retrieval fetches
+# only these, since either wiki mode may be used later on the same retrieved pages.
+WIKI_FIELDS = ("title", "text")
+WIKI_CHAR_BUDGET = max(WIKI_CHARS_SINGLE_PAGE, WIKI_CHARS_PER_PAGE)
+
 def parse_json_response(response_text):
     """Parse JSON response from VLM, with fallback for malformed responses"""
     try:
@@ -49,9 +67,217 @@ def parse_json_response(response_text):
         logging.error(f"Error parsing response: {str(e)}")
         return None, f"Error parsing response: {str(e)}"
 
-def qwen_vl_scores(args, use_multiple_wiki_pages=None, model_name='qwen_vl'):
+SYSTEM_PROMPT = "You are an expert in evaluating the cultural relevance of images."
+
+def build_wiki_context(pages, use_multiple_wiki_pages):
+    """
+    Build the prompt fields describing an image's Wikipedia context.
+
+    Returns a dict with 'entity'/'wiki' (single-page mode) or 'entities'/'wiki'
+    (multi-page mode), plus a 'multi' flag selecting the prompt template.
+    """
+    if use_multiple_wiki_pages and len(pages) > 1:
+        # Multi-page mode: use up to 10 pages with WIKI_CHARS_PER_PAGE chars each
+        entities = []
+        wiki_texts = []
+        for page in pages[:10]:  # Use up to 10 pages
+            if page and 'title' in page and 'text' in page:
+                entities.append(page['title'])
+                wiki_texts.append(f"**{page['title']}**: {page['text'][:WIKI_CHARS_PER_PAGE]}")
+        return {'multi': True, 'entities': ", ".join(entities), 'wiki': "\n\n".join(wiki_texts)}
+
+    # Single-page mode: use only the first page with WIKI_CHARS_SINGLE_PAGE chars
+    return {'multi': False, 'entity': pages[0]['title'], 'wiki': pages[0]['text'][:WIKI_CHARS_SINGLE_PAGE]}
+
+def build_prompt(context, target, target_last=False):
+    """Format the scoring prompt for one target. target_last selects the prefix-cache friendly templates."""
+    fields = {k: v for k, v in context.items() if k != 'multi'}
+    if target_last:
+        template = PROMPT_CONTEXT_TEMPLATE_MULTI if context['multi'] else PROMPT_CONTEXT_TEMPLATE
+        return template.format(**fields) + PROMPT_TARGET_TEMPLATE.format(target=target.capitalize())
+    template = PROMPT_TEMPLATE_MULTI if context['multi'] else PROMPT_TEMPLATE
+    return template.format(target=target.capitalize(), **fields)
+
+def build_chat_text(processor, model_name, prompt):
+    """Wrap a prompt in the model-specific chat format, including the image placeholder"""
+    if model_name == "pangea_vl":
+        # Pangea model uses manual prompt formatting (no chat template support)
+        return f"<|im_start|>system\n{SYSTEM_PROMPT}<|im_end|>\n<|im_start|>user\n<image>\n{prompt}<|im_end|>\n<|im_start|>assistant\n"
+    # Qwen-VL and Llama Vision use chat templates
+    conversation = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": [{"type": "image"}, {"type": "text", "text": prompt}]}
+    ]
+    return processor.apply_chat_template(conversation, add_generation_prompt=True)
+
+def prepare_inputs(processor, model_name, texts, images, device):
+    """Tokenize a batch of chat texts with one image each"""
+    if model_name == "llama_vl":
+        # Mllama expects a list of images per sample
+        images = [[image] for image in images]
+    return processor(text=texts, images=images, padding=True, return_tensors="pt").to(device)
+
+def generate_responses(model, processor, inputs, past_key_values=None):
+    # Generate text response instead of using token probabilities
+    generated_ids = model.generate(
+        **inputs,
+        past_key_values=past_key_values,
+        max_new_tokens=256,
+        do_sample=False,
+        temperature=0.7,
+    )
+
+    # Decode the generated text
+    return processor.batch_decode(
+        generated_ids[:, inputs.input_ids.shape[1]:],
+        skip_special_tokens=True,
+        clean_up_tokenization_spaces=False
+    )
+
+def bucketed_batches(processor, model_name, images, contexts, targets, batch_size, device, response_prefix="", release=False):
+    """
+    Yield (jobs, inputs) batches covering every (image, target) pair.
+
+    Prompts from several images and targets are sorted by token length before being
+    split into batches, so each batch pads to a similar length. Each job is an
+    (image index, target) tuple. targets maps each image index to the targets to score.
+    With release, each window's ImageHandles are released once it is scored.
+    """
+    # Decoder-only models need the padding on the left
+    processor.tokenizer.padding_side = "left"
+
+    indices = sorted(contexts)
+    for start in range(0, len(indices), IMAGES_PER_BUCKETING_WINDOW):
+        window = indices[start:start + IMAGES_PER_BUCKETING_WINDOW]
+        decoded = {idx: images[idx].image for idx in window}
+
+        jobs = []
+        for idx in window:
+            for target in targets[idx]:
+                text = build_chat_text(processor, model_name, build_prompt(contexts[idx], target)) + response_prefix
+                jobs.append((len(processor.tokenizer(text).input_ids), idx, target, text))
+        jobs.sort(key=lambda job: job[0])
+
+        for b in tqdm(range(0, len(jobs), batch_size), desc="Scoring batches"):
+            batch = jobs[b:b + batch_size]
+            inputs = prepare_inputs(processor, model_name, [job[3] for job in batch], [decoded[job[1]] for job in batch], device)
+            yield [(job[1], job[2]) for job in batch], inputs
+
+        del decoded
+        if release:
+            for idx in window:
+                images[idx].release()
+        torch.cuda.empty_cache()
+
+def score_batched(model, processor, device, model_name, images, contexts, targets, batch_size, on_score=None, release=False):
+    """
+    Score every (image, target) pair with free-text generation in length-bucketed batches.
+
+    Args:
+        images: ImageHandle of each image, in sorted path order
+        contexts: Dict of image index -> Wikipedia context from build_wiki_context
+        targets: Dict of image index -> target cultures to score
+        batch_size: Number of prompts per generate call
+        on_score: Optional callback(image index, [target, score, reasoning]) called as each batch finishes
+        release: Release the images once scored, see bucketed_batches
+
+    Returns:
+        Dict of image index -> list of [target, score, reasoning] in target order
+    """
+    results = {idx: {} for idx in contexts}
+    for jobs, inputs in bucketed_batches(processor, model_name, images, contexts, targets, batch_size, device, release=release):
+        for (idx, target), response in zip(jobs, generate_responses(model, processor, inputs)):
+            # Parse JSON response to extract score and reasoning
+            results[idx][target] = parse_json_response(response)
+            if on_score is not None:
+                on_score(idx, [target, *results[idx][target]])
+
+    return {idx: [[target, *results[idx][target]] for target in targets[idx]] for idx in contexts}
+
+def score_digit_token_ids(tokenizer):
+    token_ids = []
+    for digit in SCORE_DIGITS:
+        ids = tokenizer.encode(digit, add_special_tokens=False)
+        if len(ids) != 1:
+            raise ValueError(f"Score digit '{digit}' is not a single token for this tokenizer")
+        token_ids.append(ids[0])
+    return token_ids
+
+def score_logits(model, processor, device, model_name, images, contexts, targets, batch_size, on_score=None, release=False):
+    """
+    Score every (image, target) pair with a single forward pass and no free-text generation.
+
+    The assistant response is pre-filled with '{"score": ' and the next-token
+    probabilities of "1" to "5" give the score distribution. The score is the
+    expected value of that distribution.
+
+    Returns:
+        Dict of image index -> list of [target, expected score, reasoning, distribution] in target order
+    """
+    digit_ids = score_digit_token_ids(processor.tokenizer)
+    digit_values = torch.arange(1, len(SCORE_DIGITS) + 1, dtype=torch.float32)
+
+    results = {idx: {} for idx in contexts}
+    batches = bucketed_batches(processor, model_name, images, contexts, targets, batch_size, device, LOGITS_RESPONSE_PREFIX, release)
+    for jobs, inputs in batches:
+        # Only the last position is needed; avoids materializing vocab-sized logits for the whole prompt
+        logits = model(**inputs, logits_to_keep=1).logits[:, -1, :]
+        probs = torch.softmax(logits[:, digit_ids].float(), dim=-1).cpu()
+        expected = probs @ digit_values
+        for (idx, target), p, score in zip(jobs, probs.tolist(), expected.tolist()):
+            results[idx][target] = (round(score, 3), "", p)
+            if on_score is not None:
+                on_score(idx, [target, *results[idx][target]])
+
+    return {idx: [[target, *results[idx][target]] for target in targets[idx]] for idx in contexts}
+
+def score_image_with_prefix_cache(model, processor, device, model_name, image, context, targets, on_score=None):
+    """
+    Score one image against every target, prefilling the shared image + Wikipedia
+    prefix once and reusing its key/value states for each target-specific suffix.
+    on_score is called with each [target, score, reasoning] as it is generated.
+    """
+    texts = [build_chat_text(processor, model_name, build_prompt(context, target, target_last=True)) for target in targets]
+
+    # The prompt is identical up to the target-specific instruction
+    split = texts[0].index(PROMPT_TARGET_TEMPLATE.format(target=targets[0].capitalize()))
+    prefix_inputs = prepare_inputs(processor, model_name, [texts[0][:split]], [image], device)
+    prefix_ids = prefix_inputs.input_ids[0]
+    # Only the cache is needed; avoids vocab-sized logits over the whole image + Wikipedia prefix
+    prefix_cache = model(**prefix_inputs, use_cache=True, logits_to_keep=1).past_key_values
+
+    OP = []
+    for target, text in zip(targets, texts):
+        inputs = prepare_inputs(processor, model_name, [text], [image], device)
+
+        # Reuse the cache only if the prefix tokenizes identically inside the full prompt
+        past_key_values = None
+        full_ids = inputs.input_ids[0]
+        if len(full_ids) > len(prefix_ids) and torch.equal(full_ids[:len(prefix_ids)], prefix_ids):
+            past_key_values = copy.deepcopy(prefix_cache)
+        else:
+            logging.warning(f"Prompt prefix for '{target}' does not match the cached prefix, running full prefill")
+
+        score, reasoning = parse_json_response(generate_responses(model, processor, inputs, past_key_values)[0])
+        OP.append([target, score, reasoning])
+        if on_score is not None:
+            on_score(OP[-1])
+
+    del prefix_cache
+    torch.cuda.empty_cache()
+    return OP
+
+def qwen_vl_scores(args, use_multiple_wiki_pages=None, model_name='qwen_vl', use_prefix_cache=None, batch_size=None, scoring_mode="generate", on_score=None, wiki=None, persist=True):
     """
     Score images for cultural relevance using Vision-Language models.
+
+    Scores are cached persistently (SCORE_CACHE) by image, Wikipedia context, target,
+    model, scoring mode and PROMPT_TEMPLATE_VERSION. Only uncached pairs are sent to the
+    model, and the model is not loaded at all if every score is cached.
+
+    Returns:
+        The score entries, one per image: {'image_path', 'values', 'reasoning'}
+        and, in logits mode, 'distribution'
     
     Args:
         args: Arguments object containing image_paths, target_list, and timestamp
@@ -59,119 +285,128 @@ def qwen_vl_scores(args, use_multiple_wiki_pages=None, model_name='qwen_vl'):
                                  If None, uses the config value USE_MULTIPLE_WIKI_PAGES
         model_name: Name of the model to use ('qwen_vl', 'pangea_vl', 'llama_vl')
                     Defaults to 'qwen_vl' for backwards compatibility
+        use_prefix_cache: Whether to prefill the image + Wikipedia prefix once per image and
+                          reuse its KV cache across targets. If None, uses USE_PREFIX_CACHE
+        batch_size: Number of (image, target) prompts generated together when the prefix
+                    cache is not used. If None, uses SCORING_BATCH_SIZE
+        scoring_mode: 'generate' for a generated score with reasoning, or 'logits' for an
+                      expected score and 1-5 distribution from a single forward pass.
+                      The prefix cache only applies to 'generate'
+        on_score: Optional callback(image index, [target, score, reasoning(, distribution)]) called
+                  as each score becomes available, cached scores first, in no particular target order
+        wiki: wiki_retrieval's WikiResult, or None to read it from the run directory
+        persist: Also write the score entries to the run directory (1-5_scores_VLM_<model_name>.pkl)
     """
+    if scoring_mode not in SCORING_MODES:
+        raise ValueError(f"Invalid scoring mode '{scoring_mode}'.")
+
     # Use parameter if provided, otherwise fall back to config
     if use_multiple_wiki_pages is None:
         use_multiple_wiki_pages = USE_MULTIPLE_WIKI_PAGES
+    if use_prefix_cache is None:
+        use_prefix_cache = USE_PREFIX_CACHE
+    if batch_size is None:
+        batch_size = SCORING_BATCH_SIZE
 
-    model, processor, device = load_model(model_name)
-
-    with open(Path(OUTPUT_PATH) / f"{args.timestamp}" / "WIKI.pkl", 'rb') as f:
-        x = pickle.load(f)
+    if wiki is None:
+        wiki = load_wiki(args)
+    x = wiki.pages
 
     image_paths = sorted(args.image_paths)
+    handles = image_handles(args)
+    images = [handles[path] for path in image_paths]
+    # Large runs release each image once it is scored, see KEEP_DECODED_IMAGES
+    release = len(image_paths) > KEEP_DECODED_IMAGES
 
     targets = args.target_list
 
-    OUTPUTS = []
-
-    with torch.no_grad():
-        for idx, img_path in enumerate(tqdm(image_paths, desc="Processing Images")):
-            OP = []
-            
-            # Check if Wikipedia pages were retrieved for this image
-            if not x[idx] or len(x[idx]) == 0:
-                logging.warning(f"No Wikipedia pages found for image {img_path}, skipping scoring")
-                # Add default scores for this image
-                for target in targets:
-                    OP.append([target, 3, "No Wikipedia pages available for this image"])
-                OUTPUTS.append(OP)
-                continue
-
-            # Prepare Wikipedia context based on mode
-            if use_multiple_wiki_pages and len(x[idx]) > 1:
-                # Multi-page mode: use up to 10 pages with WIKI_CHARS_PER_PAGE chars each
-                entities = []
-                wiki_texts = []
-                for page_idx, page in enumerate(x[idx][:10]):  # Use up to 10 pages
-                    if page and 'title' in page and 'text' in page:
-                        entities.append(page['title'])
-                        wiki_texts.append(f"**{page['title']}**: {page['text'][:WIKI_CHARS_PER_PAGE]}")
-                
-                entities_str = ", ".join(entities)
-                wiki_combined = "\n\n".join(wiki_texts)
-                use_multi_prompt = True
-            else:
-                # Single-page mode: use only the first page with 15000 chars
-                wiki = x[idx][0]['text'][:15000]
-                entity = x[idx][0]['title']
-                use_multi_prompt = False
+    OUTPUTS = [None] * len(image_paths)
+    contexts = {}
+
+    for idx, img_path in enumerate(image_paths):
+        # Check if Wikipedia pages were retrieved for this image
+        if not x[idx] or len(x[idx]) == 0:
+            logging.warning(f"No Wikipedia pages found for image {img_path}, skipping scoring")
+            # Add default scores for this image
+            OUTPUTS[idx] = [[target, 3, "No Wikipedia pages available for this image"] for target in targets]
+            if on_score is not None:
+                for row in OUTPUTS[idx]:
+                    on_score(idx, row)
+            continue
 
-            image = Image.open(img_path).convert("RGB")
+        # Prepare Wikipedia context based on mode
+        contexts[idx] = build_wiki_context(x[idx], use_multiple_wiki_pages)
 
+    # Look up scores from earlier runs; only the missing (image, target) pairs are generated
+    score_cache = get_score_cache()
+    prompt_variant = "target_last" if use_prefix_cache and scoring_mode == "generate" else "default"
+    keys = {}
+    cached = {}
+    if score_cache is not None and contexts:
+        for idx in contexts:
+            image_key = images[idx].digest
+            context_key = digest_context(contexts[idx])
             for target in targets:
-                # Choose prompt template based on mode
-                if use_multi_prompt:
-                    PROMPT = PROMPT_TEMPLATE_MULTI.format(
-                        target=target.capitalize(), 
-                        wiki=wiki_combined, 
-                        entities=entities_str
-                    )
-                else:
-                    PROMPT = PROMPT_TEMPLATE.format(
-                        target=target.capitalize(), 
-                        wiki=wiki, 
-                        entity=entity
+                keys[idx, target] = score_key(image_key, context_key, target, model_name, scoring_mode, prompt_variant)
+        cached = score_cache.get_many(keys.values())
+        logging.info(f"{sum(key in cached for key in keys.values())} of {len(keys)} scores found in the score cache")
+
+    if on_score is not None:
+        for (idx, target), key in keys.items():
+            if key in cached:
+                on_score(idx, [target, *cached[key]])
+
+    pending = {idx: [t for t in targets if keys.get((idx, t)) not in cached] for idx in contexts}
+    pending = {idx: pending_targets for idx, pending_targets in pending.items() if pending_targets}
+    pending_contexts = {idx: contexts[idx] for idx in pending}
+
+    scored = {}
+    if pending:
+        model, processor, device = get_model(model_name)
+        with torch.no_grad():
+            if scoring_mode == "logits":
+                scored = score_logits(model, processor, device, model_name, images, pending_contexts, pending, batch_size, on_score, release)
+            elif use_prefix_cache:
+                for idx in tqdm(sorted(pending), desc="Processing Images"):
+                    scored[idx] = score_image_with_prefix_cache(
+                        model, processor, device, model_name, images[idx].image, contexts[idx], pending[idx],
+                        None if on_score is None else functools.partial(on_score, idx)
                     )
+                    if release:
+                        images[idx].release()
+            else:
+                scored = score_batched(model, processor, device, model_name, images, pending_contexts, pending, batch_size, on_score, release)
 
-                # Handle different model types
-                if model_name == "pangea_vl":
-                    # Pangea model uses manual prompt formatting (no chat template support)
-                    text_input = f"<|im_start|>system\nYou are an expert in evaluating the cultural relevance of images.<|im_end|>\n<|im_start|>user\n<image>\n{PROMPT}<|im_end|>\n<|im_start|>assistant\n"
-                    inputs = processor(images=image, text=text_input, return_tensors='pt').to(device)
-                else:
-                    # Qwen-VL and Llama Vision use chat templates
-                    conversation = [
-                        {"role": "system", "content": "You are an expert in evaluating the cultural relevance of images."},
-                        {"role": "user", "content": [{"type": "image"}, {"type": "text", "text": PROMPT}]}
-                    ]
-                    text = processor.apply_chat_template(conversation, add_generation_prompt=True)
-                    inputs = processor(text=[text], images=[image], padding=True, return_tensors="pt").to(device)
-
-                # Generate text response instead of using token probabilities
-                generated_ids = model.generate(
-                    **inputs,
-                    max_new_tokens=256,
-                    do_sample=False,
-                    temperature=0.7,
-                )
-                
-                # Decode the generated text
-                generated_text = processor.batch_decode(
-                    generated_ids[:, inputs.input_ids.shape[1]:], 
-                    skip_special_tokens=True,
-                    clean_up_tokenization_spaces=False
-                )[0]
-                
-                # Parse JSON response to extract score and reasoning
-                score, reasoning = parse_json_response(generated_text)
-                
-                OP.append([target, score, reasoning])
-                torch.cuda.empty_cache()
-
-            OUTPUTS.append(OP)
+    if score_cache is not None:
+        # Unparseable responses are not cached, so they are retried next time
+        score_cache.put_many([
+            (keys[idx, row[0]], model_name, row[0], row[1:])
+            for idx, rows in scored.items() for row in rows if row[1] is not None
+        ])
+
+    for idx in contexts:
+        new_scores = {row[0]: row[1:] for row in scored.get(idx, [])}
+        OUTPUTS[idx] = [
+            [target, *(new_scores[target] if target in new_scores else cached[keys[idx, target]])]
+            for target in targets
+        ]
 
     SCORES = []
     for n, a in enumerate(OUTPUTS):
         # Store scores with reasoning
         prompt_scores = {i[0]: i[1] for i in a}  # {culture: score}
         prompt_reasoning = {i[0]: i[2] for i in a}  # {culture: reasoning}
-        SCORES.append({
+        entry = {
             'image_path': image_paths[n], 
             'values': prompt_scores,
             'reasoning': prompt_reasoning
-        })
+        }
+        if scoring_mode == "logits":
+            # {culture: [p(1), ..., p(5)]}, None for images scored without Wikipedia pages
+            entry['distribution'] = {i[0]: i[3] if len(i) > 3 else None for i in a}
+        SCORES.append(entry)
     
-    # Use model_name in output filename
-    output_filename = f'1-5_scores_VLM_{model_name}.pkl'
-    save_pickle(Path(OUTPUT_PATH) / f'{args.timestamp}' / output_filename, SCORES, "1-5 scores")
\ No newline at end of file
+    if persist:
+        save_scores(args, model_name, SCORES)
+
+    return SCORES
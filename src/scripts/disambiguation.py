@@ -1,72 +1,128 @@
 import pickle
 import numpy as np
 from tqdm import tqdm
-import torch
-from src.utils import save_pickle
-from src.config import OUTPUT_PATH, DATA_PATH, LEMMA_EMBEDS
+from src.config import DATA_PATH, LEMMA_EMBEDS, LEMMA_MATCH_BATCH_SIZE, LEMMA_TOP_K
+from src.stores.lemma_store import get_lemma_store
+from src.scripts.stages import LemmaResult, load_retrieval, save_lemmas
 import logging
 from pathlib import Path
 
-def lemma_match(args):
+def candidate_bids(neighbors):
+    """Unique BabelNet ids over an image's retrieved neighbours, in first-seen order"""
+    return list(dict.fromkeys(bid for k in neighbors for bid in k[0]))
 
-    image_paths = sorted(args.image_paths)
-
-    with open(Path(OUTPUT_PATH) / f"{args.timestamp}" / "image_embeddings.pkl", "rb") as f:
-        image_embeddings = pickle.load(f)
+def load_lemma_matrix(bids):
+    """
+    Gather lemma embeddings for bids into a contiguous float32 matrix.
 
-    with open(Path(OUTPUT_PATH) / f"{args.timestamp}" / "bids_match.pkl", "rb") as f:
-        bids_match = pickle.load(f)
+    Returns:
+        (matrix, bid_index) where bid_index maps each bid found to its row in matrix.
+        Bids without an embedding are left out of bid_index.
+    """
+    # Prefer the memory-mapped store, which reads only the rows needed
+    store = get_lemma_store()
+    if store is not None:
+        return store.gather(bids)
 
+    logging.warning(f"Lemma store not found, loading {LEMMA_EMBEDS}. Build it with: python -m src.stores.lemma_store")
     with open(Path(DATA_PATH) / LEMMA_EMBEDS, "rb") as f:
         lemma_embeds = pickle.load(f)
 
-    LEMMA_RESULTS = []
-
-    for i in tqdm(range(len(image_paths))):
-        try:
-            filename = image_paths[i]
-
-            zimg = np.array(image_embeddings[filename])
-            zimg = np.expand_dims(zimg, axis=0)
-
-            bids = []
-            for k in bids_match[i]:
-                bids.extend(k[0])
-            bids = list(set(bids))
-
-            final_results_lemma = []
-            batch_size = 64
-            num_batches = (len(bids) + batch_size - 1) // batch_size
-
-            for batch_idx in range(num_batches):
-                bids_batch = bids[batch_idx * batch_size:(batch_idx + 1) * batch_size]
-
-                ztxt = np.array([lemma_embeds[bid] for bid in bids_batch])
-
-                # Compute sigmoid of dot products
-                scores = zimg @ ztxt.T
-                probs = 1.0 / (1.0 + np.exp(-scores))
-
-                # Collect sorted results for this image
-                for prob_vector in probs:
-                    result = [
-                        {"score": float(score), "bid": bid}
-                        for score, bid in sorted(
-                            zip(prob_vector, bids_batch), key=lambda x: -x[0]
-                        )
-                    ]
-                    final_results_lemma.extend(result)
-
-            torch.cuda.empty_cache()
-            
-            final_results_lemma = sorted(final_results_lemma, key=lambda x: -x["score"])
-            LEMMA_RESULTS.append(final_results_lemma)
-
-        except Exception as e:
-            logging.error(f"Error for image {image_paths[i]}: {e}", exc_info=True)
+    found = [bid for bid in bids if bid in lemma_embeds]
+    matrix = np.ascontiguousarray([lemma_embeds[bid] for bid in found], dtype=np.float32)
+    return matrix, {bid: row for row, bid in enumerate(found)}
+
+def rank_lemmas(zimg, candidate_rows, lemma_matrix, lemma_bids, top_k=None):
+    """
+    Rank each image's candidate lemmas by sigmoid(image · lemma) in one matrix product.
+
+    Args:
+        zimg: (num_images, dim) image embeddings
+        candidate_rows: Per image, the rows of lemma_matrix holding its candidate bids
+        lemma_matrix: (num_lemmas, dim) lemma embeddings
+        lemma_bids: Bid stored in each row of lemma_matrix
+        top_k: Keep only the k best lemmas per image (None keeps every candidate)
+
+    Returns:
+        Per image, a list of {"score", "bid"} dicts sorted by descending score
+    """
+    lengths = np.array([len(c) for c in candidate_rows], dtype=np.int64)
+    if lengths.sum() == 0:
+        return [[] for _ in candidate_rows]
+
+    rows = np.concatenate([np.asarray(c, dtype=np.int64) for c in candidate_rows])
+
+    # Restrict the product to the lemmas this block actually needs
+    block_rows, local_cols = np.unique(rows, return_inverse=True)
+    scores = zimg @ lemma_matrix[block_rows].T
+
+    # Non-candidate (image, lemma) pairs must never be selected
+    image_ids = np.repeat(np.arange(len(candidate_rows)), lengths)
+    masked = np.full_like(scores, -np.inf)
+    masked[image_ids, local_cols] = scores[image_ids, local_cols]
+
+    k = int(lengths.max()) if top_k is None else min(top_k, int(lengths.max()))
+    if k < masked.shape[1]:
+        top = np.argpartition(-masked, k - 1, axis=1)[:, :k]
+    else:
+        top = np.tile(np.arange(masked.shape[1]), (len(candidate_rows), 1))
+    top_scores = np.take_along_axis(masked, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+    with np.errstate(over="ignore"):
+        probs = 1.0 / (1.0 + np.exp(-top_scores))
+
+    block_bids = [lemma_bids[row] for row in block_rows]
+
+    results = []
+    for i, n in enumerate(np.minimum(lengths, k)):
+        results.append([
+            {"score": float(score), "bid": block_bids[col]}
+            for score, col in zip(probs[i, :n], top[i, :n])
+        ])
+    return results
+
+def lemma_match(args, retrieval=None, persist=True):
+    """
+    Rank each image's candidate lemmas against its embedding.
+
+    Takes process_images' RetrievalResult, or reads it from the run directory if None.
+    Returns a LemmaResult for wiki_retrieval; with persist it is also written to lemma_match.pkl.
+    """
+    image_paths = sorted(args.image_paths)
 
-    save_pickle(
-        Path(OUTPUT_PATH) / f"{args.timestamp}" / "lemma_match.pkl",
-        LEMMA_RESULTS,
-        "Lemma matching results"
-    )
+    if retrieval is None:
+        retrieval = load_retrieval(args)
+    image_embeddings = retrieval.embeddings
+    bids_match = retrieval.bids
+
+    candidates = [candidate_bids(neighbors) for neighbors in bids_match]
+    lemma_matrix, bid_index = load_lemma_matrix(list(dict.fromkeys(bid for c in candidates for bid in c)))
+
+    missing = sum(bid not in bid_index for c in candidates for bid in c)
+    if missing:
+        logging.warning(f"{missing} candidate bids have no lemma embedding and were skipped")
+    candidate_rows = [[bid_index[bid] for bid in c if bid in bid_index] for c in candidates]
+    lemma_bids = list(bid_index)
+
+    LEMMA_RESULTS = [[] for _ in image_paths]
+    valid = []
+    for i, filename in enumerate(image_paths):
+        if filename in image_embeddings and i < len(candidate_rows):
+            valid.append(i)
+        else:
+            logging.error(f"No retrieval results for image {filename}, skipping lemma matching")
+
+    for start in tqdm(range(0, len(valid), LEMMA_MATCH_BATCH_SIZE), desc="Lemma matching"):
+        block = valid[start:start + LEMMA_MATCH_BATCH_SIZE]
+        zimg = np.stack([image_embeddings[image_paths[i]] for i in block]).astype(np.float32)
+        ranked = rank_lemmas(zimg, [candidate_rows[i] for i in block], lemma_matrix, lemma_bids, LEMMA_TOP_K)
+        for i, result in zip(block, ranked):
+            LEMMA_RESULTS[i] = result
+
+    result = LemmaResult(LEMMA_RESULTS)
+    if persist:
+        save_lemmas(args, result)
+    return result
@@ -1,112 +1,201 @@
 import pickle
-import random
-import wikipediaapi
+import asyncio
 from tqdm import tqdm
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
-from src.config import OUTPUT_PATH, DATA_PATH, BABELNET_WIKI
-from src.utils import save_pickle
+from src.config import DATA_PATH, BABELNET_WIKI, WIKI_IMAGE_DEADLINE_S, WIKI_PREFETCH_BIDS, WIKI_BACKEND, WIKI_CONCURRENT_IMAGES
+from src.stores.babelnet_store import get_babelnet_store
+from src.stores.wiki_snapshot import WikiSnapshotClient
+from src.scripts.wiki_client import AsyncWikipediaClient, run_async
+from src.scripts.stages import WikiResult, load_lemmas, save_wiki
 import logging
 
-logging.getLogger("wikipediaapi").setLevel(logging.CRITICAL)
-USER_AGENTS = [
-    "MyPythonScript/1.0 (contact@example.com)",
-    "MyPythonScript/2.0 (contact2@example.com)",
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.3 Safari/605.1.15",
-]
+async def get_en_pages(client, titles, fields=None, max_chars=None):
+    return await client.first_page([title for title, lang in titles if lang == 'EN'], fields=fields, max_chars=max_chars)
 
-def toeng(language, page_title):
-    user_agent = random.choice(USER_AGENTS)
-    try:
-        wiki = wikipediaapi.Wikipedia(language=language, user_agent=user_agent)
-        page = wiki.page(page_title)
-        if page.exists():
-            if language != 'en':
-                lang_links = page.langlinks
-                if 'en' in lang_links:
-                    return lang_links['en'].title
-        return False
-    except:
-        return False
-
-def fetch_wikipedia_page(page_title):
+async def get_non_en_pages(client, titles, fields=None, max_chars=None):
+    non_en = [(title, lang.lower()) for title, lang in titles if lang != 'EN']
+
+    # One batched langlink query per language
+    by_lang = {}
+    for title, lang in non_en:
+        by_lang.setdefault(lang, []).append(title)
+    resolved = await asyncio.gather(*(client.resolve_langlinks(lang, lang_titles) for lang, lang_titles in by_lang.items()))
+    translations = dict(zip(by_lang, resolved))
+
+    translated = [translations[lang][title] for title, lang in non_en if translations[lang].get(title)]
+    return await client.first_page(list(dict.fromkeys(translated)), fields=fields, max_chars=max_chars)
+
+async def resolve_bid(client, bid, babelnet_dict, fields=None, max_chars=None):
+    """Return the first usable page for a bid, trying English titles before langlinks"""
     try:
-        user_agent = random.choice(USER_AGENTS)
-        wiki = wikipediaapi.Wikipedia(language='en', user_agent=user_agent)
-        page = wiki.page(page_title)
-        return {
-            "title": page.title,
-            "summary": page.summary,
-            "page_id": page.pageid,
-            "text": page.text,
-            "categories": list(page.categories.keys()),
-            "sections": [section.title for section in page.sections]
-        }
-    except:
-        return {'text': ""}
-
-def get_wiki_page(title):
-    p = fetch_wikipedia_page(title)
-    return p if p and len(p['text']) > 10 else None
-
-def get_en_pages(titles):
-    for title, lang in titles:
-        if lang == 'EN':
-            p = get_wiki_page(title)
-            if p:
-                return p
-    return None
-
-def get_non_en_pages(titles):
-    for title, lang in titles:
-        if lang != 'EN':
-            translated = toeng(lang.lower(), title)
-            if translated:
-                p = get_wiki_page(translated)
-                if p:
-                    return p
-    return None
-
-def process_group_bids(group_bids, babelnet_dict, max_docs):
+        wiki_direct, wiki_redirect = babelnet_dict[bid]
+        all_wiki = wiki_direct + wiki_redirect
+
+        p = await get_en_pages(client, all_wiki, fields, max_chars)
+        if p:
+            return p
+        return await get_non_en_pages(client, all_wiki, fields, max_chars)
+    except Exception:
+        return None
+
+class BidResolver:
+    """
+    Resolve each bid to its page at most once per batch.
+
+    Images sharing an entity await the same task, whether it is still in flight
+    or already finished. Tasks are shared, so callers must not cancel them; close()
+    cancels whatever is still pending once the batch is done.
+    """
+
+    def __init__(self, client, babelnet_dict, fields=None, max_chars=None):
+        self.client = client
+        self.babelnet_dict = babelnet_dict
+        self.fields = fields
+        self.max_chars = max_chars
+        self._tasks = {}
+        self.requests = 0
+
+    def resolve(self, bid):
+        """Return the task resolving bid, starting it on first request"""
+        self.requests += 1
+        task = self._tasks.get(bid)
+        if task is None:
+            task = asyncio.ensure_future(resolve_bid(self.client, bid, self.babelnet_dict, self.fields, self.max_chars))
+            self._tasks[bid] = task
+        return task
+
+    @property
+    def unique_bids(self):
+        return len(self._tasks)
+
+    def close(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+async def process_group_bids(resolver, group_bids, max_docs, deadline_s=WIKI_IMAGE_DEADLINE_S, prefetch=WIKI_PREFETCH_BIDS):
+    """
+    Collect up to max_docs pages for one image, in lemma rank order.
+
+    The next prefetch bids are resolved speculatively while the current one is awaited.
+    Once deadline_s has elapsed the pages found so far are returned.
+
+    Returns:
+        (pages, skipped) where skipped lists the ranked bids left unresolved at the deadline,
+        prefetched or never started (as many as max_docs could still use)
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if deadline_s is None else loop.time() + deadline_s
+    tasks = {}
     group_pages = []
-    for bid in group_bids:
+    skipped = []
+    for i, bid in enumerate(group_bids):
         if len(group_pages) >= max_docs:
             break
 
-        try:
-            wiki_direct, wiki_redirect = babelnet_dict[bid]
-            all_wiki = wiki_direct + wiki_redirect
-
-            p = get_en_pages(all_wiki)
-            if p:
-                group_pages.append(p)
-                continue
+        for j in range(i, min(i + prefetch + 1, len(group_bids))):
+            if j not in tasks:
+                tasks[j] = resolver.resolve(group_bids[j])
 
-            p = get_non_en_pages(all_wiki)
-            if p:
-                group_pages.append(p)
-        except:
-            continue
-
-    return group_pages
-
-def wiki_retrieval(args, max_docs=10):
+        remaining = None if deadline is None else deadline - loop.time()
+        try:
+            if remaining is not None and remaining <= 0:
+                raise asyncio.TimeoutError
+            # Shielded so that timing out here leaves the lookup running for other images
+            p = await asyncio.wait_for(asyncio.shield(tasks[i]), remaining)
+        except asyncio.TimeoutError:
+            # Keep prefetched pages that already arrived, still in rank order
+            for j, task in sorted(tasks.items()):
+                if j < i:
+                    continue
+                if not task.done():
+                    skipped.append(group_bids[j])
+                elif task.result() and len(group_pages) < max_docs:
+                    group_pages.append(task.result())
+            # Ranked bids not started yet count as skipped too, as many as could still fill max_docs
+            unstarted = group_bids[max(tasks) + 1:]
+            skipped += unstarted[:max(0, max_docs - len(group_pages) - len(skipped))]
+            break
+        if p:
+            group_pages.append(p)
+
+    return group_pages, skipped
+
+def open_wiki_client(backend=WIKI_BACKEND):
+    """Return the Wikipedia client for backend: 'api' (live MediaWiki) or 'snapshot' (local dump import)"""
+    if backend == "snapshot":
+        return WikiSnapshotClient()
+    if backend == "api":
+        return AsyncWikipediaClient()
+    raise ValueError(f"Unknown Wikipedia backend: {backend}")
+
+async def retrieve_all(all_bids, babelnet_dict, max_docs, fields=None, max_chars=None, deadline_s=WIKI_IMAGE_DEADLINE_S, concurrent_images=WIKI_CONCURRENT_IMAGES):
+    """
+    Resolve every image's bid list over one shared Wikipedia client, concurrent_images at a time.
+    Bids shared between images are looked up once. Each image's deadline starts when it is
+    admitted, so images waiting their turn do not use up their latency budget in the queue.
+
+    Returns:
+        (pages, skipped) with one entry per image
+    """
+    async with open_wiki_client() as client:
+        resolver = BidResolver(client, babelnet_dict, fields, max_chars)
+        try:
+            admitted = asyncio.Semaphore(concurrent_images)
+            with tqdm(total=len(all_bids)) as pbar:
+                async def process(bid_group):
+                    async with admitted:
+                        result = await process_group_bids(resolver, bid_group, max_docs, deadline_s)
+                    pbar.update(1)
+                    return result
+
+                results = await asyncio.gather(*(process(bid_group) for bid_group in all_bids))
+        finally:
+            resolver.close()
+
+    logging.info(f"Resolved {resolver.unique_bids} unique bids for {resolver.requests} bid lookups")
+    return [pages for pages, _ in results], [skipped for _, skipped in results]
+
+def load_babelnet_dict():
+    """Return the indexed BabelNet -> Wikipedia store, falling back to unpickling the full dict"""
+    store = get_babelnet_store()
+    if store is not None:
+        return store
+
+    logging.warning(f"BabelNet store not found, loading {BABELNET_WIKI}. Build it with: python -m src.stores.babelnet_store")
     with open(Path(DATA_PATH) / BABELNET_WIKI, 'rb') as f:
-        babelnet_dict = pickle.load(f)
-
-    with open(Path(OUTPUT_PATH) / f'{args.timestamp}' / "lemma_match.pkl", 'rb') as f:   
-        y = pickle.load(f)
+        return pickle.load(f)
+
+def wiki_retrieval(args, max_docs=10, fields=None, max_chars=None, deadline_s=WIKI_IMAGE_DEADLINE_S, lemmas=None, persist=True):
+    """
+    Retrieve up to max_docs Wikipedia pages per image, following the lemma ranking.
+
+    Args:
+        fields: Page fields to fetch (None = all). Pass the scoring stage's WIKI_FIELDS to skip
+                summaries and categories
+        max_chars: Truncate page text to this many characters (None = full text)
+        deadline_s: Latency budget per image in seconds (None = wait for every lookup).
+                    Bids left unresolved are listed in the result's skipped bids
+        lemmas: lemma_match's LemmaResult, or None to read it from the run directory
+        persist: Also write the result to the run directory (WIKI.pkl, wiki_skipped_bids.pkl)
+
+    Returns:
+        A WikiResult for scoring
+    """
+    babelnet_dict = load_babelnet_dict()
+
+    if lemmas is None:
+        lemmas = load_lemmas(args)
+    y = lemmas.matches
 
     all_bids = [[j['bid'] for j in i] for i in y[:]]
 
-    def process(bid_group):
-        return process_group_bids(bid_group, babelnet_dict, max_docs)
+    outputs, skipped = run_async(retrieve_all(all_bids, babelnet_dict, max_docs, fields, max_chars, deadline_s))
 
-    with ThreadPoolExecutor(max_workers=16) as executor:
-        outputs = list(tqdm(
-            executor.map(process, all_bids),
-            total=len(all_bids)
-        ))
+    late = sum(bool(s) for s in skipped)
+    if late:
+        logging.warning(f"Wikipedia deadline of {deadline_s}s reached for {late} images, returning the pages found so far")
 
-    save_pickle(Path(OUTPUT_PATH) / f"{args.timestamp}" / "WIKI.pkl", outputs, "Wikipedia content")
+    result = WikiResult(outputs, skipped)
+    if persist:
+        save_wiki(args, result)
+    return result
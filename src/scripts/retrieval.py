@@ -1,28 +1,83 @@
 import numpy as np
 import logging
+import functools
 from tqdm import tqdm
-from PIL import Image, ImageFile
 import torch
 from pathlib import Path
-from src.utils import load_faiss_index, load_index_info, save_pickle
-from src.config import RETRIEVAL_BATCH_SIZE, NUMBER_RETRIEVED_IMAGES, DATA_PATH, OUTPUT_PATH, INDEX_INFOS, FAISS_INDICES
-
-ImageFile.LOAD_TRUNCATED_IMAGES = True 
-
-def process_images(args, model, processor):
-
-    model.to('cuda')
-
-    index_info_path = Path(DATA_PATH) / INDEX_INFOS
-    faiss_index_path = Path(DATA_PATH) / FAISS_INDICES
-    
-    urls, ids = load_index_info(index_info_path)
-    ind = load_faiss_index(faiss_index_path)
+from src.utils import load_model, load_faiss_index, load_index_info
+from src.image_handle import ImageHandle, image_handles
+from src.scripts.stages import RetrievalResult, save_retrieval
+from src.stores.index_store import open_index_info_store
+from src.config import RETRIEVAL_BATCH_SIZE, NUMBER_RETRIEVED_IMAGES, DATA_PATH, INDEX_INFOS, FAISS_INDICES, FAISS_USE_MMAP, KEEP_DECODED_IMAGES
+
+class RetrievalContext:
+    """
+    Long-lived retrieval state, loaded once per process: the SigLIP encoder on its
+    device, the FAISS index, and the URL / BabelNet id tables of the indexed images.
+
+    Args:
+        model, processor: SigLIP model and processor. Loaded with load_model() if not given
+        use_mmap: Open the FAISS index memory-mapped so worker processes share its pages
+    """
+
+    def __init__(self, model=None, processor=None, use_mmap=FAISS_USE_MMAP):
+        if model is None or processor is None:
+            model, processor = load_model()
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model = model.to(self.device).eval()
+        self.processor = processor
+
+        store = open_index_info_store()
+        if store is not None:
+            # Memory-mapped columns, decoded only for the neighbours that are looked up
+            self.urls, self.ids = store.urls, store.ids
+        else:
+            logging.warning(f"Index info store not found, loading {INDEX_INFOS}. Build it with: python -m src.stores.index_store")
+            self.urls, self.ids = load_index_info(Path(DATA_PATH) / INDEX_INFOS)
+        self.index = load_faiss_index(Path(DATA_PATH) / FAISS_INDICES, mmap=use_mmap)
+        if self.index is None or self.urls is None:
+            raise RuntimeError("Failed to load the retrieval index")
+
+    def encode(self, images):
+        """Return L2-normalized SigLIP embeddings of a list of ImageHandles or PIL images as a float32 array"""
+        handles = [image if isinstance(image, ImageHandle) else ImageHandle(image=image) for image in images]
+        pixel_values = torch.cat([handle.siglip_pixels(self.processor) for handle in handles]).to(self.device)
+
+        with torch.no_grad():
+            raw = self.model.vision_model(pixel_values=pixel_values).pooler_output
+            zimg = torch.nn.functional.normalize(raw, dim=-1)
+
+        return zimg.cpu().numpy()
+
+    def search(self, zimg, retrieval_count=NUMBER_RETRIEVED_IMAGES):
+        """Return, per embedding, its nearest neighbours as [babelnet_ids, distance, url]"""
+        distances, indices = self.index.search(zimg, retrieval_count)
+        return [
+            [[self.ids[i_val], d_val, self.urls[i_val]] for d_val, i_val in zip(distances[j], indices[j])]
+            for j in range(len(zimg))
+        ]
+
+@functools.lru_cache(maxsize=1)
+def get_retrieval_context():
+    """Process-wide RetrievalContext shared by the CLI and the API pipeline"""
+    return RetrievalContext()
+
+def process_images(args, context=None, persist=True):
+    """
+    Encode the images and search the FAISS index for their nearest neighbours.
+
+    Returns a RetrievalResult for lemma_match. With persist, it is also written to the
+    run directory (bids_match.pkl, image_embeddings.pkl).
+    """
+    if context is None:
+        context = get_retrieval_context()
 
     image_paths = sorted(args.image_paths)
+    handles = image_handles(args)
+    # Small runs keep the decoded images for scoring; large ones keep only their digests
+    release = len(image_paths) > KEEP_DECODED_IMAGES
 
     batch_size = RETRIEVAL_BATCH_SIZE   
-    retrieval_count = NUMBER_RETRIEVED_IMAGES  # Number of entities to retrieve
     bids = []
     image_embeddings = {}
 
@@ -30,27 +85,19 @@ def process_images(args, model, processor):
         batch_paths = image_paths[i:i + batch_size]
 
         try:
-            images = [Image.open(filename).convert("RGB") for filename in batch_paths]
-
-            inputs = processor(images=images, return_tensors="pt")
-            inputs = {k: v.to("cuda") for k, v in inputs.items()}
-
-            with torch.no_grad():
-                raw = model.vision_model(**inputs).pooler_output
-                zimg = torch.nn.functional.normalize(raw, dim=-1)
+            images = [handles[filename] for filename in batch_paths]
 
-            zimg = zimg.cpu().numpy()
+            zimg = context.encode(images)
 
             # FAISS search
-            distances, indices = ind.search(zimg, retrieval_count)
-            for j, filename in enumerate(batch_paths):
+            for j, (filename, nearest_neighbors) in enumerate(zip(batch_paths, context.search(zimg))):
                 image_embeddings[filename] = zimg[j]
-                nearest_neighbors = [
-                    [ids[i_val], d_val, urls[i_val]] for d_val, i_val in zip(distances[j], indices[j])
-                ]
                 bids.append(nearest_neighbors)
 
-            del images, zimg, distances, indices
+            if release:
+                for image in images:
+                    image.release()
+            del images, zimg
 
             if i % (batch_size * 10) == 0:
                 torch.cuda.empty_cache()
@@ -58,5 +105,7 @@ def process_images(args, model, processor):
         except Exception as e:
             logging.error(f"Error processing batch {i // batch_size}: {e}", exc_info=True)
 
-    save_pickle(Path(OUTPUT_PATH) / f"{args.timestamp}" / "bids_match.pkl", bids, "Bids match data")
-    save_pickle(Path(OUTPUT_PATH) / f"{args.timestamp}" / "image_embeddings.pkl", image_embeddings, "Image embeddings")
\ No newline at end of file
+    result = RetrievalResult(bids, image_embeddings)
+    if persist:
+        save_retrieval(args, result)
+    return result
@@ -0,0 +1,69 @@
+import pickle
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List
+from src.utils import save_pickle
+from src.config import OUTPUT_PATH
+
+# Files a run directory holds for each stage, read back when a stage is run without its input in memory
+BIDS_FILE = "bids_match.pkl"
+EMBEDDINGS_FILE = "image_embeddings.pkl"
+LEMMA_FILE = "lemma_match.pkl"
+WIKI_FILE = "WIKI.pkl"
+WIKI_SKIPPED_FILE = "wiki_skipped_bids.pkl"
+
+@dataclass
+class RetrievalResult:
+    """process_images output: per image, in sorted path order, its nearest neighbours and SigLIP embedding"""
+    bids: List[List[list]]  # [babelnet_ids, distance, url] per neighbour
+    embeddings: Dict[Any, Any]  # image path -> embedding
+
+@dataclass
+class LemmaResult:
+    """lemma_match output: per image, its candidate lemmas as {'score', 'bid'}, best first"""
+    matches: List[List[Dict[str, Any]]]
+
+@dataclass
+class WikiResult:
+    """wiki_retrieval output: per image, its Wikipedia pages and the bids left unresolved at the deadline"""
+    pages: List[List[Dict[str, Any]]]
+    skipped: List[List[str]]
+
+def run_dir(args) -> Path:
+    return Path(OUTPUT_PATH) / f"{args.timestamp}"
+
+def _load(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+def save_retrieval(args, result: RetrievalResult):
+    save_pickle(run_dir(args) / BIDS_FILE, result.bids, "Bids match data")
+    save_pickle(run_dir(args) / EMBEDDINGS_FILE, result.embeddings, "Image embeddings")
+
+def load_retrieval(args) -> RetrievalResult:
+    return RetrievalResult(_load(run_dir(args) / BIDS_FILE), _load(run_dir(args) / EMBEDDINGS_FILE))
+
+def save_lemmas(args, result: LemmaResult):
+    save_pickle(run_dir(args) / LEMMA_FILE, result.matches, "Lemma matching results")
+
+def load_lemmas(args) -> LemmaResult:
+    return LemmaResult(_load(run_dir(args) / LEMMA_FILE))
+
+def save_wiki(args, result: WikiResult):
+    save_pickle(run_dir(args) / WIKI_FILE, result.pages, "Wikipedia content")
+    save_pickle(run_dir(args) / WIKI_SKIPPED_FILE, result.skipped, "Skipped Wikipedia bids")
+
+def load_wiki(args) -> WikiResult:
+    skipped_path = run_dir(args) / WIKI_SKIPPED_FILE
+    pages = _load(run_dir(args) / WIKI_FILE)
+    # Runs from before the Wikipedia deadline have no skipped bids file
+    return WikiResult(pages, _load(skipped_path) if skipped_path.exists() else [[] for _ in pages])
+
+def scores_file(model_name) -> str:
+    return f"1-5_scores_VLM_{model_name}.pkl"
+
+def save_scores(args, model_name, scores):
+    save_pickle(run_dir(args) / scores_file(model_name), scores, "1-5 scores")
+
+def load_scores(args, model_name):
+    return _load(run_dir(args) / scores_file(model_name))
@@ -0,0 +1,361 @@
+import re
+import asyncio
+import logging
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from src.config import (
+    WIKI_API_URL, WIKI_USER_AGENT, WIKI_MAX_CONCURRENCY, WIKI_OFFLINE,
+    WIKI_REQUEST_TIMEOUT_S, WIKI_HEDGE_DELAY_S, WIKI_MAX_RETRIES
+)
+from src.stores.wiki_cache import get_wiki_cache, MISS
+
+# MediaWiki accepts at most 50 titles per query for anonymous clients
+TITLES_PER_QUERY = 50
+# A page needs more text than this to be used as scoring context
+MIN_PAGE_CHARS = 10
+# Base delay of the exponential backoff between retries
+RETRY_BACKOFF_S = 0.5
+
+HEADING = re.compile(r"^(=+)\s*(.*?)\s*\1\s*$", re.MULTILINE)
+
+PAGE_FIELDS = ("title", "summary", "page_id", "text", "categories", "sections")
+
+def run_async(coro):
+    """Run a coroutine to completion, also from threads that already run an event loop"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+def parse_extract(title, page_id, extract, categories):
+    """Build a page dict from a plain-text extract with '== Heading ==' section markers"""
+    headings = list(HEADING.finditer(extract))
+    summary = extract[:headings[0].start()].strip() if headings else extract.strip()
+    return {
+        "title": title,
+        "summary": summary,
+        "page_id": page_id,
+        "text": HEADING.sub(lambda m: m.group(2), extract).strip(),
+        "categories": categories,
+        "sections": [m.group(2) for m in headings if len(m.group(1)) == 2]
+    }
+
+def select_fields(page, fields=None, max_chars=None):
+    """Restrict a page dict to the requested fields (always keeping 'text') and truncate its text"""
+    if page is None:
+        return None
+    selected = {k: v for k, v in page.items() if not k.startswith("_") and (fields is None or k in fields or k == "text")}
+    if max_chars is not None and "text" in selected:
+        selected["text"] = selected["text"][:max_chars]
+    return selected
+
+class AsyncWikipediaClient:
+    """
+    Asyncio MediaWiki client with one shared connection pool and bounded concurrency.
+
+    Page metadata and langlinks are fetched with batched multi-title queries
+    (titles=A|B|C). Full-text extracts are fetched one title per request, since
+    MediaWiki only returns several extracts per query for intros. All lookups
+    read through the persistent WikiPageCache, and offline mode serves from it alone.
+
+    Every request has a timeout. A request that has not answered after the hedge
+    delay gets a duplicate, and the first response wins. Timeouts, connection errors,
+    429 and 5xx responses are retried with exponential backoff.
+
+    Use as an async context manager:
+
+        async with AsyncWikipediaClient() as client:
+            page = await client.first_page(["Djembe"])
+
+    Args:
+        api_url: MediaWiki endpoint template with a {lang} placeholder
+        user_agent: User-Agent header sent with every request
+        max_concurrency: Maximum number of requests in flight
+        offline: Serve lookups from the cache only
+        request_timeout: Timeout of a single request in seconds
+        hedge_delay: Seconds before a duplicate request is sent (None disables hedging)
+        max_retries: Retries after a retryable failure
+    """
+
+    def __init__(self, api_url=WIKI_API_URL, user_agent=WIKI_USER_AGENT, max_concurrency=WIKI_MAX_CONCURRENCY, offline=WIKI_OFFLINE,
+                 request_timeout=WIKI_REQUEST_TIMEOUT_S, hedge_delay=WIKI_HEDGE_DELAY_S, max_retries=WIKI_MAX_RETRIES):
+        self.api_url = api_url
+        self.user_agent = user_agent
+        self.max_concurrency = max_concurrency
+        self.offline = offline
+        self.request_timeout = request_timeout
+        self.hedge_delay = hedge_delay
+        self.max_retries = max_retries
+        self.cache = get_wiki_cache()
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+            headers={"User-Agent": self.user_agent}
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    async def _get(self, lang, params):
+        url = self.api_url.format(lang=lang)
+        params = {"action": "query", "format": "json", "formatversion": "2", "redirects": "1", **params}
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._hedged_request(url, params)
+            except aiohttp.ClientResponseError as e:
+                if e.status != 429 and e.status < 500 or attempt == self.max_retries:
+                    raise
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                if attempt == self.max_retries:
+                    raise
+            await asyncio.sleep(RETRY_BACKOFF_S * 2 ** attempt)
+
+    async def _request(self, url, params, sent=None):
+        async with self._semaphore:
+            if sent is not None:
+                sent.set()
+            timeout = aiohttp.ClientTimeout(total=self.request_timeout)
+            async with self._session.get(url, params=params, timeout=timeout) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+    async def _hedged_request(self, url, params):
+        """
+        Send a request, and a duplicate if the first is still pending after the hedge delay.
+
+        The delay starts once the first request holds a connection slot, not while it waits
+        for one, and no duplicate is sent while every slot is taken.
+        """
+        if self.hedge_delay is None:
+            return await self._request(url, params)
+
+        sent = asyncio.Event()
+        pending = {asyncio.ensure_future(self._request(url, params, sent))}
+        try:
+            waiter = asyncio.ensure_future(sent.wait())
+            await asyncio.wait(pending | {waiter}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_delay)
+            if not done and not self._semaphore.locked():
+                pending.add(asyncio.ensure_future(self._request(url, params)))
+            error = None
+            while done or pending:
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _query_titles(self, lang, titles, params):
+        """
+        Run a multi-title query in chunks, following continuation.
+
+        Returns:
+            Dict of requested title -> page object (None if the page does not exist)
+        """
+        results = {}
+        for start in range(0, len(titles), TITLES_PER_QUERY):
+            chunk = titles[start:start + TITLES_PER_QUERY]
+            pages = {}
+            aliases = {}
+            cont = {}
+            while True:
+                data = await self._get(lang, {**params, "titles": "|".join(chunk), **cont})
+                query = data.get("query", {})
+                for entry in query.get("normalized", []) + query.get("redirects", []):
+                    aliases[entry["from"]] = entry["to"]
+                for page in query.get("pages", []):
+                    merged = pages.setdefault(page["title"], page)
+                    if merged is not page:
+                        # Continued responses carry further items of list properties
+                        for key in ("categories", "langlinks"):
+                            merged.setdefault(key, []).extend(page.get(key, []))
+                if "continue" not in data:
+                    break
+                cont = data["continue"]
+
+            for title in chunk:
+                resolved = title
+                for _ in range(2):  # normalization, then redirect
+                    resolved = aliases.get(resolved, resolved)
+                page = pages.get(resolved)
+                results[title] = None if page is None or page.get("missing") or page.get("invalid") else page
+        return results
+
+    async def _fetch_extract(self, lang, title):
+        """Return the extract query's page object for title, or None if the page does not exist"""
+        data = await self._get(lang, {"prop": "extracts", "explaintext": "1", "exsectionformat": "wiki", "titles": title})
+        pages = data.get("query", {}).get("pages", [])
+        if not pages or pages[0].get("missing") or pages[0].get("invalid"):
+            return None
+        return pages[0]
+
+    def _cached_page(self, lang, title, fields, max_chars):
+        """Return a cached page that covers the requested fields and character budget, or MISS"""
+        if self.cache is None:
+            return MISS
+        page = self.cache.get_page(lang, title, allow_stale=self.offline)
+        if page is MISS or not page.get("text"):
+            # Missing pages are cached as empty text and satisfy any request
+            return page
+        if any(field not in page for field in fields or PAGE_FIELDS):
+            return MISS
+        cached_chars = page.get("_chars")
+        if cached_chars is not None and (max_chars is None or cached_chars < max_chars):
+            return MISS
+        return page
+
+    async def _fetch_selective(self, lang, title, max_chars):
+        """Fetch a page with a single extract request, skipping the categories query"""
+        try:
+            info = await self._fetch_extract(lang, title)
+        except Exception as e:
+            logging.debug(f"Wikipedia extract for '{title}' failed: {e}")
+            return None
+        if info is None:
+            return {"title": title, "text": ""}
+        page = parse_extract(info["title"], info.get("pageid"), info.get("extract", ""), [])
+        del page["categories"]
+        if max_chars is not None:
+            page["text"] = page["text"][:max_chars]
+            # Budget the cached text was cut to, so larger budgets refetch
+            page["_chars"] = max_chars
+        return page
+
+    async def fetch_pages(self, titles, lang="en", fields=None, max_chars=None):
+        """
+        Fetch pages for titles, preserving order.
+
+        With all fields, metadata and categories for the uncached titles come from
+        batched queries, and text extracts are fetched concurrently for the pages
+        that exist. If 'categories' is not requested, each page costs a single
+        extract request.
+
+        Args:
+            fields: Page fields to return (None = all of PAGE_FIELDS). 'text' is always included
+            max_chars: Truncate page text to this many characters (None = full text)
+
+        Returns:
+            List of page dicts; missing pages have empty 'text', failed lookups are None
+        """
+        results = {}
+        misses = []
+        for title in dict.fromkeys(titles):
+            cached = self._cached_page(lang, title, fields, max_chars)
+            if cached is not MISS:
+                results[title] = cached
+            elif self.offline:
+                results[title] = {"text": ""}
+            else:
+                misses.append(title)
+
+        if misses and fields is not None and "categories" not in fields:
+            fetched = await asyncio.gather(*(self._fetch_selective(lang, title, max_chars) for title in misses))
+            for title, page in zip(misses, fetched):
+                results[title] = page
+                if page is not None and self.cache is not None:
+                    self.cache.put_page(lang, title, page)
+
+        elif misses:
+            try:
+                infos = await self._query_titles(lang, misses, {"prop": "info|categories", "cllimit": "max"})
+            except Exception as e:
+                logging.debug(f"Wikipedia page query failed: {e}")
+                infos = {}
+
+            async def fetch(info):
+                try:
+                    extract = (await self._fetch_extract(lang, info["title"]) or {}).get("extract", "")
+                except Exception as e:
+                    logging.debug(f"Wikipedia extract for '{info['title']}' failed: {e}")
+                    return None
+                categories = [c["title"] for c in info.get("categories", [])]
+                return parse_extract(info["title"], info.get("pageid"), extract, categories)
+
+            # Titles redirecting to the same page share one extract request
+            resolved = {}
+            for title in misses:
+                if infos.get(title) is not None:
+                    resolved.setdefault(infos[title]["title"], infos[title])
+            extracts = dict(zip(resolved, await asyncio.gather(*(fetch(info) for info in resolved.values()))))
+
+            for title in misses:
+                if title not in infos:
+                    page = None
+                elif infos[title] is None:
+                    page = {"title": title, "text": ""}
+                else:
+                    page = extracts[infos[title]["title"]]
+                results[title] = page
+                # Network failures are not cached
+                if page is not None and self.cache is not None:
+                    self.cache.put_page(lang, title, page)
+
+        return [select_fields(results[title], fields, max_chars) for title in titles]
+
+    async def first_page(self, titles, lang="en", fields=None, max_chars=None):
+        """
+        Return the first page among titles with usable text, or None.
+
+        In field-selective mode titles are fetched one at a time and the search
+        stops at the first usable page, so later titles cost no requests.
+        """
+        if fields is not None and "categories" not in fields:
+            for title in titles:
+                page = (await self.fetch_pages([title], lang, fields, max_chars))[0]
+                if page and len(page.get("text", "")) > MIN_PAGE_CHARS:
+                    return page
+            return None
+
+        for page in await self.fetch_pages(titles, lang, fields, max_chars):
+            if page and len(page.get("text", "")) > MIN_PAGE_CHARS:
+                return page
+        return None
+
+    async def resolve_langlinks(self, lang, titles):
+        """
+        Resolve the English titles that pages in another language link to, in batched queries.
+
+        Returns:
+            Dict of title -> English title, or None if the page has no English counterpart
+        """
+        results = {}
+        misses = []
+        for title in dict.fromkeys(titles):
+            cached = self.cache.get_langlink(lang, title, allow_stale=self.offline) if self.cache is not None else MISS
+            if cached is not MISS:
+                results[title] = cached
+            elif self.offline:
+                results[title] = None
+            else:
+                misses.append(title)
+
+        if misses:
+            try:
+                pages = await self._query_titles(lang, misses, {"prop": "langlinks", "lllang": "en", "lllimit": "max"})
+            except Exception as e:
+                logging.debug(f"Wikipedia langlink query failed: {e}")
+                pages = {}
+            for title in misses:
+                if title not in pages:
+                    results[title] = None
+                    continue
+                links = (pages[title] or {}).get("langlinks", [])
+                results[title] = links[0]["title"] if links else None
+                if self.cache is not None:
+                    self.cache.put_langlink(lang, title, results[title])
+
+        return results
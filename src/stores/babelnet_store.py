@@ -0,0 +1,111 @@
+import os
+import json
+import pickle
+import sqlite3
+import logging
+import argparse
+import functools
+import threading
+from pathlib import Path
+from src.config import DATA_PATH, BABELNET_WIKI, BABELNET_WIKI_DB
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+class BabelNetWikiStore:
+    """
+    Read-only SQLite lookup of bid -> (wiki_direct, wiki_redirect).
+
+    Drop-in replacement for the babelnet_source_dict.pkl dict: supports `store[bid]`
+    (raising KeyError), `get` and `in`. Each thread gets its own connection. The
+    database is memory-mapped, so server workers share its pages through the OS page cache.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size={os.path.getsize(self.db_path)}")
+            self._local.conn = conn
+        return conn
+
+    def __getitem__(self, bid):
+        row = self._connection().execute(
+            "SELECT direct, redirect FROM babelnet_wiki WHERE bid = ?", (bid,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(bid)
+        return json.loads(row[0]), json.loads(row[1])
+
+    def get(self, bid, default=None):
+        try:
+            return self[bid]
+        except KeyError:
+            return default
+
+    def __contains__(self, bid):
+        return self._connection().execute(
+            "SELECT 1 FROM babelnet_wiki WHERE bid = ?", (bid,)
+        ).fetchone() is not None
+
+    def values(self):
+        """Iterate over every (wiki_direct, wiki_redirect) entry"""
+        for direct, redirect in self._connection().execute("SELECT direct, redirect FROM babelnet_wiki"):
+            yield json.loads(direct), json.loads(redirect)
+
+@functools.lru_cache(maxsize=1)
+def get_babelnet_store():
+    """Open the BabelNet -> Wikipedia store once per process, or return None if it has not been built"""
+    db_path = Path(DATA_PATH) / BABELNET_WIKI_DB
+    if not db_path.exists():
+        return None
+    return BabelNetWikiStore(db_path)
+
+def build_babelnet_store(pickle_path=None, data_path=DATA_PATH, batch_size=50000):
+    """Convert the babelnet_source_dict.pkl dict into a BabelNetWikiStore database"""
+    pickle_path = Path(pickle_path or Path(data_path) / BABELNET_WIKI)
+    db_path = Path(data_path) / BABELNET_WIKI_DB
+    tmp_path = db_path.with_suffix(".tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    logging.info(f"Loading {pickle_path}...")
+    with open(pickle_path, "rb") as f:
+        babelnet_dict = pickle.load(f)
+
+    conn = sqlite3.connect(str(tmp_path))
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("CREATE TABLE babelnet_wiki (bid TEXT PRIMARY KEY, direct TEXT NOT NULL, redirect TEXT NOT NULL) WITHOUT ROWID")
+
+    def rows():
+        # Sorted keys insert in primary key order, which keeps the B-tree compact
+        for bid in sorted(babelnet_dict):
+            wiki_direct, wiki_redirect = babelnet_dict[bid]
+            yield (
+                bid,
+                json.dumps(list(wiki_direct), separators=(",", ":"), ensure_ascii=False),
+                json.dumps(list(wiki_redirect), separators=(",", ":"), ensure_ascii=False),
+            )
+
+    batch = []
+    for row in rows():
+        batch.append(row)
+        if len(batch) >= batch_size:
+            conn.executemany("INSERT INTO babelnet_wiki VALUES (?, ?, ?)", batch)
+            batch = []
+    conn.executemany("INSERT INTO babelnet_wiki VALUES (?, ?, ?)", batch)
+    conn.commit()
+    conn.close()
+
+    os.replace(tmp_path, db_path)
+    logging.info(f"Saved {len(babelnet_dict)} BabelNet entries to {db_path}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert babelnet_source_dict.pkl into an indexed SQLite store")
+    parser.add_argument("--pickle_path", default=None, help=f"Source pickle (default: {Path(DATA_PATH) / BABELNET_WIKI})")
+    cli_args = parser.parse_args()
+    build_babelnet_store(cli_args.pickle_path)
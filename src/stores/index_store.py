@@ -0,0 +1,115 @@
+import json
+import logging
+import argparse
+import numpy as np
+from pathlib import Path
+from src.config import DATA_PATH, INDEX_INFOS, INDEX_INFOS_STORE
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+class StringColumn:
+    """Read-only sequence of strings stored as one memory-mapped UTF-8 buffer plus offsets"""
+
+    def __init__(self, buffer_path, offsets_path):
+        self.offsets = np.load(str(offsets_path), mmap_mode="r")
+        size = int(self.offsets[-1])
+        self.buffer = np.memmap(str(buffer_path), dtype=np.uint8, mode="r", shape=(size,)) if size else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.buffer[int(self.offsets[i]):int(self.offsets[i + 1])].tobytes().decode("utf-8")
+
+class BidColumn:
+    """Read-only sequence of BabelNet id lists, stored as integer codes into a string vocabulary"""
+
+    def __init__(self, codes_path, offsets_path, vocab):
+        self.codes = np.load(str(codes_path), mmap_mode="r")
+        self.offsets = np.load(str(offsets_path), mmap_mode="r")
+        self.vocab = vocab
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return [self.vocab[code] for code in self.codes[int(self.offsets[i]):int(self.offsets[i + 1])]]
+
+class IndexInfoStore:
+    """
+    Columnar, memory-mapped replacement for index_infos_merged.json.
+
+    `urls` and `ids` behave like the image_urls and babelnet_ids lists of the JSON
+    file, but decode only the rows that are indexed.
+    """
+
+    def __init__(self, store_dir):
+        store_dir = Path(store_dir)
+        self.urls = StringColumn(store_dir / "urls.bin", store_dir / "url_offsets.npy")
+        vocab = StringColumn(store_dir / "bid_vocab.bin", store_dir / "bid_vocab_offsets.npy")
+        self.ids = BidColumn(store_dir / "bid_codes.npy", store_dir / "bid_offsets.npy", vocab)
+
+def store_dir(data_path=DATA_PATH):
+    return Path(data_path) / INDEX_INFOS_STORE
+
+def open_index_info_store(data_path=DATA_PATH):
+    """Return the IndexInfoStore, or None if it has not been built"""
+    path = store_dir(data_path)
+    if not (path / "bid_offsets.npy").exists():
+        return None
+    return IndexInfoStore(path)
+
+def write_string_column(strings, buffer_path, offsets_path):
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    with open(buffer_path, "wb") as f:
+        for i, s in enumerate(strings):
+            encoded = s.encode("utf-8")
+            f.write(encoded)
+            offsets[i + 1] = offsets[i] + len(encoded)
+    np.save(str(offsets_path), offsets)
+
+def build_index_info_store(json_path=None, data_path=DATA_PATH):
+    """Convert index_infos_merged.json into an IndexInfoStore directory"""
+    json_path = Path(json_path or Path(data_path) / INDEX_INFOS)
+    out_dir = store_dir(data_path)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    logging.info(f"Loading {json_path}...")
+    with open(json_path, "r") as f:
+        data = json.load(f)
+    urls, babelnet_ids = data["image_urls"], data["babelnet_ids"]
+    del data
+
+    write_string_column(urls, out_dir / "urls.bin", out_dir / "url_offsets.npy")
+
+    vocab = {}
+    codes = []
+    offsets = np.zeros(len(babelnet_ids) + 1, dtype=np.int64)
+    for i, bids in enumerate(babelnet_ids):
+        if isinstance(bids, str):
+            bids = [bids]
+        for bid in bids:
+            codes.append(vocab.setdefault(bid, len(vocab)))
+        offsets[i + 1] = len(codes)
+    np.save(str(out_dir / "bid_codes.npy"), np.asarray(codes, dtype=np.int32))
+    write_string_column(list(vocab), out_dir / "bid_vocab.bin", out_dir / "bid_vocab_offsets.npy")
+    # Written last: its presence marks a complete store
+    np.save(str(out_dir / "bid_offsets.npy"), offsets)
+
+    logging.info(f"Saved {len(urls)} index entries ({len(vocab)} unique BabelNet ids) to {out_dir}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert index_infos_merged.json into a columnar memory-mapped store")
+    parser.add_argument("--json_path", default=None, help=f"Source JSON (default: {Path(DATA_PATH) / INDEX_INFOS})")
+    cli_args = parser.parse_args()
+    build_index_info_store(cli_args.json_path)
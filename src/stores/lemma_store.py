@@ -0,0 +1,97 @@
+import pickle
+import logging
+import argparse
+import functools
+import numpy as np
+from pathlib import Path
+from src.config import DATA_PATH, LEMMA_EMBEDS, LEMMA_EMBEDS_MATRIX, LEMMA_EMBEDS_IDS
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+class LemmaStore:
+    """
+    Memory-mapped lemma embeddings.
+
+    The matrix is a float16 .npy file with one row per BabelNet id. The ids are a
+    sorted fixed-width byte array, so row lookup is a binary search. Only the rows
+    that are read get paged in, and worker processes share those pages through the
+    OS page cache.
+    """
+
+    def __init__(self, matrix_path, ids_path):
+        self.matrix = np.load(str(matrix_path), mmap_mode="r")
+        self.ids = np.load(str(ids_path), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, bids):
+        """Return (rows, found) arrays giving the matrix row of each bid and whether it exists"""
+        width = self.ids.dtype.itemsize
+        encoded = [bid.encode() for bid in bids]
+        keys = np.array(encoded, dtype=self.ids.dtype)
+        rows = np.minimum(np.searchsorted(self.ids, keys), len(self.ids) - 1)
+        # Keys longer than the stored width would be silently truncated by numpy
+        fits = np.array([len(key) <= width for key in encoded], dtype=bool)
+        found = fits & (self.ids[rows] == keys)
+        return rows, found
+
+    def gather(self, bids):
+        """
+        Read the embeddings of bids into a contiguous float32 matrix.
+
+        Returns:
+            (matrix, bid_index) where bid_index maps each bid found to its row in matrix
+        """
+        if not bids or not len(self):
+            return np.zeros((0, self.matrix.shape[1]), dtype=np.float32), {}
+
+        rows, found = self.lookup(bids)
+        found_bids = [bid for bid, ok in zip(bids, found) if ok]
+        rows = rows[found]
+
+        # Read in row order so the memory map is scanned sequentially
+        order = np.argsort(rows, kind="stable")
+        matrix = np.empty((len(rows), self.matrix.shape[1]), dtype=np.float32)
+        matrix[order] = self.matrix[rows[order]]
+        return matrix, {bid: i for i, bid in enumerate(found_bids)}
+
+def store_paths(data_path=DATA_PATH):
+    return Path(data_path) / LEMMA_EMBEDS_MATRIX, Path(data_path) / LEMMA_EMBEDS_IDS
+
+@functools.lru_cache(maxsize=1)
+def get_lemma_store():
+    """Open the lemma store once per process, or return None if it has not been built"""
+    matrix_path, ids_path = store_paths()
+    if not (matrix_path.exists() and ids_path.exists()):
+        return None
+    return LemmaStore(matrix_path, ids_path)
+
+def build_lemma_store(pickle_path=None, data_path=DATA_PATH, chunk_size=65536):
+    """Convert the combined_lemma_embeds.pkl dict of per-bid arrays into a LemmaStore"""
+    pickle_path = Path(pickle_path or Path(data_path) / LEMMA_EMBEDS)
+    matrix_path, ids_path = store_paths(data_path)
+
+    logging.info(f"Loading {pickle_path}...")
+    with open(pickle_path, "rb") as f:
+        lemma_embeds = pickle.load(f)
+
+    bids = sorted(lemma_embeds)
+    dim = len(np.asarray(lemma_embeds[bids[0]]))
+    ids = np.array([bid.encode() for bid in bids])
+
+    matrix = np.lib.format.open_memmap(str(matrix_path), mode="w+", dtype=np.float16, shape=(len(bids), dim))
+    for start in range(0, len(bids), chunk_size):
+        chunk = bids[start:start + chunk_size]
+        matrix[start:start + len(chunk)] = np.asarray([lemma_embeds[bid] for bid in chunk], dtype=np.float16)
+    matrix.flush()
+    del matrix
+
+    np.save(str(ids_path), ids)
+    logging.info(f"Saved {len(bids)} lemma embeddings ({dim}-d, float16) to {matrix_path} and {ids_path}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert combined_lemma_embeds.pkl into a memory-mapped lemma store")
+    parser.add_argument("--pickle_path", default=None, help=f"Source pickle (default: {Path(DATA_PATH) / LEMMA_EMBEDS})")
+    cli_args = parser.parse_args()
+    build_lemma_store(cli_args.pickle_path)
@@ -0,0 +1,72 @@
+import json
+import time
+import sqlite3
+import hashlib
+import functools
+import threading
+from pathlib import Path
+from src.config import DATA_PATH, SCORE_CACHE, PROMPT_TEMPLATE_VERSION
+
+class ScoreCache:
+    """
+    Persistent cache of VLM culture scores.
+
+    Each entry is one (image, target) score: [score, reasoning] or, in logits mode,
+    [score, reasoning, distribution]. Entries are keyed by score_key, so a change of
+    image, Wikipedia context, model, scoring mode or prompt version is a miss.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, target TEXT NOT NULL, value TEXT NOT NULL, "
+            "created_at REAL NOT NULL) WITHOUT ROWID"
+        )
+
+    def get_many(self, keys):
+        """Return a dict of key -> cached value for the keys present"""
+        results = {}
+        keys = list(dict.fromkeys(keys))
+        with self._lock:
+            # Stay under SQLite's bound parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM scores WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                results.update((key, json.loads(value)) for key, value in rows)
+        return results
+
+    def put_many(self, entries):
+        """Store (key, model, target, value) entries"""
+        now = time.time()
+        rows = [(key, model, target, json.dumps(value, ensure_ascii=False), now) for key, model, target, value in entries]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.execute("COMMIT")
+
+def digest_context(context):
+    """Stable digest of a Wikipedia context from build_wiki_context"""
+    return hashlib.sha256(json.dumps(context, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+def score_key(image_digest, context_digest, target, model_name, scoring_mode, prompt_variant="default"):
+    """Cache key of one score; prompt_variant tells apart templates used for the same mode"""
+    payload = json.dumps(
+        [image_digest, context_digest, target, model_name, scoring_mode, prompt_variant, PROMPT_TEMPLATE_VERSION],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+@functools.lru_cache(maxsize=1)
+def get_score_cache():
+    """Open the persistent score cache once per process, or return None if it is disabled"""
+    if SCORE_CACHE is None:
+        return None
+    return ScoreCache(Path(DATA_PATH) / SCORE_CACHE)
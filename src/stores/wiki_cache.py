@@ -0,0 +1,181 @@
+import json
+import time
+import sqlite3
+import logging
+import functools
+import contextlib
+import threading
+from pathlib import Path
+from src.config import DATA_PATH, WIKI_CACHE, WIKI_CACHE_MAX_MB, WIKI_CACHE_TTL_DAYS
+
+# Returned by the getters on a cache miss, since None / False are valid cached values
+MISS = object()
+
+# Fraction of the size limit kept after an eviction pass, so evictions are not triggered on every write
+LOW_WATER_MARK = 0.9
+# Cache hits record their access time in memory and write it back in one transaction once this
+# many are pending or TOUCH_INTERVAL_S has passed, so reads do not each take the write lock
+TOUCH_BATCH = 256
+TOUCH_INTERVAL_S = 30.0
+
+class WikiPageCache:
+    """
+    Persistent read-through cache of Wikipedia lookups, keyed by (language, title).
+
+    Holds two kinds of entries: 'page' (the page dict returned by fetch_wikipedia_page)
+    and 'langlink' (the English title a non-English page links to, or None). Entries
+    older than the TTL count as misses. When the stored payload grows past max_bytes,
+    the least recently used entries are evicted.
+
+    Several processes may share the file: the payload total is kept in the database,
+    updated in the same transaction as each write, and re-summed when evicting. Access
+    times used for eviction are written back in batches, so they lag by up to
+    TOUCH_INTERVAL_S.
+
+    Args:
+        db_path: SQLite file holding the cache
+        max_bytes: Size limit of the cached payloads (None = unbounded)
+        ttl_seconds: Age after which entries are refetched (None = never expire)
+    """
+
+    def __init__(self, db_path, max_bytes=None, ttl_seconds=None):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._touched = {}
+        self._flushed_at = time.monotonic()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "kind TEXT NOT NULL, lang TEXT NOT NULL, title TEXT NOT NULL, value TEXT, "
+            "size INTEGER NOT NULL, fetched_at REAL NOT NULL, accessed_at REAL NOT NULL, "
+            "PRIMARY KEY (kind, lang, title)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.execute(
+            "INSERT OR IGNORE INTO meta VALUES ('total_bytes', (SELECT COALESCE(SUM(size), 0) FROM entries))"
+        )
+
+    def get_page(self, lang, title, allow_stale=False):
+        return self._get("page", lang, title, allow_stale)
+
+    def put_page(self, lang, title, page):
+        self._put("page", lang, title, page)
+
+    def get_langlink(self, lang, title, allow_stale=False):
+        return self._get("langlink", lang, title, allow_stale)
+
+    def put_langlink(self, lang, title, en_title):
+        self._put("langlink", lang, title, en_title)
+
+    def total_bytes(self):
+        with self._lock:
+            return self._conn.execute("SELECT value FROM meta WHERE key = 'total_bytes'").fetchone()[0]
+
+    def flush(self):
+        """Write pending access times back to the database"""
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def _get(self, kind, lang, title, allow_stale):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, fetched_at FROM entries WHERE kind = ? AND lang = ? AND title = ?",
+                (kind, lang, title)
+            ).fetchone()
+            if row is None:
+                return MISS
+            if self.ttl_seconds is not None and now - row[1] > self.ttl_seconds and not allow_stale:
+                return MISS
+            self._touched[kind, lang, title] = now
+            if len(self._touched) >= TOUCH_BATCH or time.monotonic() - self._flushed_at > TOUCH_INTERVAL_S:
+                self._flush()
+        return json.loads(row[0])
+
+    def _flush(self):
+        if self._touched:
+            with self._transaction():
+                self._conn.executemany(
+                    "UPDATE entries SET accessed_at = MAX(accessed_at, ?) WHERE kind = ? AND lang = ? AND title = ?",
+                    [(accessed_at, *key) for key, accessed_at in self._touched.items()]
+                )
+            self._touched.clear()
+        self._flushed_at = time.monotonic()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so concurrent writers queue instead of failing to upgrade
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _put(self, kind, lang, title, value):
+        payload = json.dumps(value, ensure_ascii=False)
+        size = len(payload.encode("utf-8"))
+        now = time.time()
+        with self._lock, self._transaction():
+            old = self._conn.execute(
+                "SELECT size FROM entries WHERE kind = ? AND lang = ? AND title = ?", (kind, lang, title)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, lang, title, payload, size, now, now)
+            )
+            self._conn.execute(
+                "UPDATE meta SET value = value + ? WHERE key = 'total_bytes'", (size - (old[0] if old else 0),)
+            )
+            total = self._conn.execute("SELECT value FROM meta WHERE key = 'total_bytes'").fetchone()[0]
+        if self.max_bytes is not None and total > self.max_bytes:
+            with self._lock:
+                self._evict()
+
+    def _evict(self):
+        """Drop expired entries, then least recently used ones until under the low water mark"""
+        # Recent hits count towards recency before victims are chosen
+        self._flush()
+        with self._transaction():
+            if self.ttl_seconds is not None:
+                self._conn.execute("DELETE FROM entries WHERE fetched_at < ?", (time.time() - self.ttl_seconds,))
+            # Re-summed under the write lock, since other processes write to the same file
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            target = self.max_bytes * LOW_WATER_MARK
+            while total > target:
+                victims = self._conn.execute(
+                    "SELECT kind, lang, title, size FROM entries ORDER BY accessed_at LIMIT 256"
+                ).fetchall()
+                if not victims:
+                    break
+                deleted = []
+                for kind, lang, title, size in victims:
+                    if total <= target:
+                        break
+                    deleted.append((kind, lang, title))
+                    total -= size
+                self._conn.executemany("DELETE FROM entries WHERE kind = ? AND lang = ? AND title = ?", deleted)
+            self._conn.execute("UPDATE meta SET value = ? WHERE key = 'total_bytes'", (total,))
+        logging.info(f"Wikipedia cache evicted down to {total / 2 ** 20:.1f} MB")
+
+@functools.lru_cache(maxsize=1)
+def get_wiki_cache():
+    """Open the persistent Wikipedia cache once per process, or return None if it is disabled"""
+    if WIKI_CACHE is None:
+        return None
+    return WikiPageCache(
+        Path(DATA_PATH) / WIKI_CACHE,
+        max_bytes=WIKI_CACHE_MAX_MB * 2 ** 20 if WIKI_CACHE_MAX_MB is not None else None,
+        ttl_seconds=WIKI_CACHE_TTL_DAYS * 86400 if WIKI_CACHE_TTL_DAYS is not None else None,
+    )
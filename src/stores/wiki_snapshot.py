@@ -0,0 +1,332 @@
+import os
+import re
+import bz2
+import gzip
+import json
+import pickle
+import sqlite3
+import logging
+import argparse
+import functools
+import threading
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from src.config import DATA_PATH, BABELNET_WIKI, WIKI_SNAPSHOT
+from src.stores.babelnet_store import get_babelnet_store
+from src.scripts.wiki_client import parse_extract, select_fields, MIN_PAGE_CHARS
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+CATEGORY_LINK = re.compile(r"\[\[\s*Category\s*:\s*([^\]|]+)", re.IGNORECASE)
+# Links that render no article text (categories, images)
+NON_TEXT_LINK = re.compile(r"\s*(Category|File|Image)\s*:", re.IGNORECASE)
+
+def normalize_title(title):
+    """Normalize a title the way MediaWiki does: underscores as spaces, single spaces, first letter uppercase"""
+    title = " ".join(title.replace("_", " ").split())
+    return title[:1].upper() + title[1:]
+
+class WikiSnapshotStore:
+    """
+    Read-only SQLite snapshot of the Wikipedia pages and langlinks CAIRE can reach.
+
+    Pages are stored as the page dicts fetch_pages returns, keyed by (language, normalized title).
+    Redirect titles resolve to their target page. Each thread gets its own memory-mapped
+    connection, as in BabelNetWikiStore.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size={os.path.getsize(self.db_path)}")
+            self._local.conn = conn
+        return conn
+
+    def get_page(self, lang, title):
+        """Return the page dict for title (following one redirect), or None"""
+        conn = self._connection()
+        title = normalize_title(title)
+        row = conn.execute(
+            "SELECT target FROM redirects WHERE lang = ? AND title = ?", (lang, title)
+        ).fetchone()
+        if row is not None:
+            title = row[0]
+        row = conn.execute(
+            "SELECT page FROM pages WHERE lang = ? AND title = ?", (lang, title)
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def get_langlink(self, lang, title):
+        """Return the English title a page in lang links to, or None"""
+        row = self._connection().execute(
+            "SELECT en_title FROM langlinks WHERE lang = ? AND title = ?", (lang, normalize_title(title))
+        ).fetchone()
+        return None if row is None else row[0]
+
+class WikiSnapshotClient:
+    """
+    Serve AsyncWikipediaClient lookups from a WikiSnapshotStore, without network access.
+
+    Exposes the same async interface (fetch_pages, first_page, resolve_langlinks),
+    so fetch_wikipedia can use either backend.
+    """
+
+    def __init__(self, store=None):
+        self.store = store or get_wiki_snapshot()
+        if self.store is None:
+            raise FileNotFoundError(
+                f"Wikipedia snapshot {Path(DATA_PATH) / WIKI_SNAPSHOT} not found. Build it with: python -m src.stores.wiki_snapshot"
+            )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def fetch_pages(self, titles, lang="en", fields=None, max_chars=None):
+        pages = []
+        for title in titles:
+            page = self.store.get_page(lang, title) or {"title": title, "text": ""}
+            pages.append(select_fields(page, fields, max_chars))
+        return pages
+
+    async def first_page(self, titles, lang="en", fields=None, max_chars=None):
+        for title in titles:
+            page = self.store.get_page(lang, title)
+            if page and len(page.get("text", "")) > MIN_PAGE_CHARS:
+                return select_fields(page, fields, max_chars)
+        return None
+
+    async def resolve_langlinks(self, lang, titles):
+        return {title: self.store.get_langlink(lang, title) for title in titles}
+
+@functools.lru_cache(maxsize=1)
+def get_wiki_snapshot():
+    """Open the Wikipedia snapshot once per process, or return None if it has not been built"""
+    db_path = Path(DATA_PATH) / WIKI_SNAPSHOT
+    if not db_path.exists():
+        return None
+    return WikiSnapshotStore(db_path)
+
+def open_dump(path):
+    """Open a plain, .gz or .bz2 dump file for binary reading"""
+    path = str(path)
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+def reachable_titles(babelnet_dict):
+    """Collect the titles babelnet_source_dict can reach, grouped by lowercase language code"""
+    wanted = {}
+    for wiki_direct, wiki_redirect in babelnet_dict.values():
+        for title, lang in list(wiki_direct) + list(wiki_redirect):
+            wanted.setdefault(lang.lower(), set()).add(normalize_title(title))
+    return wanted
+
+def iter_langlinks(path):
+    """Yield (lang, title, en_title) from a TSV file of 'lang<TAB>title<TAB>English title' lines"""
+    with open_dump(path) as f:
+        for line in f:
+            parts = line.decode("utf-8").rstrip("\n").split("\t")
+            if len(parts) == 3 and parts[2]:
+                yield parts[0].lower(), normalize_title(parts[1]), normalize_title(parts[2])
+
+def iter_jsonl_pages(path):
+    """
+    Yield (title, page_id, text, categories, redirects) from a JSON lines dump.
+
+    Accepts WikiExtractor output ({"id", "title", "text"}) and CirrusSearch content
+    dumps, whose "redirect" field lists the titles redirecting to the page. Lines
+    without a title, such as CirrusSearch index headers, are skipped.
+    """
+    with open_dump(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if "title" not in record or record.get("namespace", 0) != 0:
+                continue
+            categories = [f"Category:{c}" for c in record.get("category", record.get("categories", []))]
+            redirects = [normalize_title(r["title"] if isinstance(r, dict) else r) for r in record.get("redirect", [])]
+            yield normalize_title(record["title"]), record.get("id", record.get("page_id")), record.get("text", ""), categories, redirects
+
+def iter_xml_pages(path, titles=None):
+    """
+    Yield (title, page_id, text, categories, redirect_target) from a MediaWiki XML export.
+
+    Only main-namespace pages whose normalized title is in titles (None = all) are parsed,
+    so the rest of the dump costs no wikitext parsing. Processed pages are cleared from
+    the tree, keeping memory flat on full dumps. Wikitext is reduced to plain text with
+    '== Heading ==' markers, the format of the TextExtracts API. This needs mwparserfromhell.
+    """
+    try:
+        import mwparserfromhell
+        from mwparserfromhell.nodes import Text
+    except ImportError:
+        raise ImportError("Importing XML dumps requires mwparserfromhell (pip install mwparserfromhell)")
+
+    with open_dump(path) as f:
+        root = None
+        for event, elem in ET.iterparse(f, events=("start", "end")):
+            if root is None:
+                root = elem
+            if event != "end" or (not elem.tag.endswith("}page") and elem.tag != "page"):
+                continue
+            fields = {child.tag.rsplit("}", 1)[-1]: child for child in elem}
+            title = normalize_title(fields["title"].text or "")
+            if fields.get("ns") is not None and fields["ns"].text != "0" or titles is not None and title not in titles:
+                elem.clear()
+                root.clear()
+                continue
+
+            page_id = int(fields["id"].text) if fields.get("id") is not None else None
+            redirect = fields.get("redirect")
+            if redirect is not None:
+                yield title, page_id, "", [], normalize_title(redirect.get("title", ""))
+            else:
+                revision = {child.tag.rsplit("}", 1)[-1]: child for child in fields["revision"]}
+                wikitext = revision["text"].text or ""
+                code = mwparserfromhell.parse(wikitext)
+                for link in code.filter_wikilinks():
+                    if NON_TEXT_LINK.match(str(link.title)):
+                        code.remove(link)
+                for heading in code.filter_headings():
+                    marker = "=" * heading.level
+                    # A Text node, so the marker is not parsed back into a heading
+                    code.replace(heading, Text(f"\n{marker} {heading.title.strip_code().strip()} {marker}\n"))
+                text = re.sub(r"\n{3,}", "\n\n", code.strip_code())
+                categories = [f"Category:{c.strip()}" for c in CATEGORY_LINK.findall(wikitext)]
+                yield title, page_id, text, categories, None
+            elem.clear()
+            # Drop the processed pages from the root, which otherwise keeps every one of them
+            root.clear()
+
+def build_wiki_snapshot(dumps, langlinks=(), babelnet_path=None, data_path=DATA_PATH, max_chars=None, batch_size=10000):
+    """
+    Import Wikipedia dumps into a WikiSnapshotStore, keeping only titles reachable from the BabelNet dict.
+
+    Langlinks are imported first, so the English pages they point to are kept too.
+    Redirects whose target was already passed in the dump are picked up by one more pass.
+
+    Args:
+        dumps: List of (lang, path) pairs; '.jsonl' / '.json' files (optionally .gz / .bz2)
+               are read as JSON lines, anything else as MediaWiki XML
+        langlinks: Paths of 'lang<TAB>title<TAB>English title' files (optionally .gz / .bz2)
+        babelnet_path: babelnet_source_dict.pkl (default: the BabelNet store, else the pickle in data_path)
+        max_chars: Truncate stored page text to this many characters (None = full text)
+    """
+    if babelnet_path is None and get_babelnet_store() is not None:
+        babelnet_dict = get_babelnet_store()
+    else:
+        babelnet_path = Path(babelnet_path or Path(data_path) / BABELNET_WIKI)
+        logging.info(f"Loading {babelnet_path}...")
+        with open(babelnet_path, "rb") as f:
+            babelnet_dict = pickle.load(f)
+    wanted = reachable_titles(babelnet_dict)
+
+    db_path = Path(data_path) / WIKI_SNAPSHOT
+    tmp_path = db_path.with_suffix(".tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    conn = sqlite3.connect(str(tmp_path))
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("CREATE TABLE pages (lang TEXT NOT NULL, title TEXT NOT NULL, page TEXT NOT NULL, PRIMARY KEY (lang, title)) WITHOUT ROWID")
+    conn.execute("CREATE TABLE redirects (lang TEXT NOT NULL, title TEXT NOT NULL, target TEXT NOT NULL, PRIMARY KEY (lang, title)) WITHOUT ROWID")
+    conn.execute("CREATE TABLE langlinks (lang TEXT NOT NULL, title TEXT NOT NULL, en_title TEXT NOT NULL, PRIMARY KEY (lang, title)) WITHOUT ROWID")
+
+    links = 0
+    for path in langlinks:
+        logging.info(f"Importing langlinks from {path}...")
+        batch = []
+        for lang, title, en_title in iter_langlinks(path):
+            if title in wanted.get(lang, ()):
+                batch.append((lang, title, en_title))
+                wanted.setdefault("en", set()).add(en_title)
+        conn.executemany("INSERT OR REPLACE INTO langlinks VALUES (?, ?, ?)", batch)
+        links += len(batch)
+
+    def import_pages(lang, path, titles):
+        """Store pages of titles from one dump; return redirect targets still to be imported"""
+        is_jsonl = any(str(path).endswith(s) for s in (".jsonl", ".json", ".jsonl.gz", ".json.gz", ".jsonl.bz2", ".json.bz2"))
+        pages, redirects, pending = [], [], set()
+        stored = 0
+
+        def flush():
+            conn.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)", pages)
+            conn.executemany("INSERT OR REPLACE INTO redirects VALUES (?, ?, ?)", redirects)
+            pages.clear()
+            redirects.clear()
+
+        if is_jsonl:
+            for title, page_id, text, categories, sources in iter_jsonl_pages(path):
+                aliases = [source for source in sources if source in titles]
+                if title not in titles and not aliases:
+                    continue
+                redirects.extend((lang, source, title) for source in aliases)
+                page = parse_extract(title, page_id, text, categories)
+                if max_chars is not None:
+                    page["text"] = page["text"][:max_chars]
+                pages.append((lang, title, json.dumps(page, ensure_ascii=False)))
+                stored += 1
+                if len(pages) >= batch_size:
+                    flush()
+        else:
+            for title, page_id, text, categories, target in iter_xml_pages(path, titles):
+                if target is not None:
+                    redirects.append((lang, title, target))
+                    pending.add(target)
+                    continue
+                pending.discard(title)
+                page = parse_extract(title, page_id, text, categories)
+                if max_chars is not None:
+                    page["text"] = page["text"][:max_chars]
+                pages.append((lang, title, json.dumps(page, ensure_ascii=False)))
+                stored += 1
+                if len(pages) >= batch_size:
+                    flush()
+        flush()
+
+        # Targets stored earlier in this pass are already present
+        stored_titles = {row[0] for row in conn.execute("SELECT title FROM pages WHERE lang = ?", (lang,))}
+        return stored, pending - stored_titles
+
+    for lang, path in dumps:
+        lang = lang.lower()
+        logging.info(f"Importing {lang} pages from {path}...")
+        stored, pending = import_pages(lang, path, wanted.get(lang, set()))
+        if pending:
+            logging.info(f"Second pass over {path} for {len(pending)} redirect targets...")
+            more, _ = import_pages(lang, path, pending)
+            stored += more
+        logging.info(f"Stored {stored} {lang} pages")
+
+    conn.commit()
+    page_count = conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+    conn.close()
+
+    os.replace(tmp_path, db_path)
+    logging.info(f"Saved {page_count} pages and {links} langlinks to {db_path}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import Wikipedia dumps into a local snapshot store for network-free runs")
+    parser.add_argument("--dump", action="append", default=[], metavar="LANG:PATH",
+                        help="Dump to import, e.g. en:enwiki-pages-articles.xml.bz2 or en:enwiki.jsonl.gz (repeatable)")
+    parser.add_argument("--langlinks", action="append", default=[], metavar="PATH",
+                        help="TSV of 'lang<TAB>title<TAB>English title' lines (repeatable)")
+    parser.add_argument("--babelnet_path", default=None, help=f"BabelNet dict pickle (default: the BabelNet store or {BABELNET_WIKI})")
+    parser.add_argument("--max_chars", type=int, default=None, help="Truncate stored page text to this many characters")
+    cli_args = parser.parse_args()
+    build_wiki_snapshot(
+        [tuple(dump.split(":", 1)) for dump in cli_args.dump],
+        cli_args.langlinks,
+        cli_args.babelnet_path,
+        max_chars=cli_args.max_chars
+    )
@@ -1,6 +1,7 @@
 import os
 import csv
 import json
+import hashlib
 import faiss
 import pickle
 import logging
@@ -28,6 +29,12 @@ def load_model():
         logging.error(f"Failed to load model: {e}", exc_info=True)
         return None, None
 
+def image_digest(image):
+    """Stable sha256 hex digest of a PIL image's decoded pixels, mode and size"""
+    digest = hashlib.sha256(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
 def get_image_paths(folder, extensions=("jpg", "jpeg", "png", "gif")):
     image_files = []
     for root, _, files in os.walk(folder):
@@ -45,8 +52,11 @@ def load_index_info(index_info_path):
         logging.error(f"Failed to load index information: {e}", exc_info=True)
         return None, None
 
-def load_faiss_index(index_path):
+def load_faiss_index(index_path, mmap=False):
     try:
+        if mmap:
+            # Read-only memory map: pages are shared between processes through the OS page cache
+            return faiss.read_index(str(index_path), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
         return faiss.read_index(str(index_path))
     except Exception as e:
         logging.error(f"Failed to load FAISS index: {e}", exc_info=True)
@@ -83,6 +93,14 @@ def parse_args():
         choices=["qwen_vl", "pangea_vl", "llama_vl"],
         help="VLM model to use for scoring (default: qwen_vl). Note: CulturalPangea not yet supported."
     )
+
+    parser.add_argument(
+        "--scoring_mode",
+        type=str,
+        default="generate",
+        choices=["generate", "logits"],
+        help="'generate' for scores with reasoning, 'logits' for a single forward pass reading the 1-5 token probabilities (default: generate)"
+    )
     
     return parser.parse_args()
 
@@ -152,7 +170,8 @@ def save_readable(args, OUTPUT_PATH, output_file = 'combined_outputs.csv'):
         writer = csv.writer(f)
         writer.writerow(["Image_Path", "Matched Entity", "Wikipedia Link", "Scores", "Reasoning"])
         for idx, img_path in enumerate(image_paths):
-            title = wiki_data[idx][0]['title']
+            # Images without Wikipedia pages were scored with defaults
+            title = wiki_data[idx][0]['title'] if wiki_data[idx] else "Unknown"
             encoded_title = urllib.parse.quote(title)
             wiki_link = f"{base_wiki_link}{encoded_title}"
             writer.writerow([
@@ -0,0 +1,8 @@
+import pytest
+from src.scripts import wiki_client
+
+@pytest.fixture(autouse=True)
+def no_wiki_cache(monkeypatch):
+    """Keep clients off the persistent page cache under DATA_PATH, and retry without backoff"""
+    monkeypatch.setattr(wiki_client, "get_wiki_cache", lambda: None)
+    monkeypatch.setattr(wiki_client, "RETRY_BACKOFF_S", 0)
@@ -0,0 +1,69 @@
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+class MockMediaWiki:
+    """
+    Minimal MediaWiki query API served on localhost, for AsyncWikipediaClient tests.
+
+    Answers prop=info|categories, prop=extracts and prop=langlinks queries in the
+    formatversion=2 layout and records every request's parameters, with the
+    wiki language under 'lang'.
+
+    Args:
+        pages: Dict of lang -> {title: extract text}
+        langlinks: Dict of lang -> {title: English title}
+        failures: Status codes returned, in order, before requests are answered
+        delays: Seconds to wait before answering, one per request in order (then no delay)
+    """
+
+    def __init__(self, pages=None, langlinks=None, failures=(), delays=()):
+        self.pages = pages or {}
+        self.langlinks = langlinks or {}
+        self.failures = list(failures)
+        self.delays = list(delays)
+        self.requests = []
+        self._server = None
+
+    @property
+    def url(self):
+        """Endpoint template to pass as the client's api_url"""
+        return f"http://{self._server.host}:{self._server.port}/{{lang}}/api.php"
+
+    def queries(self, prop):
+        """Recorded requests for one prop value"""
+        return [params for params in self.requests if params.get("prop") == prop]
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get("/{lang}/api.php", self._handle)
+        self._server = TestServer(app)
+        await self._server.start_server()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._server.close()
+
+    async def _handle(self, request):
+        params = dict(request.query, lang=request.match_info["lang"])
+        self.requests.append(params)
+        delay = self.delays.pop(0) if self.delays else 0
+        if delay:
+            await asyncio.sleep(delay)
+        if self.failures:
+            return web.Response(status=self.failures.pop(0))
+
+        lang = params["lang"]
+        pages = []
+        for title in params["titles"].split("|"):
+            if params["prop"] == "langlinks":
+                target = self.langlinks.get(lang, {}).get(title)
+                page = {"title": title, "langlinks": [{"lang": "en", "title": target}] if target else []}
+            elif title not in self.pages.get(lang, {}):
+                page = {"title": title, "missing": True}
+            elif params["prop"] == "extracts":
+                page = {"title": title, "pageid": list(self.pages[lang]).index(title) + 1, "extract": self.pages[lang][title]}
+            else:
+                page = {"title": title, "pageid": list(self.pages[lang]).index(title) + 1, "categories": [{"title": f"Category:{title}"}]}
+            pages.append(page)
+        return web.json_response({"batchcomplete": True, "query": {"pages": pages}})
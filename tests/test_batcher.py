@@ -0,0 +1,27 @@
+from concurrent.futures import Future
+from api.batcher import RetrievalBatcher
+
+class Context:
+    """Retrieval context stub: an 'image' is a number, and encoding the string 'bad' fails"""
+
+    def __init__(self):
+        self.batches = []
+
+    def encode(self, images):
+        self.batches.append(list(images))
+        if "bad" in images:
+            raise ValueError("cannot encode")
+        return [image * 2 for image in images]
+
+    def search(self, zimg):
+        return [[z + 1] for z in zimg]
+
+def test_failed_batch_is_retried_per_image():
+    context = Context()
+    batcher = RetrievalBatcher(context, max_batch=3, max_wait_s=0.01)
+    batch = [(image, Future()) for image in (1, "bad", 3)]
+    batcher._retrieve(batch)
+    assert batch[0][1].result() == (2, [3])
+    assert isinstance(batch[1][1].exception(), ValueError)
+    assert batch[2][1].result() == (6, [7])
+    assert context.batches == [[1, "bad", 3], [1], ["bad"], [3]]
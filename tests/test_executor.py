@@ -0,0 +1,55 @@
+import time
+import threading
+import pytest
+from api.executor import ScoringLock, QueueTimeoutError
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+def test_interactive_request_goes_before_waiting_job():
+    lock = ScoringLock()
+    order = []
+
+    def job():
+        with lock.background():
+            order.append("job")
+
+    def request():
+        with lock:
+            order.append("request")
+
+    lock.acquire()
+    threads = [threading.Thread(target=job)]
+    threads[0].start()
+    time.sleep(0.05)  # The job is waiting first
+    threads.append(threading.Thread(target=request))
+    threads[1].start()
+    wait_until(lambda: lock._waiting == 1)
+    lock.release()
+    for thread in threads:
+        thread.join(2.0)
+    assert order == ["request", "job"]
+
+def test_job_runs_when_no_request_waits():
+    lock = ScoringLock()
+    with lock.background():
+        pass
+    with lock:
+        pass
+
+def test_request_gives_up_after_max_wait():
+    lock = ScoringLock(max_wait_s=0.05)
+    lock.acquire(background=True)
+    try:
+        with pytest.raises(QueueTimeoutError):
+            with lock:
+                pass
+    finally:
+        lock.release()
+    stats = lock.stats()
+    assert stats["scoring_timed_out"] == 1
+    assert stats["scoring_waiting"] == 0
+    assert stats["mean_scoring_wait_s"] >= 0.05
@@ -0,0 +1,90 @@
+import asyncio
+from collections import Counter
+import pytest
+from mediawiki import MockMediaWiki
+from src.scripts.wiki_client import AsyncWikipediaClient
+
+fetch_wikipedia = pytest.importorskip("src.scripts.fetch_wikipedia")
+
+PAGES = {"en": {
+    "Djembe": "The djembe is a rope-tuned drum from West Africa.",
+    "Kora": "The kora is a 21-string lute-bridge-harp.",
+    "Drum": "The drum is a member of the percussion group of instruments.",
+    "Snare drum": "The snare drum is a percussion instrument with a sharp staccato sound.",
+}}
+LANGLINKS = {
+    "fr": {"Tambour": "Drum", "Caisse claire": "Snare drum"},
+    "de": {"Trommel": "Drum"},
+}
+BABELNET = {
+    "bn:djembe": ([("Djembe", "EN")], []),
+    "bn:kora": ([("Kora", "EN")], []),
+}
+
+def test_shared_bid_is_fetched_once():
+    all_bids = [["bn:djembe", "bn:kora"], ["bn:djembe"], ["bn:kora", "bn:djembe"]]
+
+    async def run():
+        async with MockMediaWiki(pages=PAGES) as wiki:
+            async with AsyncWikipediaClient(api_url=wiki.url) as client:
+                resolver = fetch_wikipedia.BidResolver(client, BABELNET)
+                try:
+                    results = await asyncio.gather(*(
+                        fetch_wikipedia.process_group_bids(resolver, group, max_docs=10) for group in all_bids))
+                finally:
+                    resolver.close()
+        return wiki, resolver, results
+
+    wiki, resolver, results = asyncio.run(run())
+    assert Counter(q["titles"] for q in wiki.queries("extracts")) == {"Djembe": 1, "Kora": 1}
+    assert resolver.unique_bids == 2
+    assert resolver.requests == 5
+    assert [[page["title"] for page in pages] for pages, _ in results] == [["Djembe", "Kora"], ["Djembe"], ["Kora", "Djembe"]]
+    assert all(not skipped for _, skipped in results)
+
+def test_langlinks_resolved_with_one_query_per_language():
+    titles = [("Tambour", "FR"), ("Trommel", "DE"), ("Caisse claire", "FR")]
+
+    async def run():
+        async with MockMediaWiki(pages=PAGES, langlinks=LANGLINKS) as wiki:
+            async with AsyncWikipediaClient(api_url=wiki.url) as client:
+                page = await fetch_wikipedia.get_non_en_pages(client, titles)
+        return wiki, page
+
+    wiki, page = asyncio.run(run())
+    queries = wiki.queries("langlinks")
+    assert sorted((q["lang"], q["titles"]) for q in queries) == [("de", "Trommel"), ("fr", "Tambour|Caisse claire")]
+    assert page["title"] == "Drum"
+
+class ResolvedBids:
+    """Resolver stub whose lookups finish at once, except for the bids in pending"""
+
+    def __init__(self, pending=()):
+        self.pending = set(pending)
+
+    def resolve(self, bid):
+        future = asyncio.get_running_loop().create_future()
+        if bid not in self.pending:
+            future.set_result({"title": bid, "text": "x" * 20})
+        return future
+
+def test_deadline_records_unstarted_bids_as_skipped():
+    bids = [f"bn:{i}" for i in range(10)]
+
+    async def run():
+        return await fetch_wikipedia.process_group_bids(ResolvedBids(), bids, max_docs=5, deadline_s=0, prefetch=2)
+
+    pages, skipped = asyncio.run(run())
+    # Every prefetched lookup had finished, but the deadline still cut the ranked list short
+    assert [page["title"] for page in pages] == ["bn:0", "bn:1", "bn:2"]
+    assert skipped == ["bn:3", "bn:4"]
+
+def test_deadline_skips_pending_and_unstarted_bids():
+    bids = [f"bn:{i}" for i in range(10)]
+
+    async def run():
+        return await fetch_wikipedia.process_group_bids(ResolvedBids(pending={"bn:1"}), bids, max_docs=5, deadline_s=0, prefetch=2)
+
+    pages, skipped = asyncio.run(run())
+    assert [page["title"] for page in pages] == ["bn:0", "bn:2"]
+    assert skipped == ["bn:1", "bn:3", "bn:4"]
@@ -0,0 +1,40 @@
+import pickle
+import pytest
+
+result_cache = pytest.importorskip("api.result_cache")
+from src.scripts.stages import RetrievalResult, LemmaResult, WikiResult
+
+def stages():
+    return (
+        RetrievalResult([[[["bn:1"], 0.1, "url"]]], {"image": [0.0]}),
+        LemmaResult([[{"score": 0.9, "bid": "bn:1"}]]),
+        WikiResult([[{"title": "Djembe", "text": "drum"}]], [[]]),
+    )
+
+def test_round_trip(tmp_path):
+    cache = result_cache.ResultCache(tmp_path)
+    cache.put("key", *stages())
+    assert cache.get("key") == stages()
+
+@pytest.mark.parametrize("payload", [
+    b"not a pickle",
+    pickle.dumps(("no", "stage", "results")),
+    # A pickle of a class that no longer exists
+    b"csrc.gone_module\nOld\n)\x81.",
+])
+def test_unreadable_entry_is_a_miss_and_discarded(tmp_path, payload):
+    cache = result_cache.ResultCache(tmp_path)
+    cache.put("key", *stages())
+    (tmp_path / "key" / result_cache.STAGES_FILE).write_bytes(payload)
+    assert cache.get("key") is None
+    assert not (tmp_path / "key").exists()
+
+def test_stale_dataclass_is_a_miss(tmp_path):
+    cache = result_cache.ResultCache(tmp_path)
+    retrieval, lemmas, wiki = stages()
+    del wiki.skipped  # As if pickled before the field was added
+    with open(tmp_path / "tmp.pkl", "wb") as f:
+        pickle.dump((retrieval, lemmas, wiki), f)
+    (tmp_path / "key").mkdir()
+    (tmp_path / "tmp.pkl").rename(tmp_path / "key" / result_cache.STAGES_FILE)
+    assert cache.get("key") is None
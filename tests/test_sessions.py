@@ -0,0 +1,44 @@
+import os
+import time
+from api import sessions
+from api.sessions import SessionStore, OutputSweeper, mark_run_dir
+
+def run_dir(root, name, age_s=0, size=1000):
+    path = root / name
+    path.mkdir()
+    (path / "stage.pkl").write_bytes(b"x" * size)
+    mark_run_dir(path)
+    if age_s:
+        old = time.time() - age_s
+        os.utime(path / sessions.RUN_MARKER, (old, old))
+    return path
+
+def test_quota_pass_keeps_in_flight_and_fresh_run_dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(sessions, "OUTPUT_PATH", tmp_path)
+    in_flight = run_dir(tmp_path, "in_flight")
+    fresh = run_dir(tmp_path, "fresh")
+    stale = run_dir(tmp_path, "stale", age_s=600)
+    owned = run_dir(tmp_path, "owned", age_s=600)
+    store = SessionStore()
+    store.put("session", {"output_dir": str(owned)})
+
+    sweeper = OutputSweeper(store, protected=lambda: [in_flight], quota_bytes=0, interval_s=300, orphan_age_s=3600)
+    sweeper.sweep()
+
+    assert in_flight.exists()
+    assert fresh.exists()
+    assert not stale.exists()
+    # Sessions are evicted to meet the quota once no old orphans are left
+    assert not owned.exists()
+    assert store.keys() == []
+
+def test_old_orphans_are_removed_whatever_the_quota(tmp_path, monkeypatch):
+    monkeypatch.setattr(sessions, "OUTPUT_PATH", tmp_path)
+    orphan = run_dir(tmp_path, "orphan", age_s=7200)
+    cli_run = tmp_path / "cli_run"
+    cli_run.mkdir()
+
+    OutputSweeper(SessionStore(), quota_bytes=None, orphan_age_s=3600).sweep()
+
+    assert not orphan.exists()
+    assert cli_run.exists()
@@ -0,0 +1,127 @@
+import asyncio
+import sqlite3
+from mediawiki import MockMediaWiki
+from src.scripts.wiki_client import AsyncWikipediaClient
+from src.stores.wiki_cache import WikiPageCache, MISS, LOW_WATER_MARK
+
+PAGES = {"en": {
+    "Djembe": "The djembe is a rope-tuned drum.\n\n== History ==\nIt comes from West Africa.",
+    "Kora": "The kora is a 21-string lute-bridge-harp.",
+}}
+LANGLINKS = {"fr": {"Tambour": "Drum"}}
+TEXT_ONLY = ("title", "text")
+
+def lookup(wiki, cache, call, offline=False):
+    """Run call(client) against the mock server with cache, returning its result"""
+    async def run():
+        async with AsyncWikipediaClient(api_url=wiki.url, offline=offline) as client:
+            client.cache = cache
+            return await call(client)
+    return run()
+
+def age_entries(cache, seconds):
+    cache._conn.execute("UPDATE entries SET fetched_at = fetched_at - ?", (seconds,))
+
+def test_warm_rerun_makes_no_requests(tmp_path):
+    cache = WikiPageCache(tmp_path / "cache.sqlite")
+
+    async def run():
+        async with MockMediaWiki(pages=PAGES, langlinks=LANGLINKS) as wiki:
+            calls = [
+                lambda client: client.fetch_pages(["Djembe", "Kora", "Balafon"]),
+                lambda client: client.resolve_langlinks("fr", ["Tambour", "Inconnu"]),
+            ]
+            cold = [await lookup(wiki, cache, call) for call in calls]
+            cold_requests = len(wiki.requests)
+            warm = [await lookup(wiki, cache, call) for call in calls]
+        return cold, warm, cold_requests, len(wiki.requests)
+
+    cold, warm, cold_requests, total_requests = asyncio.run(run())
+    assert cold_requests > 0
+    assert total_requests == cold_requests
+    assert warm == cold
+    # Missing pages and pages without an English counterpart are cached too
+    assert warm[0][2] == {"title": "Balafon", "text": ""}
+    assert warm[1] == {"Tambour": "Drum", "Inconnu": None}
+
+def test_expired_entries_are_refetched(tmp_path):
+    cache = WikiPageCache(tmp_path / "cache.sqlite", ttl_seconds=3600)
+
+    async def run():
+        async with MockMediaWiki(pages=PAGES) as wiki:
+            fetch = lambda client: client.fetch_pages(["Kora"], fields=TEXT_ONLY)
+            await lookup(wiki, cache, fetch)
+            age_entries(cache, 7200)
+            page = await lookup(wiki, cache, fetch)
+        return page, len(wiki.requests)
+
+    page, requests = asyncio.run(run())
+    assert requests == 2
+    assert page[0]["text"] == PAGES["en"]["Kora"]
+
+def test_offline_serves_stale_entries_and_misses_as_no_page(tmp_path):
+    cache = WikiPageCache(tmp_path / "cache.sqlite", ttl_seconds=3600)
+
+    async def run():
+        async with MockMediaWiki(pages=PAGES, langlinks=LANGLINKS) as wiki:
+            await lookup(wiki, cache, lambda client: client.fetch_pages(["Kora"], fields=TEXT_ONLY))
+            await lookup(wiki, cache, lambda client: client.resolve_langlinks("fr", ["Tambour"]))
+            age_entries(cache, 7200)
+            online_requests = len(wiki.requests)
+            stale = await lookup(wiki, cache, lambda client: client.first_page(["Kora"], fields=TEXT_ONLY), offline=True)
+            missing = await lookup(wiki, cache, lambda client: client.first_page(["Djembe"], fields=TEXT_ONLY), offline=True)
+            links = await lookup(wiki, cache, lambda client: client.resolve_langlinks("fr", ["Tambour", "Trommel"]), offline=True)
+        return stale, missing, links, len(wiki.requests) - online_requests
+
+    stale, missing, links, offline_requests = asyncio.run(run())
+    assert offline_requests == 0
+    assert stale["text"] == PAGES["en"]["Kora"]
+    assert missing is None
+    assert links == {"Tambour": "Drum", "Trommel": None}
+
+def test_larger_text_budget_refetches(tmp_path):
+    cache = WikiPageCache(tmp_path / "cache.sqlite")
+
+    async def run():
+        async with MockMediaWiki(pages=PAGES) as wiki:
+            counts = []
+            for max_chars in (10, 5, 20, None, 30):
+                page = await lookup(wiki, cache, lambda client: client.fetch_pages(["Kora"], fields=TEXT_ONLY, max_chars=max_chars))
+                counts.append(len(wiki.requests))
+        return page, counts
+
+    page, counts = asyncio.run(run())
+    # Smaller budgets are served from the cached truncated text; larger ones and the full text are not
+    assert counts == [1, 1, 2, 3, 3]
+    assert page[0]["text"] == PAGES["en"]["Kora"][:30]
+
+def test_eviction_keeps_payload_under_limit_and_recent_entries(tmp_path):
+    max_bytes = 20_000
+    cache = WikiPageCache(tmp_path / "cache.sqlite", max_bytes=max_bytes)
+    page = {"title": "", "text": "x" * 1000}
+    cache.put_page("en", "first", page)
+    for i in range(50):
+        cache.put_page("en", f"page {i}", page)
+        # Kept recently used although it was written first
+        assert cache.get_page("en", "first") is not MISS
+
+    shared = sqlite3.connect(tmp_path / "cache.sqlite").execute("SELECT SUM(size) FROM entries").fetchone()[0]
+    assert shared <= max_bytes
+    assert cache.total_bytes() == shared
+    assert cache.get_page("en", "page 0") is MISS
+    assert cache.get_page("en", "page 49") is not MISS
+
+def test_eviction_counts_entries_written_by_other_processes(tmp_path):
+    max_bytes = 20_000
+    page = {"title": "", "text": "x" * 1000}
+    first = WikiPageCache(tmp_path / "cache.sqlite", max_bytes=max_bytes)
+    second = WikiPageCache(tmp_path / "cache.sqlite", max_bytes=max_bytes)
+    for i in range(15):
+        first.put_page("en", f"first {i}", page)
+    for i in range(10):
+        second.put_page("en", f"second {i}", page)
+
+    total = sqlite3.connect(tmp_path / "cache.sqlite").execute("SELECT SUM(size) FROM entries").fetchone()[0]
+    assert total <= max_bytes
+    assert first.total_bytes() == second.total_bytes() == total
+    assert total > max_bytes * LOW_WATER_MARK - 2000
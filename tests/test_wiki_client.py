@@ -0,0 +1,117 @@
+import asyncio
+import time
+from mediawiki import MockMediaWiki
+from src.scripts.wiki_client import AsyncWikipediaClient
+
+PAGES = {"en": {
+    "Djembe": "The djembe is a rope-tuned drum.\n\n== History ==\nIt comes from West Africa.",
+    "Kora": "The kora is a 21-string lute-bridge-harp.",
+}}
+TEXT_ONLY = ("title", "text")
+
+def fetch(wiki, titles, fields=None, **client_args):
+    async def run():
+        async with AsyncWikipediaClient(api_url=wiki.url, **client_args) as client:
+            return await client.fetch_pages(titles, fields=fields)
+    return run()
+
+def test_fetch_pages_batches_metadata_query():
+    async def run():
+        async with MockMediaWiki(pages=PAGES) as wiki:
+            pages = await fetch(wiki, ["Djembe", "Kora", "Balafon"])
+        return wiki, pages
+
+    wiki, pages = asyncio.run(run())
+    info = wiki.queries("info|categories")
+    assert [q["titles"] for q in info] == ["Djembe|Kora|Balafon"]
+    assert sorted(q["titles"] for q in wiki.queries("extracts")) == ["Djembe", "Kora"]
+    assert pages[0]["summary"] == "The djembe is a rope-tuned drum."
+    assert pages[0]["sections"] == ["History"]
+    assert pages[0]["categories"] == ["Category:Djembe"]
+    assert pages[1]["title"] == "Kora"
+    assert pages[2] == {"title": "Balafon", "text": ""}
+
+def test_selective_fields_skip_metadata_query():
+    async def run():
+        async with MockMediaWiki(pages=PAGES) as wiki:
+            pages = await fetch(wiki, ["Kora"], fields=TEXT_ONLY)
+        return wiki, pages
+
+    wiki, pages = asyncio.run(run())
+    assert not wiki.queries("info|categories")
+    assert len(wiki.queries("extracts")) == 1
+    assert pages == [{"title": "Kora", "text": PAGES["en"]["Kora"]}]
+
+def test_retries_429_and_5xx():
+    async def run():
+        async with MockMediaWiki(pages=PAGES, failures=[503, 429]) as wiki:
+            pages = await fetch(wiki, ["Kora"], fields=TEXT_ONLY, max_retries=2, hedge_delay=None)
+        return wiki, pages
+
+    wiki, pages = asyncio.run(run())
+    assert len(wiki.requests) == 3
+    assert pages[0]["text"] == PAGES["en"]["Kora"]
+
+def test_gives_up_after_max_retries():
+    async def run():
+        async with MockMediaWiki(pages=PAGES, failures=[503, 503, 503]) as wiki:
+            pages = await fetch(wiki, ["Kora"], fields=TEXT_ONLY, max_retries=1, hedge_delay=None)
+        return wiki, pages
+
+    wiki, pages = asyncio.run(run())
+    assert len(wiki.requests) == 2
+    assert pages == [None]
+
+def test_client_errors_are_not_retried():
+    async def run():
+        async with MockMediaWiki(pages=PAGES, failures=[404]) as wiki:
+            pages = await fetch(wiki, ["Kora"], fields=TEXT_ONLY, max_retries=2, hedge_delay=None)
+        return wiki, pages
+
+    wiki, pages = asyncio.run(run())
+    assert len(wiki.requests) == 1
+    assert pages == [None]
+
+def test_slow_request_is_hedged():
+    async def run():
+        async with MockMediaWiki(pages=PAGES, delays=[2.0]) as wiki:
+            start = time.monotonic()
+            pages = await fetch(wiki, ["Kora"], fields=TEXT_ONLY, hedge_delay=0.05, request_timeout=5)
+            elapsed = time.monotonic() - start
+        return wiki, pages, elapsed
+
+    wiki, pages, elapsed = asyncio.run(run())
+    assert len(wiki.requests) == 2
+    assert pages[0]["text"] == PAGES["en"]["Kora"]
+    assert elapsed < 1.0
+
+def test_no_hedge_while_pool_is_saturated():
+    async def run():
+        async with MockMediaWiki(pages=PAGES, delays=[0.2, 0.2]) as wiki:
+            pages = await fetch(wiki, ["Djembe", "Kora"], fields=TEXT_ONLY, max_concurrency=1, hedge_delay=0.05)
+        return wiki, pages
+
+    wiki, pages = asyncio.run(run())
+    # Each request waited for the single slot, and holding it left no room for a duplicate
+    assert len(wiki.requests) == 2
+    assert [page["title"] for page in pages] == ["Djembe", "Kora"]
+
+def test_timeout_is_retried_then_reported_as_failure():
+    async def run():
+        async with MockMediaWiki(pages=PAGES, delays=[1.0, 1.0]) as wiki:
+            pages = await fetch(wiki, ["Kora"], fields=TEXT_ONLY, request_timeout=0.1, hedge_delay=None, max_retries=1)
+        return wiki, pages
+
+    wiki, pages = asyncio.run(run())
+    assert len(wiki.requests) == 2
+    assert pages == [None]
+
+def test_timeout_then_success():
+    async def run():
+        async with MockMediaWiki(pages=PAGES, delays=[1.0]) as wiki:
+            pages = await fetch(wiki, ["Kora"], fields=TEXT_ONLY, request_timeout=0.1, hedge_delay=None, max_retries=1)
+        return wiki, pages
+
+    wiki, pages = asyncio.run(run())
+    assert len(wiki.requests) == 2
+    assert pages[0]["text"] == PAGES["en"]["Kora"]